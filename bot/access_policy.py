@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import logging
+
+# the configuration settings the access policy is compiled from
+POLICY_SETTINGS = ('allowed_user_ids', 'admin_user_ids', 'user_budgets')
+
+
+class Access:
+    """
+    The access of a user, as checked by `AccessPolicy.check`.
+    """
+    __slots__ = ('allowed', 'admin', 'budget', 'guest')
+
+    def __init__(self, allowed: bool, admin: bool, budget: float | None, guest: bool):
+        self.allowed = allowed  # whether the user is allowed to use the bot on their own
+        self.admin = admin
+        self.budget = budget  # the budget of the user, or None if the guest budget applies
+        self.guest = guest  # whether the usage of the user counts towards the guest budget
+
+
+class AccessPolicy:
+    """
+    The allowed users, admins and user budgets, compiled once from the comma separated lists
+    of the configuration into sets and dictionaries, so that checking a user is a few hash lookups.
+    A policy is never changed after it is compiled: a changed configuration compiles a new policy,
+    see `get_access_policy`.
+    """
+
+    def __init__(self, config: dict):
+        """
+        Compiles the access policy.
+        :param config: The bot configuration object
+        """
+        self.settings = tuple(config[setting] for setting in POLICY_SETTINGS)
+        allowed_user_ids, admin_user_ids, user_budgets = self.settings
+
+        self.allow_all = allowed_user_ids == '*'
+        self.allowed_user_ids = frozenset(allowed_user_ids.split(','))
+        self.admin_user_ids = frozenset() if admin_user_ids == '-' else frozenset(admin_user_ids.split(','))
+        # the users whose membership allows guests to use the bot in a group chat
+        self.member_user_ids = tuple(dict.fromkeys(
+            user_id for user_id in [*allowed_user_ids.split(','), *self.admin_user_ids] if user_id.strip()
+        ))
+
+        self.unlimited_budgets = user_budgets == '*'
+        self.default_budget = None
+        self.budgets = {}
+        if self.unlimited_budgets:
+            return
+        budgets = user_budgets.split(',')
+        if self.allow_all:
+            # same budget for all users, use value in first position of budget list
+            if len(budgets) > 1:
+                logging.warning('multiple values for budgets set with unrestricted user list '
+                                'only the first value is used as budget for everyone.')
+            self.default_budget = float(budgets[0])
+            return
+        for index, user_id in enumerate(allowed_user_ids.split(',')):
+            if user_id in self.budgets:
+                continue
+            if len(budgets) <= index:
+                logging.warning(f'No budget set for user id: {user_id}. Budget list shorter than user list.')
+                self.budgets[user_id] = 0.0
+            else:
+                self.budgets[user_id] = float(budgets[index])
+
+    def is_compiled_from(self, config: dict) -> bool:
+        """
+        Checks if the policy was compiled from the current access settings of the configuration.
+        """
+        return all(config[setting] == value for setting, value in zip(POLICY_SETTINGS, self.settings))
+
+    def check(self, user_id) -> Access:
+        """
+        Checks the access of a user.
+        :param user_id: The user ID
+        :return: whether the user is allowed and an admin, and the user's budget
+        """
+        user_id = str(user_id)
+        admin = user_id in self.admin_user_ids
+        allowed = self.allow_all or admin or user_id in self.allowed_user_ids
+        if admin or self.unlimited_budgets:
+            budget = float('inf')
+        elif self.allow_all:
+            budget = self.default_budget
+        else:
+            budget = self.budgets.get(user_id)
+        return Access(allowed, admin, budget, user_id not in self.allowed_user_ids)
+
+
+def get_access_policy(config: dict) -> AccessPolicy:
+    """
+    Get the compiled access policy of the configuration, compiling it again when the access settings changed.
+    The policy is replaced with a single assignment, so checks never see a partially compiled policy.
+    :param config: The bot configuration object
+    :return: The access policy
+    """
+    policy = config.get('access_policy')
+    if policy is None or not policy.is_compiled_from(config):
+        policy = AccessPolicy(config)
+        config['access_policy'] = policy
+    return policy
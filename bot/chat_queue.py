@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import asyncio
+
+
+class ChatQueueFull(Exception):
+    """
+    Raised when a chat already has the maximum number of queued requests.
+    """
+    pass
+
+
+class ChatQueue:
+    """
+    Runs the requests of each chat one at a time, in order of arrival,
+    while requests of different chats still run in parallel.
+    The running request of a chat can be cancelled, e.g. when it is superseded by a newer one.
+    """
+
+    def __init__(self, max_depth: int = 0):
+        """
+        Initializes the chat queue.
+        :param max_depth: Maximum number of running and waiting requests per chat, 0 for no limit
+        """
+        self.max_depth = max_depth
+        self.locks: dict[int, asyncio.Lock] = {}
+        self.depths: dict[int, int] = {}
+        self.running: dict[int, tuple[int | None, asyncio.Task]] = {}  # {chat_id: (user_id, task)}
+
+    async def acquire(self, chat_id, user_id: int | None = None):
+        """
+        Waits until all earlier requests of the chat are done.
+        Every successful call must be followed by a call to `release`.
+        :param chat_id: The chat ID
+        :param user_id: The ID of the user who sent the request
+        :raises ChatQueueFull: if the chat already has the maximum number of queued requests
+        """
+        depth = self.depths.get(chat_id, 0)
+        if self.max_depth and depth >= self.max_depth:
+            raise ChatQueueFull(f'Chat {chat_id} has {depth} queued requests')
+        self.depths[chat_id] = depth + 1
+        lock = self.locks.setdefault(chat_id, asyncio.Lock())
+        try:
+            await lock.acquire()
+        except BaseException:
+            self.__leave(chat_id)
+            raise
+        self.running[chat_id] = (user_id, asyncio.current_task())
+
+    def release(self, chat_id):
+        """
+        Lets the next request of the chat run.
+        :param chat_id: The chat ID
+        """
+        self.running.pop(chat_id, None)
+        self.locks[chat_id].release()
+        self.__leave(chat_id)
+
+    def cancel(self, chat_id, user_id: int | None = None) -> bool:
+        """
+        Cancels the running request of the chat. Waiting requests are not affected.
+        :param chat_id: The chat ID
+        :param user_id: If given, the request is only cancelled if it was sent by this user
+        :return: Boolean indicating if a request was cancelled
+        """
+        if chat_id not in self.running:
+            return False
+        running_user_id, task = self.running[chat_id]
+        if user_id is not None and running_user_id != user_id:
+            return False
+        if task is asyncio.current_task():
+            return False
+        return task.cancel()
+
+    def __leave(self, chat_id):
+        self.depths[chat_id] -= 1
+        if self.depths[chat_id] == 0:
+            del self.depths[chat_id]
+            del self.locks[chat_id]
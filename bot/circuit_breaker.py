@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import time
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing dependency for a while. After `threshold` consecutive failures the breaker opens
+    and rejects all calls for `cooldown` seconds. Then a single trial call is let through (half-open):
+    the breaker closes again if it succeeds, and opens for another cooldown if it fails.
+    """
+
+    def __init__(self, threshold: int = 5, cooldown: float = 60):
+        """
+        Initializes a closed breaker.
+        :param threshold: Number of consecutive failures opening the breaker, 0 to never open it
+        :param cooldown: Number of seconds to reject calls for once the breaker is open
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return CLOSED
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return OPEN
+        return HALF_OPEN
+
+    def allow(self) -> bool:
+        """
+        Checks if a call may be made now. A call that is allowed must be followed by
+        `record_success` or `record_failure`.
+        """
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and not self.trial_running:
+            self.trial_running = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial_running or (self.threshold > 0 and self.failures >= self.threshold):
+            self.opened_at = time.monotonic()
+        self.trial_running = False
+
+    def abandon(self):
+        """
+        Records that an allowed call was abandoned before it succeeded or failed.
+        """
+        self.trial_running = False
+
+    def get_retry_after(self) -> float:
+        """
+        Get the number of seconds until the open breaker lets a trial call through.
+        """
+        if self.opened_at is None:
+            return 0.0
+        return max(self.cooldown - (time.monotonic() - self.opened_at), 0.0)
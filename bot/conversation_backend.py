@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import datetime
+import json
+import logging
+import sqlite3
+from abc import ABC, abstractmethod
+
+from conversation_store import Conversation, message_size
+
+
+class ConversationBackend(ABC):
+    """
+    A backend interface to persist conversations beyond the lifetime of the process.
+    """
+
+    @abstractmethod
+    def load(self, chat_id) -> Conversation | None:
+        """
+        Load the conversation of the given chat, or None if there is no stored conversation.
+        """
+        pass
+
+    @abstractmethod
+    def append(self, chat_id, conversation: Conversation, message: dict, tokens: int):
+        """
+        Store a message that has been appended to the conversation of the given chat.
+        """
+        pass
+
+    @abstractmethod
+    def reset(self, chat_id):
+        """
+        Remove all stored messages of the given chat.
+        """
+        pass
+
+    @abstractmethod
+    def truncate(self, chat_id, size: int):
+        """
+        Keep only the first stored message of the given chat, the system prompt, and the last `size - 1` ones.
+        """
+        pass
+
+    @abstractmethod
+    def replace(self, chat_id, conversation: Conversation):
+        """
+        Replace all stored messages of the given chat with the messages of the conversation.
+        """
+        pass
+
+    @abstractmethod
+    def remove_expired(self, before: datetime.datetime) -> int:
+        """
+        Remove all conversations last updated before the given time and return their number.
+        """
+        pass
+
+    def close(self):
+        """
+        Release the resources held by the backend.
+        """
+        pass
+
+
+class SQLiteConversationBackend(ConversationBackend):
+    """
+    Persists conversations in an embedded SQLite database in WAL mode.
+    Every message is written as its own row, so a turn only costs a small insert.
+    """
+
+    def __init__(self, path: str):
+        """
+        Opens (and creates if needed) the SQLite database.
+        :param path: Path to the database file
+        """
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS conversations ('
+                'chat_id INTEGER PRIMARY KEY, is_vision INTEGER NOT NULL, last_updated TEXT NOT NULL, '
+                "summary TEXT NOT NULL DEFAULT '', summary_tokens INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(conversations)')]
+            if 'summary' not in columns:
+                self.connection.execute(
+                    "ALTER TABLE conversations ADD COLUMN summary TEXT NOT NULL DEFAULT ''"
+                )
+                self.connection.execute(
+                    'ALTER TABLE conversations ADD COLUMN summary_tokens INTEGER NOT NULL DEFAULT 0'
+                )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS messages ('
+                'chat_id INTEGER NOT NULL, position INTEGER NOT NULL, message TEXT NOT NULL, '
+                'tokens INTEGER NOT NULL, PRIMARY KEY (chat_id, position))'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS conversations_last_updated ON conversations (last_updated)'
+            )
+
+    def load(self, chat_id) -> Conversation | None:
+        row = self.connection.execute(
+            'SELECT is_vision, last_updated, summary, summary_tokens FROM conversations WHERE chat_id = ?',
+            (chat_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        conversation = Conversation()
+        conversation.is_vision = bool(row[0])
+        conversation.last_updated = datetime.datetime.fromisoformat(row[1])
+        conversation.summary = row[2]
+        conversation.summary_tokens = row[3]
+        conversation.size = len(conversation.summary)
+        for message, tokens in self.connection.execute(
+                'SELECT message, tokens FROM messages WHERE chat_id = ? ORDER BY position', (chat_id,)):
+            message = json.loads(message)
+            conversation.messages.append(message)
+            conversation.tokens.append(tokens)
+            conversation.total_tokens += tokens
+            conversation.size += message_size(message)
+        if len(conversation.messages) == 0:
+            return None
+        logging.debug(f'Loaded conversation for chat ID {chat_id} with {len(conversation.messages)} messages')
+        return conversation
+
+    def append(self, chat_id, conversation: Conversation, message: dict, tokens: int):
+        with self.connection:
+            self.connection.execute(
+                'INSERT INTO messages (chat_id, position, message, tokens) VALUES (?, '
+                '(SELECT COALESCE(MAX(position), -1) + 1 FROM messages WHERE chat_id = ?), ?, ?)',
+                (chat_id, chat_id, json.dumps(message), tokens)
+            )
+            self.connection.execute(
+                'INSERT INTO conversations (chat_id, is_vision, last_updated) VALUES (?, ?, ?) '
+                'ON CONFLICT (chat_id) DO UPDATE SET is_vision = excluded.is_vision, '
+                'last_updated = excluded.last_updated',
+                (chat_id, int(conversation.is_vision), conversation.last_updated.isoformat())
+            )
+
+    def reset(self, chat_id):
+        with self.connection:
+            self.connection.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+            self.connection.execute(
+                "UPDATE conversations SET summary = '', summary_tokens = 0 WHERE chat_id = ?", (chat_id,)
+            )
+
+    def truncate(self, chat_id, size: int):
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM messages WHERE chat_id = ? '
+                'AND position > (SELECT MIN(position) FROM messages WHERE chat_id = ?) AND position NOT IN ('
+                'SELECT position FROM messages WHERE chat_id = ? ORDER BY position DESC LIMIT ?)',
+                (chat_id, chat_id, chat_id, max(size - 1, 0))
+            )
+
+    def replace(self, chat_id, conversation: Conversation):
+        with self.connection:
+            self.connection.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+            self.connection.executemany(
+                'INSERT INTO messages (chat_id, position, message, tokens) VALUES (?, ?, ?, ?)',
+                [(chat_id, position, json.dumps(message), tokens)
+                 for position, (message, tokens) in enumerate(zip(conversation.messages, conversation.tokens))]
+            )
+            self.connection.execute(
+                'INSERT INTO conversations (chat_id, is_vision, last_updated, summary, summary_tokens) '
+                'VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (chat_id) DO UPDATE SET is_vision = excluded.is_vision, '
+                'last_updated = excluded.last_updated, summary = excluded.summary, '
+                'summary_tokens = excluded.summary_tokens',
+                (chat_id, int(conversation.is_vision), conversation.last_updated.isoformat(),
+                 conversation.summary, conversation.summary_tokens)
+            )
+
+    def remove_expired(self, before: datetime.datetime) -> int:
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM messages WHERE chat_id IN ('
+                'SELECT chat_id FROM conversations WHERE last_updated < ?)', (before.isoformat(),)
+            )
+            return self.connection.execute(
+                'DELETE FROM conversations WHERE last_updated < ?', (before.isoformat(),)
+            ).rowcount
+
+    def close(self):
+        self.connection.close()
+
+
+def create_conversation_backend(config: dict) -> ConversationBackend | None:
+    """
+    Creates the conversation backend selected in the configuration.
+    :param config: A dictionary containing the GPT configuration
+    :return: The conversation backend, or None if conversations are only kept in memory
+    """
+    backend = config.get('conversation_backend', 'memory')
+    if backend == 'sqlite':
+        return SQLiteConversationBackend(config['conversation_db_path'])
+    if backend != 'memory':
+        raise ValueError(f'Unknown conversation backend: {backend}')
+    return None
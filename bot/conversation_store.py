@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import datetime
+import logging
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from conversation_backend import ConversationBackend
+
+
+def message_size(message: dict) -> int:
+    """
+    Returns the approximate in-memory size of a message in bytes, based on the length of its contents.
+    """
+    size = 0
+    for value in message.values():
+        if isinstance(value, str):
+            size += len(value)
+        elif isinstance(value, list):
+            for part in value:
+                if part.get('type') == 'image_url':
+                    size += len(part['image_url']['url'])
+                elif part.get('type') == 'function':
+                    size += len(part['function']['name']) + len(part['function']['arguments'])
+                else:
+                    size += len(part.get('text', ''))
+    return size
+
+
+class Conversation:
+    """
+    The history of a single chat along with its bookkeeping data.
+    """
+
+    def __init__(self):
+        self.messages: list[dict] = []
+        self.tokens: list[int] = []  # tokens per message, in the same order as messages
+        self.total_tokens = 0
+        self.summary = ''  # rolling summary of the messages that are no longer in the history
+        self.summary_tokens = 0
+        self.size = 0
+        self.is_vision = False
+        self.last_updated = datetime.datetime.now()
+
+
+class ConversationStore:
+    """
+    Keeps the conversations of recently active chats in memory.
+    The least recently used conversations are evicted once the configured number of conversations
+    or the configured memory size is exceeded, and conversations older than the maximum age
+    are dropped by `sweep`.
+    If a backend is given, every change is written through to it and conversations that are not
+    in memory are loaded from it on first access.
+    """
+
+    def __init__(self, max_conversations: int = 0, max_memory_mb: float = 0, max_age_minutes: int = 180,
+                 backend: ConversationBackend | None = None):
+        """
+        Initializes the conversation store.
+        :param max_conversations: Maximum number of conversations to keep, 0 for no limit
+        :param max_memory_mb: Maximum approximate size of all conversations in MB, 0 for no limit
+        :param max_age_minutes: Number of minutes after the last update a conversation expires
+        :param backend: The backend to persist conversations to, if any
+        """
+        self.backend = backend
+        self.max_conversations = max_conversations
+        self.max_size = int(max_memory_mb * 1024 * 1024)
+        self.max_age = datetime.timedelta(minutes=max_age_minutes)
+        self.conversations: OrderedDict[int, Conversation] = OrderedDict()
+        self.size = 0
+
+    def __contains__(self, chat_id) -> bool:
+        return chat_id in self.conversations
+
+    def __getitem__(self, chat_id) -> Conversation:
+        self.conversations.move_to_end(chat_id)
+        return self.conversations[chat_id]
+
+    def __len__(self) -> int:
+        return len(self.conversations)
+
+    def get(self, chat_id) -> Conversation | None:
+        """
+        Returns the conversation of the given chat, loading it from the backend if it is not in memory.
+        :param chat_id: The chat ID
+        :return: The conversation, or None if there is none
+        """
+        if chat_id in self.conversations:
+            return self[chat_id]
+        if self.backend is None:
+            return None
+        conversation = self.backend.load(chat_id)
+        if conversation is None:
+            return None
+        self.conversations[chat_id] = conversation
+        self.size += conversation.size
+        self.__evict()
+        return conversation
+
+    def is_expired(self, chat_id) -> bool:
+        """
+        Checks if the maximum conversation age has been reached.
+        :param chat_id: The chat ID
+        :return: A boolean indicating whether the maximum conversation age has been reached
+        """
+        if chat_id not in self.conversations:
+            return False
+        return self.conversations[chat_id].last_updated < datetime.datetime.now() - self.max_age
+
+    def touch(self, chat_id):
+        """
+        Marks the conversation as updated now.
+        """
+        self[chat_id].last_updated = datetime.datetime.now()
+
+    def reset(self, chat_id) -> Conversation:
+        """
+        Replaces the conversation of the given chat with an empty one.
+        """
+        self.remove(chat_id)
+        conversation = Conversation()
+        self.conversations[chat_id] = conversation
+        if self.backend is not None:
+            self.backend.reset(chat_id)
+        return conversation
+
+    def append(self, chat_id, message: dict, tokens: int):
+        """
+        Appends a message to the conversation of the given chat.
+        :param chat_id: The chat ID
+        :param message: The message to append
+        :param tokens: The number of tokens of the message
+        """
+        conversation = self[chat_id]
+        size = message_size(message)
+        conversation.messages.append(message)
+        conversation.tokens.append(tokens)
+        conversation.total_tokens += tokens
+        conversation.size += size
+        self.size += size
+        if self.backend is not None:
+            self.backend.append(chat_id, conversation, message, tokens)
+        self.__evict()
+
+    def truncate(self, chat_id, size: int):
+        """
+        Keeps only the system prompt and the last `size - 1` messages of the conversation of the given chat.
+        """
+        conversation = self[chat_id]
+        if len(conversation.messages) <= size:
+            return
+        start = len(conversation.messages) - max(size - 1, 0)
+        conversation.messages = conversation.messages[:1] + conversation.messages[start:]
+        conversation.tokens = conversation.tokens[:1] + conversation.tokens[start:]
+        conversation.total_tokens = sum(conversation.tokens)
+        self.size -= conversation.size
+        conversation.size = len(conversation.summary) + \
+            sum(message_size(message) for message in conversation.messages)
+        self.size += conversation.size
+        if self.backend is not None:
+            self.backend.truncate(chat_id, size)
+
+    def replace(self, chat_id, messages: list[dict], tokens: list[int], summary: str, summary_tokens: int):
+        """
+        Replaces all messages and the summary of the conversation of the given chat at once,
+        e.g. after summarising the history.
+        :param chat_id: The chat ID
+        :param messages: The new messages
+        :param tokens: The number of tokens of each message, in the same order as messages
+        :param summary: The new summary
+        :param summary_tokens: The number of tokens of the summary
+        """
+        conversation = self[chat_id]
+        conversation.messages = messages
+        conversation.tokens = tokens
+        conversation.total_tokens = sum(tokens)
+        conversation.summary = summary
+        conversation.summary_tokens = summary_tokens
+        self.size -= conversation.size
+        conversation.size = len(summary) + sum(message_size(message) for message in messages)
+        self.size += conversation.size
+        if self.backend is not None:
+            self.backend.replace(chat_id, conversation)
+
+    def remove(self, chat_id):
+        """
+        Removes the conversation of the given chat from memory, if any.
+        """
+        conversation = self.conversations.pop(chat_id, None)
+        if conversation is not None:
+            self.size -= conversation.size
+
+    def sweep(self) -> int:
+        """
+        Removes all conversations that reached the maximum age.
+        :return: The number of removed conversations
+        """
+        expired = [chat_id for chat_id in self.conversations if self.is_expired(chat_id)]
+        for chat_id in expired:
+            self.remove(chat_id)
+        removed = len(expired)
+        if self.backend is not None:
+            removed = max(removed, self.backend.remove_expired(datetime.datetime.now() - self.max_age))
+        if removed > 0:
+            logging.info(f'Removed {removed} expired conversations')
+        return removed
+
+    def close(self):
+        """
+        Closes the backend, if any.
+        """
+        if self.backend is not None:
+            self.backend.close()
+
+    def __evict(self):
+        """
+        Evicts the least recently used conversations until the store is within its limits.
+        The most recently used conversation is never evicted.
+        """
+        while len(self.conversations) > 1 and (
+                (self.max_conversations and len(self.conversations) > self.max_conversations) or
+                (self.max_size and self.size > self.max_size)):
+            chat_id, conversation = self.conversations.popitem(last=False)
+            self.size -= conversation.size
+            logging.debug(f'Evicted conversation for chat ID {chat_id}')
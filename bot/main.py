@@ -34,9 +34,17 @@ def main():
         'api_key': os.environ['OPENAI_API_KEY'],
         'show_usage': os.environ.get('SHOW_USAGE', 'false').lower() == 'true',
         'stream': os.environ.get('STREAM', 'true').lower() == 'true',
+        'stream_usage': os.environ.get('STREAM_USAGE', 'true').lower() == 'true',
         'proxy': os.environ.get('PROXY', None) or os.environ.get('OPENAI_PROXY', None),
         'max_history_size': int(os.environ.get('MAX_HISTORY_SIZE', 15)),
+        'summarise_threshold': float(os.environ.get('SUMMARISE_THRESHOLD', 0.8)),
+        'summary_model': os.environ.get('SUMMARY_MODEL', model),
+        'summary_max_input_tokens': int(os.environ.get('SUMMARY_MAX_INPUT_TOKENS', 3000)),
         'max_conversation_age_minutes': int(os.environ.get('MAX_CONVERSATION_AGE_MINUTES', 180)),
+        'max_conversations': int(os.environ.get('MAX_CONVERSATIONS', 10000)),
+        'max_conversations_memory_mb': float(os.environ.get('MAX_CONVERSATIONS_MEMORY_MB', 256)),
+        'conversation_backend': os.environ.get('CONVERSATION_BACKEND', 'memory').lower(),
+        'conversation_db_path': os.environ.get('CONVERSATION_DB_PATH', 'conversations.db'),
         'assistant_prompt': os.environ.get('ASSISTANT_PROMPT', 'You are a helpful assistant.'),
         'max_tokens': int(os.environ.get('MAX_TOKENS', max_tokens_default)),
         'n_choices': int(os.environ.get('N_CHOICES', 1)),
@@ -100,10 +108,34 @@ def main():
         'tts_prices': [float(i) for i in os.environ.get('TTS_PRICES', "0.015,0.030").split(",")],
         'transcription_price': float(os.environ.get('TRANSCRIPTION_PRICE', 0.006)),
         'bot_language': os.environ.get('BOT_LANGUAGE', 'en'),
+        'housekeeping_interval': int(os.environ.get('HOUSEKEEPING_INTERVAL_SECONDS', 60)),
+        'usage_flush_interval': float(os.environ.get('USAGE_FLUSH_INTERVAL_SECONDS', 5)),
+        'usage_storage': os.environ.get('USAGE_STORAGE', 'json').lower(),
+        'usage_db_path': os.environ.get('USAGE_DB_PATH', 'usage.db'),
+        'usage_compaction_days': int(os.environ.get('USAGE_COMPACTION_DAYS', 90)),
+        'usage_compaction_months': int(os.environ.get('USAGE_COMPACTION_MONTHS', 24)),
+        'usage_cache_size': int(os.environ.get('USAGE_CACHE_SIZE', 1000)),
+        'membership_cache_ttl': float(os.environ.get('MEMBERSHIP_CACHE_TTL_SECONDS', 300)),
+        'membership_check_concurrency': int(os.environ.get('MEMBERSHIP_CHECK_CONCURRENCY', 10)),
+        'enable_usage_report': os.environ.get('ENABLE_USAGE_REPORT', 'true').lower() == 'true',
+        'max_queued_requests': int(os.environ.get('MAX_QUEUED_REQUESTS', 5)),
+        'cancel_superseded_requests': os.environ.get('CANCEL_SUPERSEDED_REQUESTS', 'true').lower() == 'true',
     }
 
     plugin_config = {
-        'plugins': os.environ.get('PLUGINS', '').split(',')
+        'plugins': os.environ.get('PLUGINS', '').split(','),
+        'http_timeout': float(os.environ.get('PLUGIN_HTTP_TIMEOUT_SECONDS', 15)),
+        'http_max_connections': int(os.environ.get('PLUGIN_HTTP_MAX_CONNECTIONS', 100)),
+        'http_max_connections_per_host': int(os.environ.get('PLUGIN_HTTP_HOST_CONNECTIONS', 10)),
+        'plugin_executors': os.environ.get('PLUGIN_EXECUTORS', ''),
+        'plugin_max_concurrency': int(os.environ.get('PLUGIN_MAX_CONCURRENCY', 4)),
+        'plugin_thread_workers': int(os.environ.get('PLUGIN_THREAD_WORKERS', 8)),
+        'plugin_process_workers': int(os.environ.get('PLUGIN_PROCESS_WORKERS', 2)),
+        'plugin_cache_size': int(os.environ.get('PLUGIN_CACHE_SIZE', 256)),
+        'plugin_timeout': float(os.environ.get('PLUGIN_TIMEOUT_SECONDS', 30)),
+        'plugin_timeouts': os.environ.get('PLUGIN_TIMEOUTS', ''),
+        'plugin_breaker_threshold': int(os.environ.get('PLUGIN_BREAKER_THRESHOLD', 5)),
+        'plugin_breaker_cooldown': float(os.environ.get('PLUGIN_BREAKER_COOLDOWN_SECONDS', 60)),
     }
 
     # Setup and run ChatGPT and Telegram bot
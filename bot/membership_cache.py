@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+from telegram import ChatMemberUpdated, Update
+from telegram.ext import CallbackContext
+
+
+class MembershipCache:
+    """
+    Caches whether users are members of group chats, keyed by (chat_id, user_id), for a limited time.
+    The cached membership of a user is dropped when Telegram reports a change of it,
+    and all cached memberships of a chat are dropped when the bot itself leaves the chat.
+    """
+
+    def __init__(self, ttl: float = 300, max_concurrency: int = 10):
+        """
+        Initializes the cache.
+        :param ttl: Number of seconds to keep a cached membership for
+        :param max_concurrency: Maximum number of memberships to look up at the same time
+        """
+        self.ttl = ttl
+        self.max_concurrency = max(max_concurrency, 1)
+        self.entries = {}  # {(chat_id, user_id): (is_member, expiry time)}
+
+    def get(self, chat_id, user_id) -> bool | None:
+        """
+        Get the cached membership of a user, or None if it is not cached or expired.
+        """
+        entry = self.entries.get((chat_id, str(user_id)))
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        return entry[0]
+
+    def set(self, chat_id, user_id, is_member: bool):
+        """
+        Caches the membership of a user.
+        """
+        self.entries[(chat_id, str(user_id))] = (is_member, time.monotonic() + self.ttl)
+
+    def invalidate(self, chat_id, user_id=None):
+        """
+        Drops the cached membership of a user, or of all users of the chat if no user is given.
+        """
+        if user_id is not None:
+            self.entries.pop((chat_id, str(user_id)), None)
+            return
+        for key in [key for key in self.entries if key[0] == chat_id]:
+            del self.entries[key]
+
+    def sweep(self):
+        """
+        Drops the expired memberships.
+        """
+        now = time.monotonic()
+        for key in [key for key, (_, expiry) in self.entries.items() if expiry < now]:
+            del self.entries[key]
+
+    def handle_update(self, chat_member: ChatMemberUpdated):
+        """
+        Drops the cached membership changed by a chat member update.
+        :param chat_member: The chat member update of a user or of the bot itself
+        """
+        chat_id = chat_member.chat.id
+        if chat_member.new_chat_member.user.id == chat_member.get_bot().id:
+            self.invalidate(chat_id)
+        else:
+            self.invalidate(chat_id, chat_member.new_chat_member.user.id)
+
+    async def any_member(self, update: Update, context: CallbackContext, user_ids, is_member) -> str | None:
+        """
+        Finds a user of the given users that is a member of the chat of the update.
+        Cached memberships are used first, the others are looked up concurrently,
+        and the remaining lookups are cancelled as soon as a member is found.
+        :param update: Telegram update object
+        :param context: Telegram callback context
+        :param user_ids: The users to look for
+        :param is_member: Coroutine function looking up if a user is a member, see `utils.is_user_in_group`
+        :return: The first member found, or None if none of the users are members
+        """
+        chat_id = update.message.chat_id
+        missing = []
+        for user_id in user_ids:
+            cached = self.get(chat_id, user_id)
+            if cached:
+                return user_id
+            if cached is None:
+                missing.append(user_id)
+        if len(missing) == 0:
+            return None
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def check(user_id):
+            async with semaphore:
+                result = await is_member(update, context, user_id)
+            self.set(chat_id, user_id, result)
+            return user_id if result else None
+
+        tasks = [asyncio.create_task(check(user_id)) for user_id in missing]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                member = await next_done
+                if member is not None:
+                    return member
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
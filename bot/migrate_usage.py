@@ -0,0 +1,64 @@
+"""
+Imports the JSON usage logs into the SQLite usage storage.
+The files are read one at a time and committed in batches, so any number of logs can be imported.
+
+Usage: python bot/migrate_usage.py [--logs-dir usage_logs] [--db usage.db] [--batch-size 500]
+"""
+import argparse
+import json
+import logging
+import pathlib
+
+from usage_storage import SQLiteUsageStorage, history_to_rows
+
+
+def migrate(logs_dir: str, db_path: str, batch_size: int = 500) -> int:
+    """
+    Imports all usage logs of a directory into the SQLite usage storage.
+    Users that are already stored are replaced, so the import can be run again.
+    :param logs_dir: path to directory of usage logs
+    :param db_path: path to the SQLite database file
+    :param batch_size: number of files to import per transaction
+    :return: the number of imported files
+    """
+    storage = SQLiteUsageStorage(db_path)
+    connection = storage.connection
+    imported = 0
+    try:
+        for user_file in sorted(pathlib.Path(logs_dir).glob('*.json')):
+            try:
+                with open(user_file, 'r') as file:
+                    usage = json.load(file)
+            except (OSError, ValueError) as e:
+                logging.warning(f'Skipping {user_file}: {str(e)}')
+                continue
+            user_id = user_file.stem
+            if imported % batch_size == 0:
+                connection.execute('BEGIN')
+            connection.execute('DELETE FROM usage_days WHERE user_id = ?', (user_id,))
+            storage.write_user(user_id, usage.get('user_name'), json.dumps(usage['current_cost']))
+            storage.add_days(user_id, history_to_rows(usage['usage_history']))
+            imported += 1
+            if imported % batch_size == 0:
+                connection.execute('COMMIT')
+                logging.info(f'Imported {imported} usage logs')
+        if connection.in_transaction:
+            connection.execute('COMMIT')
+    finally:
+        storage.close()
+    return imported
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Import the JSON usage logs into the SQLite usage storage.')
+    parser.add_argument('--logs-dir', default='usage_logs', help='path to directory of usage logs')
+    parser.add_argument('--db', default='usage.db', help='path to the SQLite database file')
+    parser.add_argument('--batch-size', type=int, default=500, help='number of files to import per transaction')
+    args = parser.parse_args()
+    imported = migrate(args.logs_dir, args.db, args.batch_size)
+    logging.info(f'Done. Imported {imported} usage logs into {args.db}')
+
+
+if __name__ == '__main__':
+    main()
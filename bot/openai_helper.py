@@ -1,5 +1,5 @@
 from __future__ import annotations
-import datetime
+import asyncio
 import logging
 import os
 
@@ -14,8 +14,11 @@ from PIL import Image
 
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
 
-from utils import is_direct_result, encode_image, decode_image
+from utils import is_direct_result, cleanup_intermediate_files, encode_image, decode_image
 from plugin_manager import PluginManager
+from conversation_store import ConversationStore, Conversation
+from conversation_backend import create_conversation_backend
+from summariser import Summariser
 
 # Models can be found here: https://platform.openai.com/docs/models/overview
 # Models gpt-3.5-turbo-0613 and  gpt-3.5-turbo-16k-0613 will be deprecated on June 13, 2024
@@ -107,9 +110,24 @@ class OpenAIHelper:
         self.client = openai.AsyncOpenAI(api_key=config['api_key'], http_client=http_client)
         self.config = config
         self.plugin_manager = plugin_manager
-        self.conversations: dict[int: list] = {}  # {chat_id: history}
-        self.conversations_vision: dict[int: bool] = {}  # {chat_id: is_vision}
-        self.last_updated: dict[int: datetime] = {}  # {chat_id: last_update_timestamp}
+        self.conversations = ConversationStore(
+            max_conversations=config.get('max_conversations', 0),
+            max_memory_mb=config.get('max_conversations_memory_mb', 0),
+            max_age_minutes=config['max_conversation_age_minutes'],
+            backend=create_conversation_backend(config)
+        )
+        try:
+            self.encoding = tiktoken.encoding_for_model(config['model'])
+        except KeyError:
+            self.encoding = tiktoken.get_encoding("o200k_base")
+        self.summariser = Summariser(
+            self.client,
+            model=config['summary_model'],
+            encoding=self.encoding,
+            max_input_tokens=config['summary_max_input_tokens'],
+            temperature=1 if config['summary_model'] in O_MODELS else 0.4
+        )
+        self.summary_tasks: dict[int, asyncio.Task] = {}
 
     def get_conversation_stats(self, chat_id: int) -> tuple[int, int]:
         """
@@ -117,9 +135,17 @@ class OpenAIHelper:
         :param chat_id: The chat ID
         :return: A tuple containing the number of messages and tokens used
         """
-        if chat_id not in self.conversations:
+        if self.conversations.get(chat_id) is None:
             self.reset_chat_history(chat_id)
-        return len(self.conversations[chat_id]), self.__count_tokens(self.conversations[chat_id])
+        return len(self.conversations[chat_id].messages), self.__count_conversation_tokens(chat_id)
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Counts the number of tokens of a text with the encoding of the model.
+        :param text: The text
+        :return: The number of tokens
+        """
+        return len(self.encoding.encode(text))
 
     async def get_chat_response(self, chat_id: int, query: str) -> tuple[str, str]:
         """
@@ -129,11 +155,12 @@ class OpenAIHelper:
         :return: The answer from the model and the number of tokens used
         """
         plugins_used = ()
+        tool_tokens = 0
         response = await self.__common_get_chat_response(chat_id, query)
-        if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
-            response, plugins_used = await self.__handle_function_call(chat_id, response)
+        if self.config['enable_functions'] and not self.__get_conversation(chat_id).is_vision:
+            response, plugins_used, tool_tokens = await self.__handle_function_call(chat_id, response)
             if is_direct_result(response):
-                return response, '0'
+                return response, str(tool_tokens)
 
         answer = ''
 
@@ -150,11 +177,12 @@ class OpenAIHelper:
             self.__add_to_history(chat_id, role="assistant", content=answer)
 
         bot_language = self.config['bot_language']
+        total_tokens = response.usage.total_tokens + tool_tokens
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
         if self.config['show_usage']:
             answer += "\n\n---\n" \
-                      f"💰 {str(response.usage.total_tokens)} {localized_text('stats_tokens', bot_language)}" \
+                      f"💰 {str(total_tokens)} {localized_text('stats_tokens', bot_language)}" \
                       f" ({str(response.usage.prompt_tokens)} {localized_text('prompt', bot_language)}," \
                       f" {str(response.usage.completion_tokens)} {localized_text('completion', bot_language)})"
             if show_plugins_used:
@@ -162,7 +190,7 @@ class OpenAIHelper:
         elif show_plugins_used:
             answer += f"\n\n---\n🔌 {', '.join(plugin_names)}"
 
-        return answer, response.usage.total_tokens
+        return answer, total_tokens
 
     async def get_chat_response_stream(self, chat_id: int, query: str):
         """
@@ -172,29 +200,40 @@ class OpenAIHelper:
         :return: The answer from the model and the number of tokens used, or 'not_finished'
         """
         plugins_used = ()
+        tool_tokens = 0
         response = await self.__common_get_chat_response(chat_id, query, stream=True)
-        if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
-            response, plugins_used = await self.__handle_function_call(chat_id, response, stream=True)
+        if self.config['enable_functions'] and not self.__get_conversation(chat_id).is_vision:
+            response, plugins_used, tool_tokens = await self.__handle_function_call(chat_id, response, stream=True)
             if is_direct_result(response):
-                yield response, '0'
+                yield response, str(tool_tokens)
                 return
 
         answer = ''
-        async for chunk in response:
-            if len(chunk.choices) == 0:
-                continue
-            delta = chunk.choices[0].delta
-            if delta.content:
-                answer += delta.content
-                yield answer, 'not_finished'
+        usage = None
+        try:
+            async for chunk in response:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if len(chunk.choices) == 0:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    answer += delta.content
+                    yield answer, 'not_finished'
+        finally:
+            # closes the upstream connection if the generation is cancelled before it completes
+            await response.close()
         answer = answer.strip()
         self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+        tokens_used = str(self.__get_stream_tokens_used(chat_id, usage) + tool_tokens)
 
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
         if self.config['show_usage']:
             answer += f"\n\n---\n💰 {tokens_used} {localized_text('stats_tokens', self.config['bot_language'])}"
+            if usage is not None:
+                answer += f" ({str(usage.prompt_tokens)} {localized_text('prompt', self.config['bot_language'])}," \
+                          f" {str(usage.completion_tokens)} {localized_text('completion', self.config['bot_language'])})"
             if show_plugins_used:
                 answer += f"\n🔌 {', '.join(plugin_names)}"
         elif show_plugins_used:
@@ -217,47 +256,34 @@ class OpenAIHelper:
         """
         bot_language = self.config['bot_language']
         try:
-            if chat_id not in self.conversations or self.__max_age_reached(chat_id):
+            if self.conversations.get(chat_id) is None or self.conversations.is_expired(chat_id):
                 self.reset_chat_history(chat_id)
 
-            self.last_updated[chat_id] = datetime.datetime.now()
-
+            self.conversations.touch(chat_id)
             self.__add_to_history(chat_id, role="user", content=query)
 
             # Summarize the chat history if it's too long to avoid excessive token usage
-            token_count = self.__count_tokens(self.conversations[chat_id])
-            exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
-            exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
-
-            if exceeded_max_tokens or exceeded_max_history_size:
-                logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
-                try:
-                    summary = await self.__summarise(self.conversations[chat_id][:-1])
-                    logging.debug(f'Summary: {summary}')
-                    self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    self.__add_to_history(chat_id, role="assistant", content=summary)
-                    self.__add_to_history(chat_id, role="user", content=query)
-                except Exception as e:
-                    logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
+            await self.__summarise_if_needed(chat_id)
 
+            conversation = self.conversations[chat_id]
             max_tokens_str = 'max_completion_tokens' if self.config['model'] in O_MODELS else 'max_tokens'
             common_args = {
-                'model': self.config['model'] if not self.conversations_vision[chat_id] else self.config['vision_model'],
-                'messages': self.conversations[chat_id],
+                'model': self.config['model'] if not conversation.is_vision else self.config['vision_model'],
+                'messages': self.__get_request_messages(chat_id),
                 'temperature': self.config['temperature'],
                 'n': self.config['n_choices'],
                 max_tokens_str: self.config['max_tokens'],
                 'presence_penalty': self.config['presence_penalty'],
                 'frequency_penalty': self.config['frequency_penalty'],
-                'stream': stream
+                'stream': stream,
+                **self.__get_stream_options(stream)
             }
 
-            if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
-                functions = self.plugin_manager.get_functions_specs()
-                if len(functions) > 0:
-                    common_args['functions'] = self.plugin_manager.get_functions_specs()
-                    common_args['function_call'] = 'auto'
+            if self.config['enable_functions'] and not conversation.is_vision:
+                tools = self.plugin_manager.get_tools_specs()
+                if len(tools) > 0:
+                    common_args['tools'] = tools
+                    common_args['tool_choice'] = 'auto'
             return await self.client.chat.completions.create(**common_args)
 
         except openai.RateLimitError as e:
@@ -269,58 +295,113 @@ class OpenAIHelper:
         except Exception as e:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
-    async def __handle_function_call(self, chat_id, response, stream=False, times=0, plugins_used=()):
-        function_name = ''
-        arguments = ''
+    async def __handle_function_call(self, chat_id, response, stream=False, times=0, plugins_used=(), tokens_used=0):
+        """
+        Runs the tool calls of the model's response, if any, and requests the follow-up response.
+        All tool calls of a response run concurrently, and their results are sent back in a single request.
+        :param chat_id: The chat ID
+        :param response: The response of the model, or the stream of it
+        :param stream: Whether the response is streamed
+        :param times: The number of tool call rounds so far
+        :param plugins_used: The names of the functions called so far
+        :param tokens_used: The number of tokens used by the tool call rounds so far
+        :return: The final response of the model, or a direct result, the names of the functions called
+                 and the number of tokens used by the tool call rounds, which the final response doesn't include
+        """
+        tool_calls = {}  # {index: {'id': ..., 'name': ..., 'arguments': ...}}
+        usage = None
         if stream:
+            finished = False
             async for item in response:
+                if item.usage is not None:
+                    usage = item.usage
+                if finished:
+                    # the usage of the round is reported in the last chunk, after the finish reason
+                    continue
                 if len(item.choices) > 0:
                     first_choice = item.choices[0]
-                    if first_choice.delta and first_choice.delta.function_call:
-                        if first_choice.delta.function_call.name:
-                            function_name += first_choice.delta.function_call.name
-                        if first_choice.delta.function_call.arguments:
-                            arguments += first_choice.delta.function_call.arguments
-                    elif first_choice.finish_reason and first_choice.finish_reason == 'function_call':
-                        break
+                    if first_choice.delta and first_choice.delta.tool_calls:
+                        for tool_call in first_choice.delta.tool_calls:
+                            call = tool_calls.setdefault(tool_call.index, {'id': '', 'name': '', 'arguments': ''})
+                            if tool_call.id:
+                                call['id'] += tool_call.id
+                            if tool_call.function and tool_call.function.name:
+                                call['name'] += tool_call.function.name
+                            if tool_call.function and tool_call.function.arguments:
+                                call['arguments'] += tool_call.function.arguments
+                    elif first_choice.finish_reason and first_choice.finish_reason == 'tool_calls':
+                        finished = True
                     else:
-                        return response, plugins_used
+                        return response, plugins_used, tokens_used
                 else:
-                    return response, plugins_used
+                    return response, plugins_used, tokens_used
         else:
             if len(response.choices) > 0:
                 first_choice = response.choices[0]
-                if first_choice.message.function_call:
-                    if first_choice.message.function_call.name:
-                        function_name += first_choice.message.function_call.name
-                    if first_choice.message.function_call.arguments:
-                        arguments += first_choice.message.function_call.arguments
+                if first_choice.message.tool_calls:
+                    for index, tool_call in enumerate(first_choice.message.tool_calls):
+                        tool_calls[index] = {'id': tool_call.id, 'name': tool_call.function.name,
+                                             'arguments': tool_call.function.arguments}
                 else:
-                    return response, plugins_used
+                    return response, plugins_used, tokens_used
             else:
-                return response, plugins_used
-
-        logging.info(f'Calling function {function_name} with arguments {arguments}')
-        function_response = await self.plugin_manager.call_function(function_name, self, arguments)
-
-        if function_name not in plugins_used:
-            plugins_used += (function_name,)
-
-        if is_direct_result(function_response):
-            self.__add_function_call_to_history(chat_id=chat_id, function_name=function_name,
-                                                content=json.dumps({'result': 'Done, the content has been sent'
-                                                                              'to the user.'}))
-            return function_response, plugins_used
+                return response, plugins_used, tokens_used
+            usage = response.usage
+
+        calls = [tool_calls[index] for index in sorted(tool_calls)]
+        for call in calls:
+            logging.info(f'Calling function {call["name"]} with arguments {call["arguments"]}')
+        results = await asyncio.gather(
+            *[self.plugin_manager.call_function(call['name'], self, call['arguments']) for call in calls],
+            return_exceptions=True
+        )
+        # a failed call is reported to the model as its result, so the other calls of the round are kept
+        for index, (call, result) in enumerate(zip(calls, results)):
+            if isinstance(result, BaseException) and not isinstance(result, Exception):
+                for other in results:
+                    if not isinstance(other, BaseException) and is_direct_result(other):
+                        cleanup_intermediate_files(other)
+                raise result
+            if isinstance(result, Exception):
+                logging.error(f'Function {call["name"]} failed', exc_info=result)
+                results[index] = json.dumps({'error': f'{type(result).__name__}: {result}'})
+
+        for call in calls:
+            if call['name'] not in plugins_used:
+                plugins_used += (call['name'],)
+
+        self.__append_message(chat_id, {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [{"id": call['id'], "type": "function",
+                            "function": {"name": call['name'], "arguments": call['arguments']}} for call in calls]
+        })
+        # without reported usage, the round is counted from the conversation including the tool calls
+        tokens_used += usage.total_tokens if usage is not None else self.__count_conversation_tokens(chat_id)
+        direct_result = None
+        for call, function_response in zip(calls, results):
+            if is_direct_result(function_response):
+                # only one direct result can be sent to the user, the files of the others are removed
+                if direct_result is None:
+                    direct_result = function_response
+                    function_response = json.dumps({'result': 'Done, the content has been sent to the user.'})
+                else:
+                    cleanup_intermediate_files(function_response)
+                    function_response = json.dumps({'result': 'The content was not sent, only one content '
+                                                              'can be sent to the user at a time.'})
+            self.__add_tool_result_to_history(chat_id=chat_id, tool_call_id=call['id'], content=function_response)
+        if direct_result is not None:
+            return direct_result, plugins_used, tokens_used
 
-        self.__add_function_call_to_history(chat_id=chat_id, function_name=function_name, content=function_response)
         response = await self.client.chat.completions.create(
             model=self.config['model'],
-            messages=self.conversations[chat_id],
-            functions=self.plugin_manager.get_functions_specs(),
-            function_call='auto' if times < self.config['functions_max_consecutive_calls'] else 'none',
-            stream=stream
+            messages=self.__get_request_messages(chat_id),
+            tools=self.plugin_manager.get_tools_specs(),
+            tool_choice='auto' if times < self.config['functions_max_consecutive_calls'] else 'none',
+            stream=stream,
+            **self.__get_stream_options(stream)
         )
-        return await self.__handle_function_call(chat_id, response, stream, times + 1, plugins_used)
+        return await self.__handle_function_call(chat_id, response, stream, times + 1, plugins_used, tokens_used)
 
     async def generate_image(self, prompt: str) -> tuple[str, str]:
         """
@@ -391,23 +472,30 @@ class OpenAIHelper:
         wait=wait_fixed(20),
         stop=stop_after_attempt(3)
     )
-    async def __common_get_chat_response_vision(self, chat_id: int, content: list, stream=False):
+    async def __common_get_chat_response_vision(self, chat_id: int, content: list, fileobj, stream=False):
         """
         Request a response from the GPT model.
         :param chat_id: The chat ID
         :param query: The query to send to the model
+        :param fileobj: The image file in the content
         :return: The answer from the model and the number of tokens used
         """
         bot_language = self.config['bot_language']
         try:
-            if chat_id not in self.conversations or self.__max_age_reached(chat_id):
+            if self.conversations.get(chat_id) is None or self.conversations.is_expired(chat_id):
                 self.reset_chat_history(chat_id)
 
-            self.last_updated[chat_id] = datetime.datetime.now()
+            self.conversations.touch(chat_id)
+            conversation = self.conversations[chat_id]
 
             if self.config['enable_vision_follow_up_questions']:
-                self.conversations_vision[chat_id] = True
-                self.__add_to_history(chat_id, role="user", content=content)
+                conversation.is_vision = True
+                message = {"role": "user", "content": content}
+                # the image stays in the history, so its cost is computed once from the image header
+                with Image.open(fileobj) as image:
+                    image_tokens = self.__count_tokens_vision(*image.size)
+                self.__append_message(chat_id, message,
+                                      tokens=self.__count_message_tokens(message, image_tokens=image_tokens))
             else:
                 for message in content:
                     if message['type'] == 'text':
@@ -416,35 +504,20 @@ class OpenAIHelper:
                 self.__add_to_history(chat_id, role="user", content=query)
 
             # Summarize the chat history if it's too long to avoid excessive token usage
-            token_count = self.__count_tokens(self.conversations[chat_id])
-            exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
-            exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
-
-            if exceeded_max_tokens or exceeded_max_history_size:
-                logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
-                try:
-                    
-                    last = self.conversations[chat_id][-1]
-                    summary = await self.__summarise(self.conversations[chat_id][:-1])
-                    logging.debug(f'Summary: {summary}')
-                    self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    self.__add_to_history(chat_id, role="assistant", content=summary)
-                    self.conversations[chat_id] += [last]
-                except Exception as e:
-                    logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
+            await self.__summarise_if_needed(chat_id)
 
             message = {'role':'user', 'content':content}
 
             common_args = {
                 'model': self.config['vision_model'],
-                'messages': self.conversations[chat_id][:-1] + [message],
+                'messages': self.__get_request_messages(chat_id)[:-1] + [message],
                 'temperature': self.config['temperature'],
                 'n': 1, # several choices is not implemented yet
                 'max_tokens': self.config['vision_max_tokens'],
                 'presence_penalty': self.config['presence_penalty'],
                 'frequency_penalty': self.config['frequency_penalty'],
-                'stream': stream
+                'stream': stream,
+                **self.__get_stream_options(stream)
             }
 
 
@@ -478,7 +551,7 @@ class OpenAIHelper:
         content = [{'type':'text', 'text':prompt}, {'type':'image_url', \
                     'image_url': {'url':image, 'detail':self.config['vision_detail'] } }]
 
-        response = await self.__common_get_chat_response_vision(chat_id, content)
+        response = await self.__common_get_chat_response_vision(chat_id, content, fileobj)
 
         
 
@@ -529,7 +602,7 @@ class OpenAIHelper:
         content = [{'type':'text', 'text':prompt}, {'type':'image_url', \
                     'image_url': {'url':image, 'detail':self.config['vision_detail'] } }]
 
-        response = await self.__common_get_chat_response_vision(chat_id, content, stream=True)
+        response = await self.__common_get_chat_response_vision(chat_id, content, fileobj, stream=True)
 
         
 
@@ -540,21 +613,31 @@ class OpenAIHelper:
         #         return
 
         answer = ''
-        async for chunk in response:
-            if len(chunk.choices) == 0:
-                continue
-            delta = chunk.choices[0].delta
-            if delta.content:
-                answer += delta.content
-                yield answer, 'not_finished'
+        usage = None
+        try:
+            async for chunk in response:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if len(chunk.choices) == 0:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    answer += delta.content
+                    yield answer, 'not_finished'
+        finally:
+            # closes the upstream connection if the generation is cancelled before it completes
+            await response.close()
         answer = answer.strip()
         self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+        tokens_used = str(self.__get_stream_tokens_used(chat_id, usage))
 
         #show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         #plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
         if self.config['show_usage']:
             answer += f"\n\n---\n💰 {tokens_used} {localized_text('stats_tokens', self.config['bot_language'])}"
+            if usage is not None:
+                answer += f" ({str(usage.prompt_tokens)} {localized_text('prompt', self.config['bot_language'])}," \
+                          f" {str(usage.completion_tokens)} {localized_text('completion', self.config['bot_language'])})"
         #     if show_plugins_used:
         #         answer += f"\n🔌 {', '.join(plugin_names)}"
         # elif show_plugins_used:
@@ -568,27 +651,37 @@ class OpenAIHelper:
         """
         if content == '':
             content = self.config['assistant_prompt']
-        self.conversations[chat_id] = [{"role": "assistant" if self.config['model'] in O_MODELS else "system", "content": content}]
-        self.conversations_vision[chat_id] = False
+        self.__cancel_summary(chat_id)
+        self.conversations.reset(chat_id)
+        self.__add_to_history(chat_id, role="assistant" if self.config['model'] in O_MODELS else "system",
+                              content=content)
+
+    def sweep_conversations(self) -> int:
+        """
+        Removes all conversations that reached the maximum age, and the background summaries
+        of all conversations that are no longer kept in memory, e.g. because they were evicted.
+        :return: The number of removed conversations
+        """
+        removed = self.conversations.sweep()
+        for chat_id in [chat_id for chat_id in self.summary_tasks if chat_id not in self.conversations]:
+            self.__cancel_summary(chat_id)
+        return removed
 
-    def __max_age_reached(self, chat_id) -> bool:
+    def __get_conversation(self, chat_id) -> Conversation:
         """
-        Checks if the maximum conversation age has been reached.
+        Returns the conversation of the given chat, starting a new one if there is none.
         :param chat_id: The chat ID
-        :return: A boolean indicating whether the maximum conversation age has been reached
+        :return: The conversation
         """
-        if chat_id not in self.last_updated:
-            return False
-        last_updated = self.last_updated[chat_id]
-        now = datetime.datetime.now()
-        max_age_minutes = self.config['max_conversation_age_minutes']
-        return last_updated < now - datetime.timedelta(minutes=max_age_minutes)
+        if self.conversations.get(chat_id) is None:
+            self.reset_chat_history(chat_id)
+        return self.conversations[chat_id]
 
-    def __add_function_call_to_history(self, chat_id, function_name, content):
+    def __add_tool_result_to_history(self, chat_id, tool_call_id, content):
         """
-        Adds a function call to the conversation history
+        Adds the result of a tool call to the conversation history
         """
-        self.conversations[chat_id].append({"role": "function", "name": function_name, "content": content})
+        self.__append_message(chat_id, {"role": "tool", "tool_call_id": tool_call_id, "content": content})
 
     def __add_to_history(self, chat_id, role, content):
         """
@@ -597,24 +690,162 @@ class OpenAIHelper:
         :param role: The role of the message sender
         :param content: The message content
         """
-        self.conversations[chat_id].append({"role": role, "content": content})
+        self.__append_message(chat_id, {"role": role, "content": content})
 
-    async def __summarise(self, conversation) -> str:
+    def __append_message(self, chat_id, message: dict, tokens: int = None):
         """
-        Summarises the conversation history.
-        :param conversation: The conversation history
-        :return: The summary
+        Appends a message to the conversation history and keeps the running token count up to date.
+        :param chat_id: The chat ID
+        :param message: The message to append
+        :param tokens: The number of tokens of the message, counted if not given
         """
-        messages = [
-            {"role": "assistant", "content": "Summarize this conversation in 700 characters or less"},
-            {"role": "user", "content": str(conversation)}
-        ]
-        response = await self.client.chat.completions.create(
-            model=self.config['model'],
-            messages=messages,
-            temperature=1 if self.config['model'] in O_MODELS else 0.4
+        if tokens is None:
+            tokens = self.__count_message_tokens(message)
+        self.__get_conversation(chat_id)
+        self.conversations.append(chat_id, message, tokens)
+
+    def __exceeds_history_limits(self, chat_id, fraction: float = 1.0) -> bool:
+        """
+        Checks if the conversation history exceeds the given fraction of the token or history size limits.
+        :param chat_id: The chat ID
+        :param fraction: The fraction of the limits to check against
+        :return: Boolean indicating if the limits are exceeded
+        """
+        token_count = self.__count_conversation_tokens(chat_id)
+        exceeded_max_tokens = token_count + self.config['max_tokens'] > fraction * self.__max_model_tokens()
+        exceeded_max_history_size = len(self.conversations[chat_id].messages) > \
+            fraction * self.config['max_history_size']
+        return exceeded_max_tokens or exceeded_max_history_size
+
+    async def __summarise_if_needed(self, chat_id):
+        """
+        Keeps the conversation history within the token and history size limits.
+        A summary is prepared in the background once the history reaches the summarise threshold,
+        and swapped in before a later turn. The history is only summarised while the user waits
+        if it exceeds the limits before a background summary is ready.
+        :param chat_id: The chat ID
+        """
+        self.__apply_summary(chat_id)
+        if not self.__exceeds_history_limits(chat_id):
+            if chat_id not in self.summary_tasks and \
+                    self.__exceeds_history_limits(chat_id, self.config['summarise_threshold']):
+                self.__start_summary(chat_id)
+            return
+
+        if chat_id in self.summary_tasks:
+            await asyncio.wait([self.summary_tasks[chat_id]])
+            if self.__apply_summary(chat_id) and not self.__exceeds_history_limits(chat_id):
+                return
+
+        logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
+        self.__cancel_summary(chat_id)
+        conversation = self.conversations[chat_id]
+        try:
+            # each pass folds the oldest messages that fit into the summarisation input
+            while len(conversation.messages) > 2 and self.__exceeds_history_limits(chat_id):
+                summary, count = await self.summariser.summarise(conversation.summary, conversation.messages[1:-1])
+                logging.debug(f'Summary: {summary}')
+                self.__replace_with_summary(chat_id, count + 1, summary)
+        except Exception as e:
+            logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
+            size = self.config['max_history_size']
+            # the system prompt is kept, and tool results are not kept without the tool calls they answer
+            while 1 < size < len(conversation.messages) and conversation.messages[1 - size]['role'] == 'tool':
+                size -= 1
+            self.conversations.truncate(chat_id, size)
+
+    def __start_summary(self, chat_id):
+        """
+        Starts folding the conversation history of the given chat into its summary in the background,
+        leaving out the system prompt and the latest message which is still to be answered.
+        :param chat_id: The chat ID
+        """
+        conversation = self.conversations[chat_id]
+        messages = conversation.messages[:-1]
+        summary = conversation.summary
+        if len(messages) < 2:
+            return
+
+        async def summarise():
+            new_summary, count = await self.summariser.summarise(summary, messages[1:])
+            return messages[:count + 1], summary, new_summary
+
+        logging.info(f'Chat history for chat ID {chat_id} is getting long. Summarising in the background...')
+        self.summary_tasks[chat_id] = asyncio.create_task(summarise())
+
+    def __apply_summary(self, chat_id) -> bool:
+        """
+        Swaps in the background summary of the given chat, if it is ready.
+        The summary is discarded if the summarised messages are no longer part of the history.
+        :param chat_id: The chat ID
+        :return: Boolean indicating if the summary was applied
+        """
+        task = self.summary_tasks.get(chat_id)
+        if task is None or not task.done():
+            return False
+        del self.summary_tasks[chat_id]
+        if task.cancelled():
+            return False
+        if task.exception() is not None:
+            logging.warning(f'Error while summarising chat history in the background: {str(task.exception())}')
+            return False
+
+        summarised, old_summary, summary = task.result()
+        conversation = self.conversations[chat_id]
+        if conversation.summary != old_summary or len(conversation.messages) < len(summarised) or \
+                any(message is not old for message, old in zip(conversation.messages, summarised)):
+            return False
+        logging.debug(f'Summary: {summary}')
+        self.__replace_with_summary(chat_id, len(summarised), summary)
+        return True
+
+    def __cancel_summary(self, chat_id):
+        """
+        Cancels the background summary of the given chat, if any.
+        :param chat_id: The chat ID
+        """
+        task = self.summary_tasks.pop(chat_id, None)
+        if task is not None:
+            task.cancel()
+
+    def __replace_with_summary(self, chat_id, count: int, summary: str):
+        """
+        Replaces the summary of the given chat and drops the first `count` messages of the history,
+        except for the system prompt, which are now part of the summary.
+        :param chat_id: The chat ID
+        :param count: The number of summarised messages, including the system prompt
+        :param summary: The new summary
+        """
+        conversation = self.conversations[chat_id]
+        self.conversations.replace(
+            chat_id,
+            messages=conversation.messages[:1] + conversation.messages[count:],
+            tokens=conversation.tokens[:1] + conversation.tokens[count:],
+            summary=summary,
+            summary_tokens=self.__count_message_tokens(self.__get_summary_message(summary))
         )
-        return response.choices[0].message.content
+
+    def __get_summary_message(self, summary: str) -> dict:
+        """
+        Returns the message that passes the summary of the earlier conversation to the model.
+        :param summary: The summary
+        :return: The summary message
+        """
+        return {"role": "assistant" if self.config['model'] in O_MODELS else "system",
+                "content": f"Summary of the earlier conversation: {summary}"}
+
+    def __get_request_messages(self, chat_id) -> list[dict]:
+        """
+        Returns the messages to send to the model for the given chat,
+        with the summary of the earlier conversation after the system prompt.
+        :param chat_id: The chat ID
+        :return: The messages
+        """
+        conversation = self.__get_conversation(chat_id)
+        if not conversation.summary:
+            return conversation.messages
+        return conversation.messages[:1] + [self.__get_summary_message(conversation.summary)] + \
+            conversation.messages[1:]
 
     def __max_model_tokens(self):
         base = 4096
@@ -644,60 +875,93 @@ class OpenAIHelper:
             f"Max tokens for model {self.config['model']} is not implemented yet."
         )
 
-    # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-    def __count_tokens(self, messages) -> int:
+    def __get_stream_options(self, stream: bool) -> dict:
+        """
+        Returns the request arguments asking the provider to report usage in the last chunk of a stream.
+        :param stream: Whether the response is streamed
+        :return: the additional request arguments
         """
-        Counts the number of tokens required to send the given messages.
-        :param messages: the messages to send
+        if not stream or not self.config['stream_usage']:
+            return {}
+        return {'stream_options': {'include_usage': True}}
+
+    def __get_stream_tokens_used(self, chat_id, usage) -> int:
+        """
+        Returns the number of tokens used by a streamed response, as reported by the provider.
+        Falls back to counting the tokens of the conversation for endpoints that don't report usage.
+        :param chat_id: The chat ID
+        :param usage: The usage reported in the last chunk of the stream, if any
+        :return: the number of tokens used
+        """
+        if usage is None:
+            return self.__count_conversation_tokens(chat_id)
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = getattr(details, 'cached_tokens', None) or 0
+        logging.debug(f'Chat ID {chat_id} used {usage.prompt_tokens} prompt tokens ({cached_tokens} cached) '
+                      f'and {usage.completion_tokens} completion tokens')
+        return usage.total_tokens
+
+    def __count_conversation_tokens(self, chat_id) -> int:
+        """
+        Returns the number of tokens required to send the conversation history of the given chat.
+        :param chat_id: The chat ID
         :return: the number of tokens required
         """
-        model = self.config['model']
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            encoding = tiktoken.get_encoding("o200k_base")
+        conversation = self.conversations[chat_id]
+        # every reply is primed with <|start|>assistant<|message|>
+        return conversation.total_tokens + conversation.summary_tokens + 3
 
+    # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    def __count_message_tokens(self, message: dict, image_tokens: int = None) -> int:
+        """
+        Counts the number of tokens of a single message.
+        :param message: the message
+        :param image_tokens: the number of tokens of the images in the message, if already known
+        :return: the number of tokens of the message
+        """
+        model = self.config['model']
         if model in GPT_ALL_MODELS:
             tokens_per_message = 3
             tokens_per_name = 1
         else:
             raise NotImplementedError(f"""num_tokens_from_messages() is not implemented for model {model}.""")
-        num_tokens = 0
-        for message in messages:
-            num_tokens += tokens_per_message
-            for key, value in message.items():
-                if key == 'content':
-                    if isinstance(value, str):
-                        num_tokens += len(encoding.encode(value))
-                    else:
-                        for message1 in value:
-                            if message1['type'] == 'image_url':
-                                image = decode_image(message1['image_url']['url'])
-                                num_tokens += self.__count_tokens_vision(image)
-                            else:
-                                num_tokens += len(encoding.encode(message1['text']))
+        num_tokens = tokens_per_message
+        for key, value in message.items():
+            if key == 'content':
+                if value is None:
+                    continue
+                if isinstance(value, str):
+                    num_tokens += len(self.encoding.encode(value))
                 else:
-                    num_tokens += len(encoding.encode(value))
-                    if key == "name":
-                        num_tokens += tokens_per_name
-        num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+                    for message1 in value:
+                        if message1['type'] == 'image_url':
+                            if image_tokens is None:
+                                image = Image.open(io.BytesIO(decode_image(message1['image_url']['url'])))
+                                num_tokens += self.__count_tokens_vision(*image.size)
+                        else:
+                            num_tokens += len(self.encoding.encode(message1['text']))
+            elif key == 'tool_calls':
+                num_tokens += len(self.encoding.encode(json.dumps(value)))
+            else:
+                num_tokens += len(self.encoding.encode(value))
+                if key == "name":
+                    num_tokens += tokens_per_name
+        if image_tokens is not None:
+            num_tokens += image_tokens
         return num_tokens
 
-    # no longer needed
-
-    def __count_tokens_vision(self, image_bytes: bytes) -> int:
+    def __count_tokens_vision(self, width: int, height: int) -> int:
         """
         Counts the number of tokens for interpreting an image.
-        :param image_bytes: image to interpret
+        :param width: width of the image to interpret
+        :param height: height of the image to interpret
         :return: the number of tokens required
         """
-        image_file = io.BytesIO(image_bytes)
-        image = Image.open(image_file)
         model = self.config['vision_model']
         if model not in GPT_4_VISION_MODELS:
             raise NotImplementedError(f"""count_tokens_vision() is not implemented for model {model}.""")
-        
-        w, h = image.size
+
+        w, h = width, height
         if w > h: w, h = h, w
         # this computation follows https://platform.openai.com/docs/guides/vision and https://openai.com/pricing#gpt-4-turbo
         base_tokens = 85
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from collections import OrderedDict
+
+
+def cache_key(function_name: str, arguments: dict) -> str:
+    """
+    Builds the cache key of a function call from the function name and the normalized arguments:
+    keys are sorted and surrounding whitespace of string values is removed.
+    """
+    normalized = {key: value.strip() if isinstance(value, str) else value for key, value in arguments.items()}
+    return f'{function_name}:{json.dumps(normalized, sort_keys=True, default=str)}'
+
+
+class PluginResultCache:
+    """
+    A size-bounded LRU cache of function results with a time to live per entry.
+    Concurrent calls with the same key share a single call (single-flight),
+    so a burst of identical calls reaches the upstream API once.
+    """
+
+    def __init__(self, max_size: int = 256):
+        """
+        Initializes the cache.
+        :param max_size: The maximum number of cached results, 0 to disable the cache
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()  # {key: (result, expiry time)}
+        self.in_flight = {}  # {key: {'task': task of the running call, 'waiters': number of callers}}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get_or_call(self, key: str, ttl: float, call, is_cacheable):
+        """
+        Get the cached result of a call, or make the call and cache its result.
+        :param key: The cache key, see `cache_key`
+        :param ttl: Number of seconds to cache the result for, 0 to not cache it
+        :param call: Coroutine function making the call
+        :param is_cacheable: Function telling if a result may be cached, e.g. False for errors
+        :return: The result
+        """
+        if ttl <= 0 or self.max_size <= 0:
+            return await call()
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[1] >= time.monotonic():
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return entry[0]
+            del self.entries[key]
+
+        flight = self.in_flight.get(key)
+        if flight is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            # the call runs in its own task, so a cancelled caller doesn't cancel it for the other callers
+            flight = self.in_flight[key] = {'waiters': 0}
+            flight['task'] = asyncio.create_task(self.__call(key, flight, ttl, call, is_cacheable))
+        flight['waiters'] += 1
+        try:
+            return await asyncio.shield(flight['task'])
+        finally:
+            flight['waiters'] -= 1
+            if flight['waiters'] == 0 and not flight['task'].done():
+                # nobody is waiting for the result anymore
+                flight['task'].cancel()
+                self.__end_flight(key, flight)
+
+    async def __call(self, key: str, flight: dict, ttl: float, call, is_cacheable):
+        """
+        Makes the shared call of a key and caches its result.
+        """
+        try:
+            result = await call()
+            if is_cacheable(result):
+                self.entries[key] = (result, time.monotonic() + ttl)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+            return result
+        finally:
+            self.__end_flight(key, flight)
+
+    def __end_flight(self, key: str, flight: dict):
+        """
+        Forgets the shared call of a key, unless a newer call of the key already took its place.
+        """
+        if self.in_flight.get(key) is flight:
+            del self.in_flight[key]
+
+    def get_stats(self) -> dict:
+        """
+        Get the statistics of the cache.
+        :return: dictionary with the number of entries, hits, misses, coalesced calls and the hit rate
+        """
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0
+        }
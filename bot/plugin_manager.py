@@ -1,4 +1,8 @@
+import asyncio
 import json
+import logging
+import math
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 
 from plugins.gtts_text_to_speech import GTTSTextToSpeech
 from plugins.auto_tts import AutoTextToSpeech
@@ -15,6 +19,81 @@ from plugins.worldtimeapi import WorldTimeApiPlugin
 from plugins.whois_ import WhoisPlugin
 from plugins.webshot import WebshotPlugin
 from plugins.iplocation import IpLocationPlugin
+from plugins.http_client import PluginHttpClient
+from plugins.plugin import Plugin
+from plugin_cache import PluginResultCache, cache_key
+from circuit_breaker import CircuitBreaker
+
+# plugins wrapping blocking libraries, which run in the thread pool unless configured otherwise
+BLOCKING_PLUGINS = ('wolfram', 'spotify', 'ddg_image_search', 'youtube_audio_extractor', 'gtts_text_to_speech',
+                    'whois')
+EXECUTOR_KINDS = ('inline', 'thread', 'process')
+
+# plugins created in a worker process, by class
+worker_plugins = {}
+
+
+def run_plugin(plugin: Plugin, function_name, helper, kwargs):
+    """
+    Runs the execute coroutine of a plugin to completion in a worker thread, on its own event loop.
+    Only plugins that don't need the main event loop can run there, see `Plugin.needs_event_loop`.
+    """
+    return asyncio.run(plugin.execute(function_name, helper, **kwargs))
+
+
+def run_plugin_in_process(plugin_class, function_name, kwargs):
+    """
+    Runs a plugin in a worker process. The plugin is created once per process, from the inherited environment,
+    and it gets no helper and no HTTP client, so only plugins that don't need the event loop can run there.
+    """
+    if plugin_class not in worker_plugins:
+        worker_plugins[plugin_class] = plugin_class()
+    return run_plugin(worker_plugins[plugin_class], function_name, None, kwargs)
+
+
+def is_cacheable_result(result) -> bool:
+    """
+    Checks if a plugin result may be cached. Direct results are sent to the user as files,
+    which are removed afterwards, and errors should be retried.
+    """
+    if not isinstance(result, dict):
+        return True
+    return 'direct_result' not in result and not is_error_result(result)
+
+
+def is_error_result(result) -> bool:
+    """
+    Checks if a plugin result reports an error
+    """
+    return isinstance(result, dict) and any(key.lower() == 'error' for key in result)
+
+
+def parse_plugin_executors(value: str) -> dict:
+    """
+    Parses the executors of the plugins, e.g. 'whois:process,wolfram:thread:2,spotify:inline'.
+    :param value: comma separated entries of plugin name, executor kind and optional concurrency limit
+    :return: dictionary of plugin name to (executor kind, concurrency limit or None)
+    """
+    executors = {}
+    for entry in filter(None, (entry.strip() for entry in value.split(','))):
+        name, kind, *limit = entry.split(':')
+        if kind not in EXECUTOR_KINDS:
+            raise ValueError(f'Unknown executor {kind} for plugin {name}, expected one of {EXECUTOR_KINDS}')
+        executors[name] = (kind, int(limit[0]) if limit else None)
+    return executors
+
+
+def parse_plugin_timeouts(value: str) -> dict:
+    """
+    Parses the timeouts of the plugins, e.g. 'ddg_web_search:45,webshot:60'.
+    :param value: comma separated entries of plugin name and timeout in seconds
+    :return: dictionary of plugin name to timeout
+    """
+    timeouts = {}
+    for entry in filter(None, (entry.strip() for entry in value.split(','))):
+        name, timeout = entry.split(':')
+        timeouts[name] = float(timeout)
+    return timeouts
 
 
 class PluginManager:
@@ -41,7 +120,49 @@ class PluginManager:
             'webshot': WebshotPlugin,
             'iplocation': IpLocationPlugin,
         }
-        self.plugins = [plugin_mapping[plugin]() for plugin in enabled_plugins if plugin in plugin_mapping]
+        self.plugin_names = {}
+        for name in enabled_plugins:
+            if name in plugin_mapping:
+                self.plugin_names[plugin_mapping[name]()] = name
+        self.plugins = list(self.plugin_names)
+        self.http = PluginHttpClient(
+            timeout=config.get('http_timeout', 15),
+            max_connections=config.get('http_max_connections', 100),
+            max_connections_per_host=config.get('http_max_connections_per_host', 10)
+        )
+        for plugin in self.plugins:
+            plugin.http = self.http
+
+        # where each plugin runs: on the event loop, in the thread pool or in the process pool
+        configured_executors = parse_plugin_executors(config.get('plugin_executors', ''))
+        default_limit = config.get('plugin_max_concurrency', 4)
+        configured_timeouts = parse_plugin_timeouts(config.get('plugin_timeouts', ''))
+        self.executor_kinds = {}
+        self.limits = {}
+        self.semaphores = {}
+        self.queue_depths = {}
+        self.running = {}
+        self.timeouts = {}
+        self.breakers = {}
+        for plugin, name in self.plugin_names.items():
+            kind, limit = configured_executors.get(name, ('thread' if name in BLOCKING_PLUGINS else 'inline', None))
+            if kind != 'inline' and plugin.needs_event_loop:
+                raise ValueError(f'Plugin {name} uses the shared HTTP client or the helper '
+                                 f'and can only run inline, not in the {kind} pool')
+            self.executor_kinds[name] = kind
+            self.limits[name] = limit or default_limit
+            self.semaphores[name] = asyncio.Semaphore(self.limits[name])
+            self.queue_depths[name] = 0
+            self.running[name] = 0
+            self.timeouts[name] = configured_timeouts.get(name, config.get('plugin_timeout', 30))
+            self.breakers[name] = CircuitBreaker(
+                threshold=config.get('plugin_breaker_threshold', 5),
+                cooldown=config.get('plugin_breaker_cooldown', 60)
+            )
+        self.thread_workers = config.get('plugin_thread_workers', 8)
+        self.process_workers = config.get('plugin_process_workers', 2)
+        self.executors: dict[str, Executor] = {}
+        self.cache = PluginResultCache(config.get('plugin_cache_size', 256))
 
     def get_functions_specs(self):
         """
@@ -49,6 +170,12 @@ class PluginManager:
         """
         return [spec for specs in map(lambda plugin: plugin.get_spec(), self.plugins) for spec in specs]
 
+    def get_tools_specs(self):
+        """
+        Return the list of tool specs of the functions that can be called by the model, for the tools API
+        """
+        return [{'type': 'function', 'function': spec} for spec in self.get_functions_specs()]
+
     async def call_function(self, function_name, helper, arguments):
         """
         Call a function based on the name and parameters provided
@@ -56,7 +183,37 @@ class PluginManager:
         plugin = self.__get_plugin_by_function_name(function_name)
         if not plugin:
             return json.dumps({'error': f'Function {function_name} not found'})
-        return json.dumps(await plugin.execute(function_name, helper, **json.loads(arguments)), default=str)
+        kwargs = json.loads(arguments)
+
+        async def call():
+            return await self.__call_guarded(plugin, function_name, helper, kwargs)
+
+        result = await self.cache.get_or_call(cache_key(function_name, kwargs), plugin.get_cache_ttl(function_name),
+                                              call, is_cacheable_result)
+        return json.dumps(result, default=str)
+
+    def get_queue_depths(self) -> dict:
+        """
+        Return the number of calls of each plugin waiting for their turn because of the plugin's concurrency limit
+        """
+        return dict(self.queue_depths)
+
+    def get_status(self) -> list[dict]:
+        """
+        Return the executor, circuit breaker state and load of every plugin
+        """
+        return [{
+            'name': name,
+            'executor': self.executor_kinds[name],
+            'state': self.breakers[name].state,
+            'failures': self.breakers[name].failures,
+            'rejected': self.breakers[name].rejected,
+            'retry_after': self.breakers[name].get_retry_after(),
+            'running': self.running[name],
+            'limit': self.limits[name],
+            'waiting': self.queue_depths[name],
+            'timeout': self.timeouts[name],
+        } for name in self.plugin_names.values()]
 
     def get_plugin_source_name(self, function_name) -> str:
         """
@@ -67,6 +224,96 @@ class PluginManager:
             return ''
         return plugin.get_source_name()
 
+    async def close(self):
+        """
+        Closes the connections of the shared HTTP client and shuts the worker pools down
+        """
+        await self.http.close()
+        for executor in self.executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def __call_guarded(self, plugin: Plugin, function_name, helper, kwargs):
+        """
+        Executes a plugin function within the plugin's deadline, unless the circuit breaker of the plugin is open.
+        Timeouts, exceptions and error results count as failures of the plugin, see `Plugin.execute`.
+        """
+        name = self.plugin_names[plugin]
+        breaker = self.breakers[name]
+        if not breaker.allow():
+            logging.warning(f'Circuit breaker of plugin {name} is {breaker.state}, not calling {function_name}')
+            return {'error': f'The {plugin.get_source_name()} service is temporarily unavailable, '
+                             f'try again in {math.ceil(breaker.get_retry_after())} seconds'}
+        try:
+            result = await asyncio.wait_for(self.__execute(plugin, function_name, helper, kwargs), self.timeouts[name])
+        except asyncio.TimeoutError:
+            breaker.record_failure()
+            logging.warning(f'Function {function_name} of plugin {name} timed out after {self.timeouts[name]} seconds')
+            return {'error': f'The {plugin.get_source_name()} service did not respond in time'}
+        except asyncio.CancelledError:
+            breaker.abandon()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+        if is_error_result(result):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return result
+
+    async def __execute(self, plugin: Plugin, function_name, helper, kwargs):
+        """
+        Executes a plugin function in the executor of the plugin, within the plugin's concurrency limit
+        """
+        name = self.plugin_names[plugin]
+        kind = self.executor_kinds[name]
+        self.queue_depths[name] += 1
+        try:
+            await self.semaphores[name].acquire()
+        finally:
+            self.queue_depths[name] -= 1
+        self.running[name] += 1
+
+        if kind == 'inline':
+            try:
+                return await plugin.execute(function_name, helper, **kwargs)
+            finally:
+                self.__release(name)
+
+        loop = asyncio.get_running_loop()
+        try:
+            if kind == 'process':
+                future = self.__get_executor(kind).submit(run_plugin_in_process, type(plugin), function_name, kwargs)
+            else:
+                future = self.__get_executor(kind).submit(run_plugin, plugin, function_name, helper, kwargs)
+        except Exception:
+            self.__release(name)
+            raise
+        # a worker can't be stopped, so the plugin's slot is only released when the worker is done,
+        # even if the call timed out before
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self.__release, name))
+        return await asyncio.wrap_future(future)
+
+    def __release(self, name):
+        """
+        Releases a slot of the plugin's concurrency limit
+        """
+        self.running[name] -= 1
+        self.semaphores[name].release()
+
+    def __get_executor(self, kind) -> Executor:
+        """
+        Return the worker pool of the given kind, creating it on first use
+        """
+        if kind not in self.executors:
+            if kind == 'process':
+                self.executors[kind] = ProcessPoolExecutor(max_workers=self.process_workers)
+            else:
+                self.executors[kind] = ThreadPoolExecutor(max_workers=self.thread_workers,
+                                                          thread_name_prefix='plugin')
+            logging.info(f'Started the plugin {kind} pool')
+        return self.executors[kind]
+
     def __get_plugin_by_function_name(self, function_name):
         return next((plugin for plugin in self.plugins
                     if function_name in map(lambda spec: spec.get('name'), plugin.get_spec())), None)
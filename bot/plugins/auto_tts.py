@@ -9,6 +9,7 @@ class AutoTextToSpeech(Plugin):
     """
     A plugin to convert text to speech using Openai Speech API
     """
+    needs_event_loop = True
 
     def get_source_name(self) -> str:
         return "TTS"
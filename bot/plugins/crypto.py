@@ -1,4 +1,3 @@
-import requests
 from typing import Dict, Any
 import datetime
 
@@ -11,6 +10,7 @@ class CryptoPlugin(Plugin):
     It first searches by the user's query, then gets detailed info.
     Finally, it returns a nicely formatted string with emojis.
     """
+    needs_event_loop = True
 
     def get_source_name(self) -> str:
         return "Coingecko (detailed)"
@@ -38,6 +38,10 @@ class CryptoPlugin(Plugin):
             },
         }]
 
+    def get_cache_ttl(self, function_name) -> float:
+        # prices change quickly, but Coingecko's rate limits are low
+        return 60
+
     async def execute(self, function_name, helper, **kwargs) -> Dict[str, Any]:
         """
         1) Поиск монеты по /search (чтобы находить и новые, малоизвестные монеты).
@@ -54,14 +58,14 @@ class CryptoPlugin(Plugin):
         user_query = kwargs["asset"].strip()
         if not user_query:
             return {
-                "error": "Empty asset query",
+                "result": "Empty asset query",
                 "formatted_answer": "❓ Пожалуйста, введите название или символ монеты."
             }
 
         # --- Шаг 1: поиск по /search ---
         search_url = "https://api.coingecko.com/api/v3/search"
         try:
-            search_resp = requests.get(search_url, params={"query": user_query}, timeout=10)
+            search_resp = await self.http.get(search_url, params={"query": user_query}, timeout=10)
             search_data = search_resp.json()
         except Exception as e:
             return {
@@ -72,7 +76,7 @@ class CryptoPlugin(Plugin):
         coins_found = search_data.get("coins", [])
         if not coins_found:
             return {
-                "error": f"No coin found for '{user_query}'",
+                "result": f"No coin found for '{user_query}'",
                 "formatted_answer": (
                     f"❌ Не нашёл монету по запросу '{user_query}'. "
                     "Попробуйте ввести официальное название или символ (на англ.), например: BTC, bitcoin."
@@ -90,7 +94,7 @@ class CryptoPlugin(Plugin):
             "&sparkline=false"
                     )
         try:
-            resp = requests.get(details_url, timeout=10)
+            resp = await self.http.get(details_url, timeout=10)
             coin_data = resp.json()
         except Exception as e:
             return {
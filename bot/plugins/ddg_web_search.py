@@ -1,12 +1,14 @@
+import asyncio
 import os
 import re
-import requests
 from itertools import islice
 from typing import Dict, Any, List, Union
 
+import httpx
 from duckduckgo_search import DDGS
 from bs4 import BeautifulSoup
 
+from .http_client import PluginHttpClient
 from .plugin import Plugin
 
 # ------------------- Константы настройки -------------------
@@ -38,15 +40,15 @@ def detect_timelimit(query: str) -> Union[str, None]:
         return 'm'
     return None
 
-def fetch_page_text(url: str) -> str:
+async def fetch_page_text(http: PluginHttpClient, url: str) -> str:
     """
     Скачиваем HTML (с timeout=10) и берём текст <body>, обрезаем до MAX_PAGE_CHARS.
     Возвращаем чистый текст.
     """
     try:
-        resp = requests.get(url, timeout=10, headers={"User-Agent": "Mozilla/5.0"})
+        resp = await http.get(url, timeout=10, headers={"User-Agent": "Mozilla/5.0"})
         resp.raise_for_status()
-    except requests.RequestException:
+    except httpx.HTTPError:
         return ""
 
     soup = BeautifulSoup(resp.text, "html.parser")
@@ -116,6 +118,7 @@ class DDGWebSearchPlugin(Plugin):
     2) Скачивает каждую ссылку, парсит <body>, режет на чанки, суммирует
     3) Возвращает подробную сводку (и форматированный список ссылок)
     """
+    needs_event_loop = True
 
     def __init__(self):
         self.safesearch = os.getenv('DUCKDUCKGO_SAFESEARCH', 'moderate')
@@ -142,6 +145,9 @@ class DDGWebSearchPlugin(Plugin):
             },
         }]
 
+    def get_cache_ttl(self, function_name) -> float:
+        return 15 * 60
+
     async def execute(self, function_name, helper, **kwargs) -> Dict[str, Union[str, List[Dict[str, str]]]]:
         query = kwargs.get("query", "").strip()
         if not query:
@@ -153,8 +159,8 @@ class DDGWebSearchPlugin(Plugin):
         region = detect_region_auto(query)
         timelimit = detect_timelimit(query)
 
-        # Шаг 1: Поиск через duckduckgo_search
-        try:
+        # Шаг 1: Поиск через duckduckgo_search (блокирующая библиотека, поэтому в отдельном потоке)
+        def search():
             with DDGS() as ddgs:
                 ddgs_gen = ddgs.text(
                     keywords=query,
@@ -162,15 +168,15 @@ class DDGWebSearchPlugin(Plugin):
                     safesearch=self.safesearch,
                     timelimit=timelimit
                 )
-                raw_results = list(islice(ddgs_gen, MAX_RESULTS))  # берём до 3 ссылок
-        except requests.RequestException as e:
-            return {
-                "Result": [],
-                "formatted_answer": f"Ошибка сети или DuckDuckGo: {e}"
-            }
+                return list(islice(ddgs_gen, MAX_RESULTS))  # берём до 3 ссылок
+
+        try:
+            raw_results = await asyncio.to_thread(search)
         except Exception as e:
+            # ключ error: результат не кэшируется и считается сбоем сервиса
             return {
                 "Result": [],
+                "error": str(e),
                 "formatted_answer": f"Ошибка во время поиска: {e}"
             }
 
@@ -189,13 +195,15 @@ class DDGWebSearchPlugin(Plugin):
                 seen_links.add(link)
                 final_links.append(r)
 
-        # Шаг 2: Скачиваем и суммируем
+        # Шаг 2: Скачиваем страницы параллельно и суммируем
+        page_texts = await asyncio.gather(
+            *[fetch_page_text(self.http, item.get("href", "")) for item in final_links]
+        )
         final_data = []
-        for item in final_links:
+        for item, page_text in zip(final_links, page_texts):
             title = item.get("title", "No Title")
             url = item.get("href", "")
 
-            page_text = fetch_page_text(url)
             summary = summarize_whole_page(page_text)
 
             final_data.append({
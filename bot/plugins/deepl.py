@@ -1,8 +1,6 @@
 import os
 from typing import Dict
 
-import requests
-
 from .plugin import Plugin
 
 
@@ -10,6 +8,8 @@ class DeeplTranslatePlugin(Plugin):
     """
     A plugin to translate a given text from a language to another, using DeepL
     """
+    needs_event_loop = True
+
     def __init__(self):
         deepl_api_key = os.getenv('DEEPL_API_KEY')
         if not deepl_api_key:
@@ -33,6 +33,9 @@ class DeeplTranslatePlugin(Plugin):
             },
         }]
 
+    def get_cache_ttl(self, function_name) -> float:
+        return 24 * 60 * 60
+
     async def execute(self, function_name, helper, **kwargs) -> Dict:
         if self.api_key.endswith(':fx'):
             url = "https://api-free.deepl.com/v2/translate"
@@ -49,5 +52,6 @@ class DeeplTranslatePlugin(Plugin):
             "text": kwargs['text'],
             "target_lang": kwargs['to_language']
         }
-        translated_text = requests.post(url, headers=headers, data=data).json()["translations"][0]["text"]
+        response = await self.http.post(url, headers=headers, data=data)
+        translated_text = response.json()["translations"][0]["text"]
         return translated_text.encode('unicode-escape').decode('unicode-escape')
\ No newline at end of file
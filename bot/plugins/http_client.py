@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import asyncio
+from urllib.parse import urlsplit
+
+import httpx
+
+
+class PluginHttpClient:
+    """
+    An async HTTP client shared by all plugins. Connections are pooled and kept alive across requests,
+    every request has a default timeout, and the number of concurrent requests to a single host is limited,
+    so one slow API doesn't use up the whole pool.
+    """
+
+    def __init__(self, timeout: float = 15, max_connections: int = 100, max_connections_per_host: int = 10):
+        """
+        Initializes the client.
+        :param timeout: The default timeout of a request in seconds
+        :param max_connections: The maximum number of open connections
+        :param max_connections_per_host: The maximum number of concurrent requests to a single host
+        """
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            follow_redirects=True
+        )
+        self.max_connections_per_host = max(max_connections_per_host, 1)
+        self.host_semaphores = {}
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        Sends a request, waiting while too many requests to the same host are running.
+        :param method: The HTTP method
+        :param url: The URL
+        :param kwargs: The arguments of `httpx.AsyncClient.request`, e.g. params, headers, data or timeout
+        :return: The response, with its content read
+        """
+        host = urlsplit(url).hostname or ''
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(self.max_connections_per_host)
+        async with self.host_semaphores[host]:
+            return await self.client.request(method, url, **kwargs)
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        """
+        Sends a GET request, see `request`.
+        """
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        """
+        Sends a POST request, see `request`.
+        """
+        return await self.request('POST', url, **kwargs)
+
+    async def close(self):
+        """
+        Closes all connections.
+        """
+        await self.client.aclose()
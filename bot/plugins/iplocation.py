@@ -1,4 +1,3 @@
-import requests
 from typing import Dict
 
 from .plugin import Plugin
@@ -8,6 +7,7 @@ class IpLocationPlugin(Plugin):
     """
     A plugin to get geolocation and other information for a given IP address
     """
+    needs_event_loop = True
 
     def get_source_name(self) -> str:
         return "IP.FM"
@@ -25,12 +25,15 @@ class IpLocationPlugin(Plugin):
             },
         }]
         
+    def get_cache_ttl(self, function_name) -> float:
+        return 24 * 60 * 60
+
     async def execute(self, function_name, helper, **kwargs) -> Dict:
         ip = kwargs.get('ip')
         BASE_URL = "https://api.ip.fm/?ip={}"
         url = BASE_URL.format(ip)
         try:
-            response = requests.get(url)
+            response = await self.http.get(url)
             response_data = response.json()
             country = response_data.get('data', {}).get('country', "None")
             subdivisions = response_data.get('data', {}).get('subdivisions', "None")
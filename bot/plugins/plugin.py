@@ -1,11 +1,18 @@
 from abc import abstractmethod, ABC
 from typing import Dict
 
+from .http_client import PluginHttpClient
+
 
 class Plugin(ABC):
     """
     A plugin interface which can be used to create plugins for the ChatGPT API.
+    Plugins make their HTTP requests with the shared async client in `self.http`, set by the plugin manager.
+    Plugins using `self.http` or the helper must set `needs_event_loop`, as both are bound to the main event loop
+    and can't be used from a worker thread or process.
     """
+    http: PluginHttpClient
+    needs_event_loop: bool = False
 
     @abstractmethod
     def get_source_name(self) -> str:
@@ -22,9 +29,20 @@ class Plugin(ABC):
         """
         pass
 
+    def get_cache_ttl(self, function_name) -> float:
+        """
+        Return the number of seconds the results of the given function may be cached for, 0 to not cache them.
+        Results are cached by function name and arguments, so only functions whose result depends on nothing else
+        should be cached.
+        """
+        return 0
+
     @abstractmethod
     async def execute(self, function_name, helper, **kwargs) -> Dict:
         """
-        Execute the plugin and return a JSON serializable response
+        Execute the plugin and return a JSON serializable response.
+        A response with an `error` key reports a failure of the plugin's service: it is not cached and it counts
+        towards the plugin's circuit breaker. Problems with the request itself, e.g. nothing found,
+        should be reported as a regular response.
         """
         pass
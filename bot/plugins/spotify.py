@@ -259,7 +259,7 @@ class SpotifyPlugin(Plugin):
             return {'result': self._get_album(search_response)}
 
         else:
-            return {'error': 'Invalid search type. Must be track, artist or album'}
+            return {'result': 'Invalid search type. Must be track, artist or album'}
 
     @staticmethod
     def _get_artist(response, albums):
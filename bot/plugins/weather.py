@@ -1,8 +1,6 @@
 from datetime import datetime
 from typing import Dict
 
-import requests
-
 from .plugin import Plugin
 
 
@@ -10,6 +8,7 @@ class WeatherPlugin(Plugin):
     """
     A plugin to get the current weather and 7-day daily forecast for a location
     """
+    needs_event_loop = True
 
     def get_source_name(self) -> str:
         return "OpenMeteo"
@@ -57,6 +56,9 @@ class WeatherPlugin(Plugin):
             }
         ]
 
+    def get_cache_ttl(self, function_name) -> float:
+        return 600 if function_name == 'get_current_weather' else 1800
+
     async def execute(self, function_name, helper, **kwargs) -> Dict:
         url = 'https://api.open-meteo.com/v1/forecast' \
               f'?latitude={kwargs["latitude"]}' \
@@ -64,13 +66,13 @@ class WeatherPlugin(Plugin):
               f'&temperature_unit={kwargs["unit"]}'
         if function_name == 'get_current_weather':
             url += '&current_weather=true'
-            return requests.get(url).json()
+            return (await self.http.get(url)).json()
 
         elif function_name == 'get_forecast_weather':
             url += '&daily=weathercode,temperature_2m_max,temperature_2m_min,precipitation_probability_mean,'
             url += f'&forecast_days={kwargs["forecast_days"]}'
             url += '&timezone=auto'
-            response = requests.get(url).json()
+            response = (await self.http.get(url)).json()
             results = {}
             for i, time in enumerate(response["daily"]["time"]):
                 results[datetime.strptime(time, "%Y-%m-%d").strftime("%A, %B %d, %Y")] = {
@@ -1,4 +1,4 @@
-import os, requests, random, string
+import os, random, string
 from typing import Dict
 from .plugin import Plugin
 
@@ -6,6 +6,7 @@ class WebshotPlugin(Plugin):
     """
     A plugin to screenshot a website
     """
+    needs_event_loop = True
     def get_source_name(self) -> str:
         return "WebShot"
 
@@ -31,10 +32,10 @@ class WebshotPlugin(Plugin):
             image_url = f'https://image.thum.io/get/maxAge/12/width/720/{kwargs["url"]}'
             
             # preload url first
-            requests.get(image_url)
+            await self.http.get(image_url)
 
             # download the actual image
-            response = requests.get(image_url, timeout=30)
+            response = await self.http.get(image_url, timeout=30)
 
             if response.status_code == 200:
                 if not os.path.exists("uploads/webshot"):
@@ -24,6 +24,9 @@ class WhoisPlugin(Plugin):
             },
         }]
 
+    def get_cache_ttl(self, function_name) -> float:
+        return 24 * 60 * 60
+
     async def execute(self, function_name, helper, **kwargs) -> Dict:
         try:
             whois_result = whois.query(kwargs['domain'])
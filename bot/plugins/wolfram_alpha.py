@@ -32,6 +32,9 @@ class WolframAlphaPlugin(Plugin):
             }
         }]
 
+    def get_cache_ttl(self, function_name) -> float:
+        return 60 * 60
+
     async def execute(self, function_name, helper, **kwargs) -> Dict:
         client = wolframalpha.Client(self.app_id)
         res = client.query(kwargs['query'])
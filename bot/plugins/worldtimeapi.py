@@ -1,4 +1,4 @@
-import os, requests
+import os
 from typing import Dict
 from datetime import datetime
 
@@ -9,6 +9,7 @@ class WorldTimeApiPlugin(Plugin):
     """
     A plugin to get the current time from a given timezone, using WorldTimeAPI
     """
+    needs_event_loop = True
     def __init__(self):
         default_timezone = os.getenv('WORLDTIME_DEFAULT_TIMEZONE')
         if not default_timezone:
@@ -40,7 +41,7 @@ class WorldTimeApiPlugin(Plugin):
         url = f'https://worldtimeapi.org/api/timezone/{timezone}'
 
         try:
-            wtr = requests.get(url).json().get('datetime')
+            wtr = (await self.http.get(url)).json().get('datetime')
             wtr_obj = datetime.strptime(wtr, "%Y-%m-%dT%H:%M:%S.%f%z")
             time_24hr = wtr_obj.strftime("%H:%M:%S")
             time_12hr = wtr_obj.strftime("%I:%M:%S %p")
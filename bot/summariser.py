@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import openai
+import tiktoken
+
+FUNCTION_DIGEST_LENGTH = 300
+
+
+def digest(text: str, length: int) -> str:
+    """
+    Collapses the whitespace of a text and shortens it to the given number of characters.
+    """
+    text = ' '.join(text.split())
+    return text if len(text) <= length else text[:length] + '…'
+
+
+def render_message(message: dict, tool_names: dict = None) -> str:
+    """
+    Renders a message as a single compact line of the summarisation input.
+    Images are replaced with a placeholder, as their description follows in the assistant's answer,
+    and function results are reduced to a short digest.
+    :param message: The message to render
+    :param tool_names: The names of the called functions by tool call ID, to name the tool results
+    """
+    content = message.get('content') or ''
+    if message.get('tool_calls'):
+        calls = ', '.join(f"{call['function']['name']}({call['function']['arguments']})"
+                          for call in message['tool_calls'])
+        return f"{message['role'].capitalize()} called {digest(calls, FUNCTION_DIGEST_LENGTH)}"
+    if isinstance(content, list):
+        parts = []
+        for part in content:
+            if part.get('type') == 'image_url':
+                parts.append('[image]')
+            elif part.get('type') == 'text':
+                parts.append(part['text'])
+        content = ' '.join(parts)
+    if message['role'] in ('function', 'tool'):
+        name = message.get('name') or (tool_names or {}).get(message.get('tool_call_id'), 'function')
+        return f"Result of {name}: {digest(content, FUNCTION_DIGEST_LENGTH)}"
+    return f"{message['role'].capitalize()}: {content}"
+
+
+class Summariser:
+    """
+    Keeps a rolling summary of a conversation.
+    Only the messages added since the last summary are folded into it, oldest first and as many as fit
+    into the input budget, so the cost of a summary stays bounded however long the chat lives.
+    """
+
+    def __init__(self, client: openai.AsyncOpenAI, model: str, encoding: tiktoken.Encoding,
+                 max_input_tokens: int = 3000, temperature: float = 0.4):
+        """
+        Initializes the summariser.
+        :param client: The OpenAI client
+        :param model: The model used to write the summaries
+        :param encoding: The encoding used to count the tokens of the summarisation input
+        :param max_input_tokens: Maximum number of tokens of the summarisation input
+        :param temperature: The sampling temperature used to write the summaries
+        """
+        self.client = client
+        self.model = model
+        self.encoding = encoding
+        self.max_input_tokens = max_input_tokens
+        self.temperature = temperature
+
+    async def summarise(self, summary: str, messages: list[dict]) -> tuple[str, int]:
+        """
+        Folds the oldest of the given messages that fit into the input budget into the summary.
+        :param summary: The current summary, empty if there is none yet
+        :param messages: The messages added since the current summary was written
+        :return: The updated summary and the number of messages folded into it
+        """
+        if summary:
+            instructions = 'Update the summary of the earlier conversation with the new messages. ' \
+                           'Keep it at 700 characters or less'
+            budget = self.max_input_tokens - len(self.encoding.encode(summary))
+            rendered, count = self.build_input(messages, budget)
+            content = f'Summary of the earlier conversation:\n{summary}\n\nNew messages:\n{rendered}'
+        else:
+            instructions = 'Summarize this conversation in 700 characters or less'
+            content, count = self.build_input(messages, self.max_input_tokens)
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "assistant", "content": instructions},
+                {"role": "user", "content": content}
+            ],
+            temperature=self.temperature
+        )
+        return response.choices[0].message.content, count
+
+    def build_input(self, messages: list[dict], max_tokens: int) -> tuple[str, int]:
+        """
+        Renders the oldest messages that fit into the token budget as compact lines.
+        The messages that don't fit are left out, to be folded into the summary by a later pass.
+        :param messages: The messages to render
+        :param max_tokens: The token budget
+        :return: The rendered messages and the number of messages rendered
+        """
+        # tool results only carry the ID of their call, the name is in the assistant message that made it
+        tool_names = {call['id']: call['function']['name']
+                      for message in messages for call in message.get('tool_calls') or []}
+        lines = []
+        remaining = max(max_tokens, 0)
+        for message in messages:
+            line = render_message(message, tool_names)
+            tokens = self.encoding.encode(line)
+            if len(lines) > 0 and message['role'] == 'tool':
+                # a tool round is never split, so the history left doesn't start with results without their calls.
+                # The results are short digests, so they may exceed the budget a little
+                lines.append(line)
+                remaining = max(remaining - len(tokens), 0)
+                continue
+            if len(tokens) > remaining:
+                if len(lines) == 0 and remaining > 0:
+                    # always make progress, with the beginning of the oldest message
+                    lines.append(self.encoding.decode(tokens[:remaining]) + '…')
+                    remaining = 0
+                    continue
+                break
+            lines.append(line)
+            remaining -= len(tokens)
+        return '\n'.join(lines), len(lines)
@@ -11,7 +11,7 @@ from telegram import InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResu
 from telegram import InputTextMessageContent, BotCommand
 from telegram.error import RetryAfter, TimedOut, BadRequest
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, \
-    filters, InlineQueryHandler, CallbackQueryHandler, Application, ContextTypes, CallbackContext
+    filters, InlineQueryHandler, CallbackQueryHandler, Application, ContextTypes, CallbackContext, ChatMemberHandler
 
 from pydub import AudioSegment
 from PIL import Image
@@ -19,9 +19,14 @@ from PIL import Image
 from utils import is_group_chat, get_thread_id, message_text, wrap_with_indicator, split_into_chunks, \
     edit_message_with_retry, get_stream_cutoff_values, is_allowed, get_remaining_budget, is_admin, is_within_budget, \
     get_reply_to_message_id, add_chat_request_to_usage_tracker, error_handler, is_direct_result, handle_direct_result, \
-    cleanup_intermediate_files
+    cleanup_intermediate_files, is_guest, is_addressed_to_bot
 from openai_helper import OpenAIHelper, localized_text
-from usage_tracker import UsageTracker
+from usage_tracker import UsageRegistry
+from access_policy import get_access_policy
+from membership_cache import MembershipCache
+from usage_analytics import metric_prices
+from usage_storage import create_usage_storage
+from chat_queue import ChatQueue, ChatQueueFull
 
 
 class ChatGPTTelegramBot:
@@ -37,6 +42,8 @@ class ChatGPTTelegramBot:
         """
         self.config = config
         self.openai = openai
+        # compile the access policy once at startup
+        get_access_policy(config)
         bot_language = self.config['bot_language']
         self.commands = [
             BotCommand(command='help', description=localized_text('help_description', bot_language)),
@@ -56,9 +63,23 @@ class ChatGPTTelegramBot:
         )] + self.commands
         self.disallowed_message = localized_text('disallowed', bot_language)
         self.budget_limit_message = localized_text('budget_limit', bot_language)
-        self.usage = {}
+        self.membership = MembershipCache(
+            ttl=config['membership_cache_ttl'],
+            max_concurrency=config['membership_check_concurrency']
+        )
+        self.usage = UsageRegistry(
+            create_usage_storage(config),
+            keep_days=config['usage_compaction_days'],
+            keep_months=config['usage_compaction_months'],
+            enable_index=config['enable_usage_report'],
+            max_trackers=config['usage_cache_size']
+        )
         self.last_message = {}
         self.inline_queries_cache = {}
+        self.chat_queue = ChatQueue(max_depth=self.config.get('max_queued_requests', 0))
+        self.usage_index_task = None
+        self.housekeeping_task = None
+        self.usage_flush_task = None
 
     async def help(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
         """
@@ -82,7 +103,7 @@ class ChatGPTTelegramBot:
         """
         Returns token usage statistics for current day and month.
         """
-        if not await is_allowed(self.config, update, context):
+        if not await is_allowed(self.config, update, context, membership=self.membership):
             logging.warning(f'User {update.message.from_user.name} (id: {update.message.from_user.id}) '
                             'is not allowed to request their usage statistics')
             await self.send_disallowed_message(update, context)
@@ -92,8 +113,7 @@ class ChatGPTTelegramBot:
                      'requested their usage statistics')
 
         user_id = update.message.from_user.id
-        if user_id not in self.usage:
-            self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+        self.usage.get_tracker(user_id, update.message.from_user.name)
 
         tokens_today, tokens_month = self.usage[user_id].get_current_token_usage()
         images_today, images_month = self.usage[user_id].get_current_image_count()
@@ -184,11 +204,91 @@ class ChatGPTTelegramBot:
         usage_text = text_current_conversation + text_today + text_month + text_budget
         await update.message.reply_text(usage_text, parse_mode=constants.ParseMode.MARKDOWN)
 
+    async def report(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Sends the usage report of all users to an admin, along with a CSV export.
+        """
+        user_id = update.message.from_user.id
+        if not is_admin(self.config, user_id):
+            logging.warning(f'User {update.message.from_user.name} (id: {user_id}) '
+                            'is not allowed to request the usage report')
+            await self.send_disallowed_message(update, context)
+            return
+
+        bot_language = self.config['bot_language']
+        if not self.config['enable_usage_report']:
+            await update.message.reply_text(localized_text('report_unavailable', bot_language))
+            return
+        if self.usage.index is None:
+            await update.message.reply_text(localized_text('report_loading', bot_language))
+            return
+
+        logging.info(f'Admin {update.message.from_user.name} (id: {user_id}) requested the usage report')
+        report = self.usage.index.report(metric_prices(self.config), self.config['allowed_user_ids'])
+        spend = localized_text('report_spend', bot_language)
+        text = (
+            f"{localized_text('report_title', bot_language)}\n"
+            f"💰 {spend[0]}: ${report.total_cost:.2f} ({spend[1]}: ${report.allowed_users_cost:.2f}, "
+            f"{spend[2]}: ${report.guest_cost:.2f})\n"
+            "----------------------------\n"
+            f"{localized_text('report_top_users', bot_language)}:\n"
+        )
+        for index, (top_user_id, user_name, cost) in enumerate(report.top_users):
+            text += f"{index + 1}. {user_name} ({top_user_id}): ${cost:.2f}\n"
+        text += f"----------------------------\n{localized_text('report_daily', bot_language)}:\n"
+        for day, cost in report.daily_costs:
+            text += f"{day}: ${cost:.2f}\n"
+        text += f"----------------------------\n{localized_text('report_metrics', bot_language)}:\n"
+        for metric, amount, cost in report.metrics:
+            text += f"{metric}: {amount:g} (${cost:.2f})\n"
+
+        await update.message.reply_text(text)
+        await update.message.reply_document(
+            document=io.BytesIO(report.to_csv().encode('utf-8')),
+            filename='usage_report.csv'
+        )
+
+    async def plugins(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Sends the circuit breaker state and load of every plugin to an admin.
+        """
+        user_id = update.message.from_user.id
+        if not is_admin(self.config, user_id):
+            logging.warning(f'User {update.message.from_user.name} (id: {user_id}) '
+                            'is not allowed to request the plugin status')
+            await self.send_disallowed_message(update, context)
+            return
+
+        bot_language = self.config['bot_language']
+        plugin_manager = self.openai.plugin_manager
+        status = plugin_manager.get_status()
+        if len(status) == 0:
+            await update.message.reply_text(localized_text('plugins_none', bot_language))
+            return
+
+        text = f"{localized_text('plugins_title', bot_language)}:\n"
+        for plugin in status:
+            state = plugin['state']
+            if state != 'closed':
+                state += f" ({plugin['retry_after']:.0f}s, {plugin['rejected']} rejected)"
+            text += (
+                f"{plugin['name']} [{plugin['executor']}, {plugin['timeout']:g}s]: {state}, "
+                f"{plugin['failures']} failures, {plugin['running']}/{plugin['limit']} running, "
+                f"{plugin['waiting']} waiting\n"
+            )
+        cache = plugin_manager.cache.get_stats()
+        text += (
+            f"----------------------------\n{localized_text('plugins_cache', bot_language)}: "
+            f"{cache['hit_rate']:.0%} ({cache['hits']} hits, {cache['coalesced']} coalesced, "
+            f"{cache['misses']} misses, {cache['entries']} entries)"
+        )
+        await update.message.reply_text(text)
+
     async def resend(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Resend the last request
         """
-        if not await is_allowed(self.config, update, context):
+        if not await is_allowed(self.config, update, context, membership=self.membership):
             logging.warning(f'User {update.message.from_user.name}  (id: {update.message.from_user.id})'
                             ' is not allowed to resend the message')
             await self.send_disallowed_message(update, context)
@@ -216,7 +316,7 @@ class ChatGPTTelegramBot:
         """
         Resets the conversation.
         """
-        if not await is_allowed(self.config, update, context):
+        if not await is_allowed(self.config, update, context, membership=self.membership):
             logging.warning(f'User {update.message.from_user.name} (id: {update.message.from_user.id}) '
                             'is not allowed to reset the conversation')
             await self.send_disallowed_message(update, context)
@@ -227,6 +327,8 @@ class ChatGPTTelegramBot:
 
         chat_id = update.effective_chat.id
         reset_content = message_text(update.message)
+        if self.chat_queue.cancel(chat_id):
+            logging.info(f'Cancelled the running request in chat {chat_id}')
         self.openai.reset_chat_history(chat_id=chat_id, content=reset_content)
         await update.effective_message.reply_text(
             message_thread_id=get_thread_id(update),
@@ -271,8 +373,8 @@ class ChatGPTTelegramBot:
                 user_id = update.message.from_user.id
                 self.usage[user_id].add_image_request(image_size, self.config['image_prices'])
                 # add guest chat request to guest usage tracker
-                if str(user_id) not in self.config['allowed_user_ids'].split(',') and 'guests' in self.usage:
-                    self.usage["guests"].add_image_request(image_size, self.config['image_prices'])
+                if is_guest(self.config, user_id) and 'guests' in self.usage:
+                    self.usage.guests.add_image_request(image_size, self.config['image_prices'])
 
             except Exception as e:
                 logging.exception(e)
@@ -317,8 +419,8 @@ class ChatGPTTelegramBot:
                 user_id = update.message.from_user.id
                 self.usage[user_id].add_tts_request(text_length, self.config['tts_model'], self.config['tts_prices'])
                 # add guest chat request to guest usage tracker
-                if str(user_id) not in self.config['allowed_user_ids'].split(',') and 'guests' in self.usage:
-                    self.usage["guests"].add_tts_request(text_length, self.config['tts_model'], self.config['tts_prices'])
+                if is_guest(self.config, user_id) and 'guests' in self.usage:
+                    self.usage.guests.add_tts_request(text_length, self.config['tts_model'], self.config['tts_prices'])
 
             except Exception as e:
                 logging.exception(e)
@@ -335,13 +437,17 @@ class ChatGPTTelegramBot:
         """
         Transcribe audio messages.
         """
-        if not self.config['enable_transcription'] or not await self.check_allowed_and_within_budget(update, context):
+        if not self.config['enable_transcription']:
             return
 
+        # filter out group chat messages before the more expensive authorization
         if is_group_chat(update) and self.config['ignore_group_transcriptions']:
             logging.info('Transcription coming from group chat, ignoring...')
             return
 
+        if not await self.check_allowed_and_within_budget(update, context):
+            return
+
         chat_id = update.effective_chat.id
         filename = update.message.effective_attachment.file_unique_id
 
@@ -382,8 +488,7 @@ class ChatGPTTelegramBot:
                 return
 
             user_id = update.message.from_user.id
-            if user_id not in self.usage:
-                self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+            self.usage.get_tracker(user_id, update.message.from_user.name)
 
             try:
                 transcript = await self.openai.transcribe(filename_mp3)
@@ -391,9 +496,8 @@ class ChatGPTTelegramBot:
                 transcription_price = self.config['transcription_price']
                 self.usage[user_id].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
 
-                allowed_user_ids = self.config['allowed_user_ids'].split(',')
-                if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
-                    self.usage["guests"].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
+                if is_guest(self.config, user_id) and 'guests' in self.usage:
+                    self.usage.guests.add_transcription_seconds(audio_track.duration_seconds, transcription_price)
 
                 # check if transcript starts with any of the prefixes
                 response_to_transcription = any(transcript.lower().startswith(prefix.lower()) if prefix else False
@@ -417,8 +521,8 @@ class ChatGPTTelegramBot:
                     response, total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=transcript)
 
                     self.usage[user_id].add_chat_tokens(total_tokens, self.config['token_price'])
-                    if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
-                        self.usage["guests"].add_chat_tokens(total_tokens, self.config['token_price'])
+                    if is_guest(self.config, user_id) and 'guests' in self.usage:
+                        self.usage.guests.add_chat_tokens(total_tokens, self.config['token_price'])
 
                     # Split into chunks of 4096 characters (Telegram's message limit)
                     transcript_output = (
@@ -449,18 +553,26 @@ class ChatGPTTelegramBot:
                 if os.path.exists(filename):
                     os.remove(filename)
 
-        await wrap_with_indicator(update, context, _execute, constants.ChatAction.TYPING)
+        if not await self.enter_chat_queue(update, chat_id, update.message.from_user.id):
+            return
+        try:
+            await wrap_with_indicator(update, context, _execute, constants.ChatAction.TYPING)
+        except asyncio.CancelledError:
+            logging.info(f'Transcription request in chat {chat_id} was cancelled')
+        finally:
+            self.chat_queue.release(chat_id)
 
     async def vision(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Interpret image using vision model.
         """
-        if not self.config['enable_vision'] or not await self.check_allowed_and_within_budget(update, context):
+        if not self.config['enable_vision']:
             return
 
         chat_id = update.effective_chat.id
         prompt = update.message.caption
 
+        # filter out group chat messages before the more expensive authorization
         if is_group_chat(update):
             if self.config['ignore_group_vision']:
                 logging.info('Vision coming from group chat, ignoring...')
@@ -471,11 +583,17 @@ class ChatGPTTelegramBot:
                    (prompt is not None and not prompt.lower().startswith(trigger_keyword.lower())):
                     logging.info('Vision coming from group chat with wrong keyword, ignoring...')
                     return
-        
+
+        if not await self.check_allowed_and_within_budget(update, context):
+            return
+
         image = update.message.effective_attachment[-1]
-        
+        total_tokens = 0
+        prompt_tokens = 0
+        answer = ''
 
         async def _execute():
+            nonlocal total_tokens, prompt_tokens, answer
             bot_language = self.config['bot_language']
             try:
                 media_file = await context.bot.get_file(image.file_id)
@@ -515,8 +633,7 @@ class ChatGPTTelegramBot:
             
 
             user_id = update.message.from_user.id
-            if user_id not in self.usage:
-                self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+            self.usage.get_tracker(user_id, update.message.from_user.name)
 
             if self.config['stream']:
 
@@ -534,6 +651,13 @@ class ChatGPTTelegramBot:
                     if len(content.strip()) == 0:
                         continue
 
+                    if not answer:
+                        # the prompt has been processed once the answer starts, counted before a /reset clears it
+                        prompt_tokens = self.openai.get_conversation_stats(chat_id)[1]
+                    answer = content
+                    if tokens != 'not_finished':
+                        total_tokens = int(tokens)
+
                     stream_chunks = split_into_chunks(content)
                     if len(stream_chunks) > 1:
                         content = stream_chunks[-1]
@@ -542,14 +666,14 @@ class ChatGPTTelegramBot:
                             try:
                                 await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
                                                               stream_chunks[-2])
-                            except:
+                            except Exception:
                                 pass
                             try:
                                 sent_message = await update.effective_message.reply_text(
                                     message_thread_id=get_thread_id(update),
                                     text=content if len(content) > 0 else "..."
                                 )
-                            except:
+                            except Exception:
                                 pass
                             continue
 
@@ -566,7 +690,7 @@ class ChatGPTTelegramBot:
                                 reply_to_message_id=get_reply_to_message_id(self.config, update),
                                 text=content,
                             )
-                        except:
+                        except Exception:
                             continue
 
                     elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
@@ -594,8 +718,6 @@ class ChatGPTTelegramBot:
                         await asyncio.sleep(0.01)
 
                     i += 1
-                    if tokens != 'not_finished':
-                        total_tokens = int(tokens)
 
                 
             else:
@@ -637,11 +759,26 @@ class ChatGPTTelegramBot:
             vision_token_price = self.config['vision_token_price']
             self.usage[user_id].add_vision_tokens(total_tokens, vision_token_price)
 
-            allowed_user_ids = self.config['allowed_user_ids'].split(',')
-            if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
-                self.usage["guests"].add_vision_tokens(total_tokens, vision_token_price)
+            if is_guest(self.config, user_id) and 'guests' in self.usage:
+                self.usage.guests.add_vision_tokens(total_tokens, vision_token_price)
+            # the usage is recorded, a cancellation while the typing indicator stops must not count it again
+            total_tokens = 0
+            answer = ''
 
-        await wrap_with_indicator(update, context, _execute, constants.ChatAction.TYPING)
+        if not await self.enter_chat_queue(update, chat_id, update.message.from_user.id):
+            return
+        try:
+            await wrap_with_indicator(update, context, _execute, constants.ChatAction.TYPING)
+        except asyncio.CancelledError:
+            logging.info(f'Vision request in chat {chat_id} was cancelled')
+            total_tokens = self.count_cancelled_tokens(total_tokens, prompt_tokens, answer)
+            if total_tokens > 0:
+                user_id = update.message.from_user.id
+                self.usage[user_id].add_vision_tokens(total_tokens, self.config['vision_token_price'])
+                if is_guest(self.config, user_id) and 'guests' in self.usage:
+                    self.usage.guests.add_vision_tokens(total_tokens, self.config['vision_token_price'])
+        finally:
+            self.chat_queue.release(chat_id)
 
     async def prompt(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
@@ -650,6 +787,11 @@ class ChatGPTTelegramBot:
         if update.edited_message or not update.message or update.message.via_bot:
             return
 
+        # filter out group chat messages not addressed to the bot before the more expensive authorization
+        if is_group_chat(update) and not is_addressed_to_bot(self.config, update, context.bot.id):
+            logging.warning('Message does not start with trigger keyword, ignoring...')
+            return
+
         if not await self.check_allowed_and_within_budget(update, context):
             return
 
@@ -672,15 +814,15 @@ class ChatGPTTelegramBot:
                         update.message.reply_to_message.from_user.id != context.bot.id:
                     prompt = f'"{update.message.reply_to_message.text}" {prompt}'
             else:
-                if update.message.reply_to_message and update.message.reply_to_message.from_user.id == context.bot.id:
-                    logging.info('Message is a reply to the bot, allowing...')
-                else:
-                    logging.warning('Message does not start with trigger keyword, ignoring...')
-                    return
+                logging.info('Message is a reply to the bot, allowing...')
 
-        try:
-            total_tokens = 0
+        if not await self.enter_chat_queue(update, chat_id, user_id):
+            return
 
+        total_tokens = 0
+        prompt_tokens = 0
+        answer = ''
+        try:
             if self.config['stream']:
                 await update.effective_message.reply_chat_action(
                     action=constants.ChatAction.TYPING,
@@ -696,11 +838,20 @@ class ChatGPTTelegramBot:
 
                 async for content, tokens in stream_response:
                     if is_direct_result(content):
+                        # the tokens of the tool calls that produced the direct result
+                        add_chat_request_to_usage_tracker(self.usage, self.config, user_id, int(tokens))
                         return await handle_direct_result(self.config, update, content)
 
                     if len(content.strip()) == 0:
                         continue
 
+                    if not answer:
+                        # the prompt has been processed once the answer starts, counted before a /reset clears it
+                        prompt_tokens = self.openai.get_conversation_stats(chat_id)[1]
+                    answer = content
+                    if tokens != 'not_finished':
+                        total_tokens = int(tokens)
+
                     stream_chunks = split_into_chunks(content)
                     if len(stream_chunks) > 1:
                         content = stream_chunks[-1]
@@ -709,14 +860,14 @@ class ChatGPTTelegramBot:
                             try:
                                 await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
                                                               stream_chunks[-2])
-                            except:
+                            except Exception:
                                 pass
                             try:
                                 sent_message = await update.effective_message.reply_text(
                                     message_thread_id=get_thread_id(update),
                                     text=content if len(content) > 0 else "..."
                                 )
-                            except:
+                            except Exception:
                                 pass
                             continue
 
@@ -733,7 +884,7 @@ class ChatGPTTelegramBot:
                                 reply_to_message_id=get_reply_to_message_id(self.config, update),
                                 text=content,
                             )
-                        except:
+                        except Exception:
                             continue
 
                     elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
@@ -761,8 +912,6 @@ class ChatGPTTelegramBot:
                         await asyncio.sleep(0.01)
 
                     i += 1
-                    if tokens != 'not_finished':
-                        total_tokens = int(tokens)
 
             else:
                 async def _reply():
@@ -799,6 +948,12 @@ class ChatGPTTelegramBot:
 
             add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens)
 
+        except asyncio.CancelledError:
+            logging.info(f'Chat request in chat {chat_id} was cancelled')
+            total_tokens = self.count_cancelled_tokens(total_tokens, prompt_tokens, answer)
+            if total_tokens > 0:
+                add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens)
+
         except Exception as e:
             logging.exception(e)
             await update.effective_message.reply_text(
@@ -807,6 +962,8 @@ class ChatGPTTelegramBot:
                 text=f"{localized_text('chat_fail', self.config['bot_language'])} {str(e)}",
                 parse_mode=constants.ParseMode.MARKDOWN
             )
+        finally:
+            self.chat_queue.release(chat_id)
 
     async def inline_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
@@ -864,11 +1021,14 @@ class ChatGPTTelegramBot:
         bot_language = self.config['bot_language']
         answer_tr = localized_text("answer", bot_language)
         loading_tr = localized_text("loading", bot_language)
+        queued = False
+        total_tokens = 0
+        prompt_tokens = 0
+        answer = ''
 
         try:
             if callback_data.startswith(callback_data_suffix):
                 unique_id = callback_data.split(':')[1]
-                total_tokens = 0
 
                 # Retrieve the prompt from the cache
                 query = self.inline_queries_cache.get(unique_id)
@@ -884,6 +1044,19 @@ class ChatGPTTelegramBot:
                                                   is_inline=True)
                     return
 
+                try:
+                    if self.config['cancel_superseded_requests']:
+                        self.chat_queue.cancel(user_id, user_id)
+                    await self.chat_queue.acquire(user_id, user_id)
+                    queued = True
+                except ChatQueueFull:
+                    logging.warning(f'Too many queued requests in chat {user_id}, ignoring inline query...')
+                    await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
+                                                  text=f'{query}\n\n_{answer_tr}:_\n'
+                                                       f'{localized_text("queue_full", bot_language)}',
+                                                  is_inline=True)
+                    return
+
                 unavailable_message = localized_text("function_unavailable_in_inline_mode", bot_language)
                 if self.config['stream']:
                     stream_response = self.openai.get_chat_response_stream(chat_id=user_id, query=query)
@@ -892,6 +1065,7 @@ class ChatGPTTelegramBot:
                     backoff = 0
                     async for content, tokens in stream_response:
                         if is_direct_result(content):
+                            add_chat_request_to_usage_tracker(self.usage, self.config, user_id, int(tokens))
                             cleanup_intermediate_files(content)
                             await edit_message_with_retry(context, chat_id=None,
                                                           message_id=inline_message_id,
@@ -902,6 +1076,13 @@ class ChatGPTTelegramBot:
                         if len(content.strip()) == 0:
                             continue
 
+                        if not answer:
+                            # the prompt has been processed once the answer starts, counted before a /reset clears it
+                            prompt_tokens = self.openai.get_conversation_stats(user_id)[1]
+                        answer = content
+                        if tokens != 'not_finished':
+                            total_tokens = int(tokens)
+
                         cutoff = get_stream_cutoff_values(update, content)
                         cutoff += backoff
 
@@ -911,7 +1092,7 @@ class ChatGPTTelegramBot:
                                                               message_id=inline_message_id,
                                                               text=f'{query}\n\n{answer_tr}:\n{content}',
                                                               is_inline=True)
-                            except:
+                            except Exception:
                                 continue
 
                         elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
@@ -942,8 +1123,6 @@ class ChatGPTTelegramBot:
                             await asyncio.sleep(0.01)
 
                         i += 1
-                        if tokens != 'not_finished':
-                            total_tokens = int(tokens)
 
                 else:
                     async def _send_inline_query_response():
@@ -978,6 +1157,12 @@ class ChatGPTTelegramBot:
 
                 add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens)
 
+        except asyncio.CancelledError:
+            logging.info(f'Inline query request of user {user_id} was cancelled')
+            total_tokens = self.count_cancelled_tokens(total_tokens, prompt_tokens, answer)
+            if total_tokens > 0:
+                add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens)
+
         except Exception as e:
             logging.error(f'Failed to respond to an inline query via button callback: {e}')
             logging.exception(e)
@@ -985,6 +1170,9 @@ class ChatGPTTelegramBot:
             await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
                                           text=f"{query}\n\n_{answer_tr}:_\n{localized_answer} {str(e)}",
                                           is_inline=True)
+        finally:
+            if queued:
+                self.chat_queue.release(user_id)
 
     async def check_allowed_and_within_budget(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
                                               is_inline=False) -> bool:
@@ -998,7 +1186,7 @@ class ChatGPTTelegramBot:
         name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
         user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
 
-        if not await is_allowed(self.config, update, context, is_inline=is_inline):
+        if not await is_allowed(self.config, update, context, is_inline=is_inline, membership=self.membership):
             logging.warning(f'User {name} (id: {user_id}) is not allowed to use the bot')
             await self.send_disallowed_message(update, context, is_inline)
             return False
@@ -1009,6 +1197,42 @@ class ChatGPTTelegramBot:
 
         return True
 
+    async def enter_chat_queue(self, update: Update, chat_id: int, user_id: int) -> bool:
+        """
+        Cancels the running request of the user in the chat, if enabled,
+        and waits until all earlier requests of the chat are done.
+        :param update: Telegram update object
+        :param chat_id: The chat ID
+        :param user_id: The ID of the user who sent the request
+        :return: Boolean indicating if the request can run, False if the queue of the chat is full
+        """
+        if self.config['cancel_superseded_requests'] and self.chat_queue.cancel(chat_id, user_id):
+            logging.info(f'Cancelled the superseded request of user {user_id} in chat {chat_id}')
+        try:
+            await self.chat_queue.acquire(chat_id, user_id)
+            return True
+        except ChatQueueFull:
+            logging.warning(f'Too many queued requests in chat {chat_id}, ignoring...')
+            await update.effective_message.reply_text(
+                message_thread_id=get_thread_id(update),
+                reply_to_message_id=get_reply_to_message_id(self.config, update),
+                text=localized_text('queue_full', self.config['bot_language'])
+            )
+            return False
+
+    def count_cancelled_tokens(self, total_tokens: int, prompt_tokens: int, answer: str) -> int:
+        """
+        Returns the number of tokens used by a cancelled request, which are billed even though
+        the answer was not finished.
+        :param total_tokens: The number of tokens reported for the request, 0 if the response didn't finish
+        :param prompt_tokens: The number of tokens of the conversation sent as the prompt
+        :param answer: The part of the answer streamed so far
+        :return: The reported number of tokens, or an estimate from the prompt and the partial answer
+        """
+        if total_tokens > 0 or not answer:
+            return total_tokens
+        return prompt_tokens + self.openai.count_tokens(answer)
+
     async def send_disallowed_message(self, update: Update, _: ContextTypes.DEFAULT_TYPE, is_inline=False):
         """
         Sends the disallowed message to the user.
@@ -1036,12 +1260,65 @@ class ChatGPTTelegramBot:
             result_id = str(uuid4())
             await self.send_inline_query_result(update, result_id, message_content=self.budget_limit_message)
 
+    async def chat_member_update(self, update: Update, _: ContextTypes.DEFAULT_TYPE):
+        """
+        Drops the cached group membership changed by a chat member update.
+        """
+        self.membership.handle_update(update.chat_member or update.my_chat_member)
+
     async def post_init(self, application: Application) -> None:
         """
         Post initialization hook for the bot.
         """
         await application.bot.set_my_commands(self.group_commands, scope=BotCommandScopeAllGroupChats())
         await application.bot.set_my_commands(self.commands)
+        # the usage index is built in the background, so the bot doesn't wait for the whole usage to be read
+        self.usage_index_task = asyncio.create_task(self.usage.load_index())
+        self.housekeeping_task = asyncio.create_task(self.housekeeping())
+        self.usage_flush_task = asyncio.create_task(self.flush_usage_periodically())
+
+    async def post_shutdown(self, _: Application) -> None:
+        """
+        Post shutdown hook for the bot.
+        """
+        if self.usage_index_task is not None:
+            self.usage_index_task.cancel()
+        if self.housekeeping_task is not None:
+            self.housekeeping_task.cancel()
+        if self.usage_flush_task is not None:
+            self.usage_flush_task.cancel()
+        await self.usage.close()
+        self.openai.conversations.close()
+        await self.openai.plugin_manager.close()
+
+    async def housekeeping(self):
+        """
+        Periodically removes expired conversations and the data kept for them,
+        compacts the usage history and removes expired group memberships.
+        """
+        while True:
+            await asyncio.sleep(self.config['housekeeping_interval'])
+            try:
+                self.openai.sweep_conversations()
+                for chat_id in [chat_id for chat_id in self.last_message if chat_id not in self.openai.conversations]:
+                    del self.last_message[chat_id]
+                await self.usage.compact()
+                self.membership.sweep()
+                logging.debug(f'Usage tracker cache: {self.usage.get_cache_stats()}')
+                logging.debug(f'Plugin result cache: {self.openai.plugin_manager.cache.get_stats()}')
+            except Exception as e:
+                logging.exception(e)
+
+    async def flush_usage_periodically(self):
+        """
+        Periodically writes the changed usage of all users to the usage storage.
+        """
+        while True:
+            await asyncio.sleep(self.config['usage_flush_interval'])
+            try:
+                await self.usage.flush()
+            except Exception as e:
+                logging.exception(e)
 
     def run(self):
         """
@@ -1052,6 +1329,7 @@ class ChatGPTTelegramBot:
             .proxy_url(self.config['proxy']) \
             .get_updates_proxy_url(self.config['proxy']) \
             .post_init(self.post_init) \
+            .post_shutdown(self.post_shutdown) \
             .concurrent_updates(True) \
             .build()
 
@@ -1061,6 +1339,8 @@ class ChatGPTTelegramBot:
         application.add_handler(CommandHandler('tts', self.tts))
         application.add_handler(CommandHandler('start', self.help))
         application.add_handler(CommandHandler('stats', self.stats))
+        application.add_handler(CommandHandler('report', self.report))
+        application.add_handler(CommandHandler('plugins', self.plugins))
         application.add_handler(CommandHandler('resend', self.resend))
         application.add_handler(CommandHandler(
             'chat', self.prompt, filters=filters.ChatType.GROUP | filters.ChatType.SUPERGROUP)
@@ -1077,7 +1357,9 @@ class ChatGPTTelegramBot:
             constants.ChatType.GROUP, constants.ChatType.SUPERGROUP, constants.ChatType.PRIVATE
         ]))
         application.add_handler(CallbackQueryHandler(self.handle_callback_inline_query))
+        application.add_handler(ChatMemberHandler(self.chat_member_update, ChatMemberHandler.ANY_CHAT_MEMBER))
 
         application.add_error_handler(error_handler)
 
-        application.run_polling()
+        # chat member updates are only sent when requested explicitly
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
@@ -0,0 +1,228 @@
+from __future__ import annotations
+
+import csv
+import io
+from datetime import date
+
+import numpy as np
+
+from usage_storage import UsageStorage, IMAGE_SIZES
+
+DAY, MONTH, YEAR = 0, 1, 2  # granularity of the usage history keys
+
+
+def parse_period(key: str) -> tuple[int, int]:
+    """
+    Converts a key of the usage history ('2023-03-14', '2023-03' or '2023') into
+    the ordinal of the first day of the period and its granularity.
+    """
+    if len(key) == 10:
+        return date.fromisoformat(key).toordinal(), DAY
+    if len(key) == 7:
+        return date(int(key[:4]), int(key[5:7]), 1).toordinal(), MONTH
+    return date(int(key), 1, 1).toordinal(), YEAR
+
+
+def metric_prices(config: dict) -> dict[str, float]:
+    """
+    Get the price per unit of every metric, as configured.
+    :param config: The bot configuration object
+    :return: dictionary of metric to price per unit
+    """
+    prices = {
+        'chat_tokens': config['token_price'] / 1000,
+        'vision_tokens': config['vision_token_price'] / 1000,
+        'transcription_seconds': config['transcription_price'] / 60,
+    }
+    for size, price in zip(IMAGE_SIZES, config['image_prices']):
+        prices[f'number_images:{size}'] = price
+    for tts_model, price in zip(['tts-1', 'tts-1-hd'], config['tts_prices']):
+        prices[f'tts_characters:{tts_model}'] = price / 1000
+    return prices
+
+
+class UsageReport:
+    """
+    Usage across all users, as computed by `UsageIndex.report`.
+    """
+
+    def __init__(self):
+        self.top_users: list[tuple[str, str, float]] = []  # (user_id, user_name, cost)
+        self.daily_costs: list[tuple[str, float]] = []  # (day, cost)
+        self.metrics: list[tuple[str, float, float]] = []  # (metric, amount, cost)
+        self.total_cost = 0.0
+        self.guest_cost = 0.0
+        self.allowed_users_cost = 0.0
+        self.users: list[tuple[str, str, float]] = []  # (user_id, user_name, cost) of all users
+        self.user_amounts = np.zeros((0, 0))  # amount per user and metric, in the order of users and metrics
+        self.metric_names: list[str] = []
+
+    def to_csv(self) -> str:
+        """
+        Exports the usage of all users as CSV, with one row per user and one column per metric.
+        """
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['user_id', 'user_name', *self.metric_names, 'cost'])
+        for (user_id, user_name, cost), amounts in zip(self.users, self.user_amounts):
+            writer.writerow([user_id, user_name, *[f'{amount:g}' for amount in amounts], f'{cost:.6f}'])
+        return output.getvalue()
+
+
+class UsageIndex:
+    """
+    A columnar index of the usage of all users, kept as NumPy arrays of (user, period, metric, amount) rows.
+    There is a single row per user, period and metric, so the index grows with the number of active users
+    and days, not with the number of requests.
+    It is built once from the usage storage and then updated incrementally with the written usage,
+    so reports across all users don't need to read the storage.
+    The 'guests' pseudo user, which repeats the usage of guest users in group chats, is kept apart in reports.
+    """
+
+    def __init__(self, capacity: int = 4096):
+        """
+        Initializes an empty index.
+        :param capacity: The initial number of rows to allocate
+        """
+        self.size = 0
+        self.users = np.zeros(capacity, dtype=np.int32)
+        self.periods = np.zeros(capacity, dtype=np.int32)
+        self.granularities = np.zeros(capacity, dtype=np.int8)
+        self.metrics = np.zeros(capacity, dtype=np.int16)
+        self.amounts = np.zeros(capacity, dtype=np.float64)
+        self.user_ids: list[str] = []
+        self.user_names: list[str] = []
+        self.user_index: dict[str, int] = {}
+        self.metric_names: list[str] = []
+        self.metric_index: dict[str, int] = {}
+        self.cells: dict[tuple[int, int, int, int], int] = {}  # {(user, period, granularity, metric): row}
+
+    def load(self, storage: UsageStorage):
+        """
+        Adds the whole usage stored in the storage engine to the index.
+        """
+        self.__add_rows((self.__get_user(user_id, user_name), *parse_period(key), self.__get_metric(metric), amount)
+                        for user_id, user_name, key, metric, amount in storage.iter_rows())
+
+    def add(self, user_id, user_name, rows):
+        """
+        Adds usage of a user to the index.
+        :param user_id: The user ID
+        :param user_name: The user name
+        :param rows: iterable of (day, metric, amount) tuples
+        """
+        user = self.__get_user(user_id, user_name)
+        self.__add_rows((user, *parse_period(key), self.__get_metric(metric), amount) for key, metric, amount in rows)
+
+    def report(self, prices: dict[str, float], allowed_user_ids: str = '*', top: int = 10,
+               days: int = 7) -> UsageReport:
+        """
+        Computes a report of the usage across all users.
+        :param prices: The price per unit of every metric, see `metric_prices`
+        :param allowed_user_ids: The comma separated allowed user IDs, or '*'
+        :param top: The number of users with the highest cost to include
+        :param days: The number of days, up to today, to include the daily totals for
+        :return: the report
+        """
+        report = UsageReport()
+        n_users, n_metrics = len(self.user_ids), len(self.metric_names)
+        users, metrics = self.users[:self.size], self.metrics[:self.size]
+        amounts = self.amounts[:self.size]
+        costs = amounts * np.array([prices.get(metric, 0.0) for metric in self.metric_names])[metrics]
+
+        # usage of the 'guests' pseudo user is already counted for the guest users themselves
+        guests = self.user_index.get('guests', -1)
+        counted = users != guests
+        all_user_costs = np.bincount(users, weights=costs, minlength=n_users)
+        user_costs = all_user_costs.copy()
+        report.guest_cost = float(user_costs[guests]) if guests >= 0 else 0.0
+        if guests >= 0:
+            user_costs[guests] = 0.0
+        report.total_cost = float(user_costs.sum())
+        if allowed_user_ids == '*':
+            report.allowed_users_cost = report.total_cost
+        else:
+            allowed = [self.user_index[user_id] for user_id in allowed_user_ids.split(',')
+                       if user_id in self.user_index]
+            report.allowed_users_cost = float(user_costs[allowed].sum())
+
+        top_users = np.argsort(-user_costs, kind='stable')[:top]
+        report.top_users = [(self.user_ids[user], self.user_names[user], float(user_costs[user]))
+                            for user in top_users if user_costs[user] > 0]
+
+        first_day = date.today().toordinal() - days + 1
+        in_days = counted & (self.granularities[:self.size] == DAY) & (self.periods[:self.size] >= first_day)
+        daily_costs = np.bincount(self.periods[:self.size][in_days] - first_day, weights=costs[in_days],
+                                  minlength=days)[:days]
+        report.daily_costs = [(str(date.fromordinal(first_day + day)), float(cost))
+                              for day, cost in enumerate(daily_costs)]
+
+        metric_amounts = np.bincount(metrics[counted], weights=amounts[counted], minlength=n_metrics)
+        metric_costs = np.bincount(metrics[counted], weights=costs[counted], minlength=n_metrics)
+        report.metrics = [(metric, float(metric_amounts[index]), float(metric_costs[index]))
+                          for index, metric in enumerate(self.metric_names)]
+
+        report.metric_names = list(self.metric_names)
+        report.user_amounts = np.bincount(users.astype(np.int64) * n_metrics + metrics, weights=amounts,
+                                          minlength=n_users * n_metrics).reshape(n_users, n_metrics)
+        report.users = [(user_id, user_name, float(cost))
+                        for user_id, user_name, cost in zip(self.user_ids, self.user_names, all_user_costs)]
+        return report
+
+    def __get_user(self, user_id, user_name) -> int:
+        user_id = str(user_id)
+        if user_id not in self.user_index:
+            self.user_index[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+            self.user_names.append(user_name or '')
+        elif user_name:
+            self.user_names[self.user_index[user_id]] = user_name
+        return self.user_index[user_id]
+
+    def __get_metric(self, metric: str) -> int:
+        if metric not in self.metric_index:
+            self.metric_index[metric] = len(self.metric_names)
+            self.metric_names.append(metric)
+        return self.metric_index[metric]
+
+    def __add_rows(self, rows):
+        """
+        Adds (user, period, granularity, metric, amount) rows to the index. The amount of a row is added
+        to the existing row of the same user, period and metric, if any, and the other rows are appended.
+        """
+        new_rows = [[], [], [], [], []]
+        new_cells = {}
+        for user, period, granularity, metric, amount in rows:
+            cell = (user, period, granularity, metric)
+            row = self.cells.get(cell)
+            if row is not None:
+                self.amounts[row] += amount
+            elif cell in new_cells:
+                new_rows[4][new_cells[cell]] += amount
+            else:
+                new_cells[cell] = len(new_rows[0])
+                for column, value in zip(new_rows, (*cell, amount)):
+                    column.append(value)
+        for cell, offset in new_cells.items():
+            self.cells[cell] = self.size + offset
+        self.__append(*new_rows)
+
+    def __append(self, users, periods, granularities, metrics, amounts):
+        """
+        Appends rows to the columns, growing them as needed.
+        """
+        count = len(users)
+        if self.size + count > len(self.users):
+            capacity = max(2 * len(self.users), self.size + count)
+            for name in ('users', 'periods', 'granularities', 'metrics', 'amounts'):
+                column = getattr(self, name)
+                grown = np.zeros(capacity, dtype=column.dtype)
+                grown[:self.size] = column[:self.size]
+                setattr(self, name, grown)
+        end = self.size + count
+        self.users[self.size:end] = users
+        self.periods[self.size:end] = periods
+        self.granularities[self.size:end] = granularities
+        self.metrics[self.size:end] = metrics
+        self.amounts[self.size:end] = amounts
+        self.size = end
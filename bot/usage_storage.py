@@ -0,0 +1,363 @@
+from __future__ import annotations
+
+import json
+import os.path
+import pathlib
+import sqlite3
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from datetime import date, timedelta
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from usage_tracker import UsageTracker
+
+# metrics whose amounts are counted in whole units
+INTEGER_METRICS = ('chat_tokens', 'vision_tokens', 'number_images', 'tts_characters')
+IMAGE_SIZES = ["256x256", "512x512", "1024x1024"]
+
+
+def write_atomic(path, data):
+    """
+    Writes data to a file through a temporary file and a rename,
+    so the file is never left partially written.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, "w") as outfile:
+            outfile.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def compaction_cutoffs(today: date, keep_days: int, keep_months: int):
+    """
+    Get the cutoffs for compacting the usage history. Days before the day cutoff are rolled into months,
+    and months before the month cutoff into years. The current month and year are never rolled up.
+    :param today: the current date
+    :param keep_days: number of days to keep daily usage for
+    :param keep_months: number of months to keep monthly usage for
+    :return: the day cutoff and the month cutoff, compared as strings to the keys of the usage history
+    """
+    months = today.year * 12 + today.month - 1 - keep_months
+    day_cutoff = min(str(today - timedelta(days=keep_days)), str(today)[:7])
+    month_cutoff = min(f'{months // 12:04d}-{months % 12 + 1:02d}', str(today)[:4])
+    return day_cutoff, month_cutoff
+
+
+def rollup_key(key: str, day_cutoff: str, month_cutoff: str) -> str | None:
+    """
+    Get the month or year a key of the usage history is rolled into, or None if it is kept.
+    """
+    target = key
+    if len(target) == 10 and target < day_cutoff:
+        target = target[:7]
+    if len(target) == 7 and target < month_cutoff:
+        target = target[:4]
+    return target if target != key else None
+
+
+def compact_history(usage_history: dict, day_cutoff: str, month_cutoff: str) -> bool:
+    """
+    Rolls the daily usage before the day cutoff into monthly totals, and the monthly totals before
+    the month cutoff into yearly totals, see `compaction_cutoffs`. Totals are kept exact.
+    :param usage_history: the usage history, compacted in place
+    :param day_cutoff: days before this date are rolled into months
+    :param month_cutoff: months before this month are rolled into years
+    :return: whether the usage history has changed
+    """
+    changed = False
+    buckets = [usage_history.get("chat_tokens", {}), usage_history.get("transcription_seconds", {}),
+               usage_history.get("vision_tokens", {}), *usage_history.get("tts_characters", {}).values()]
+    images = usage_history.get("number_images", {})
+    for bucket in [*buckets, images]:
+        for key in list(bucket):
+            target = rollup_key(key, day_cutoff, month_cutoff)
+            if target is None:
+                continue
+            amount = bucket.pop(key)
+            if bucket is images:
+                bucket[target] = [a + b for a, b in zip(bucket.get(target, [0, 0, 0]), amount)]
+            else:
+                bucket[target] = bucket.get(target, 0) + amount
+            changed = True
+    return changed
+
+
+def history_to_rows(usage_history: dict):
+    """
+    Flattens a usage history into (day, metric, amount) rows.
+    Image counts and TTS characters are split into one metric per image size and TTS model,
+    e.g. 'number_images:256x256' and 'tts_characters:tts-1'.
+    """
+    for metric, days in usage_history.items():
+        if metric == 'number_images':
+            for day, counts in days.items():
+                for size, count in zip(IMAGE_SIZES, counts):
+                    yield day, f'number_images:{size}', count
+        elif metric == 'tts_characters':
+            for tts_model, model_days in days.items():
+                for day, characters in model_days.items():
+                    yield day, f'tts_characters:{tts_model}', characters
+        else:
+            for day, amount in days.items():
+                yield day, metric, amount
+
+
+def rows_to_history(rows) -> dict:
+    """
+    Builds a usage history from (day, metric, amount) rows, reversing `history_to_rows`.
+    """
+    usage_history = {"chat_tokens": {}, "transcription_seconds": {}, "number_images": {},
+                     "tts_characters": {}, "vision_tokens": {}}
+    for day, metric, amount in rows:
+        metric, _, variant = metric.partition(':')
+        if metric in INTEGER_METRICS:
+            amount = int(amount)
+        if metric == 'number_images':
+            counts = usage_history['number_images'].setdefault(day, [0, 0, 0])
+            counts[IMAGE_SIZES.index(variant)] += amount
+        elif metric == 'tts_characters':
+            usage_history['tts_characters'].setdefault(variant, {})[day] = amount
+        else:
+            usage_history.setdefault(metric, {})[day] = amount
+    return usage_history
+
+
+class UsageStorage(ABC):
+    """
+    A storage engine interface for the usage of the users.
+    Changes are written in batches: a snapshot of each changed tracker is taken on the event loop,
+    and the batch of snapshots is written afterwards, possibly in a different thread.
+    """
+
+    @abstractmethod
+    def load(self, user_id) -> dict | None:
+        """
+        Load the usage of the given user, or None if there is no stored usage.
+        """
+        pass
+
+    @abstractmethod
+    def snapshot(self, tracker: UsageTracker, events: list[tuple]):
+        """
+        Take a snapshot of the changes of a tracker to be written by `write`.
+        :param tracker: The changed usage tracker
+        :param events: The usage events recorded since the last snapshot, as (time, metric, amount, cost) tuples
+        """
+        pass
+
+    @abstractmethod
+    def write(self, snapshots: list):
+        """
+        Write a batch of snapshots.
+        """
+        pass
+
+    @abstractmethod
+    def iter_rows(self):
+        """
+        Iterate over the stored usage history of all users, as (user_id, user_name, day, metric, amount) tuples.
+        """
+        pass
+
+    def compact(self, day_cutoff: str, month_cutoff: str, loaded: set[str]):
+        """
+        Roll up the stored usage history, see `compact_history`.
+        :param day_cutoff: days before this date are rolled into months
+        :param month_cutoff: months before this month are rolled into years
+        :param loaded: the IDs of the users whose trackers are loaded, which compact their own usage history
+        """
+        pass
+
+    def close(self):
+        """
+        Release the resources held by the storage.
+        """
+        pass
+
+
+class JSONUsageStorage(UsageStorage):
+    """
+    Stores the usage of every user in its own JSON file.
+    """
+
+    def __init__(self, logs_dir: str = "usage_logs"):
+        """
+        Initializes the storage.
+        :param logs_dir: path to directory of usage logs
+        """
+        self.logs_dir = logs_dir
+        # ensure directory exists
+        pathlib.Path(logs_dir).mkdir(exist_ok=True)
+
+    def load(self, user_id) -> dict | None:
+        user_file = f"{self.logs_dir}/{user_id}.json"
+        if not os.path.isfile(user_file):
+            return None
+        with open(user_file, "r") as file:
+            return json.load(file)
+
+    def snapshot(self, tracker: UsageTracker, events: list[tuple]):
+        return f"{self.logs_dir}/{tracker.user_id}.json", json.dumps(tracker.usage)
+
+    def write(self, snapshots: list):
+        for user_file, data in snapshots:
+            write_atomic(user_file, data)
+
+    def iter_rows(self):
+        for user_file in pathlib.Path(self.logs_dir).glob('*.json'):
+            with open(user_file, "r") as file:
+                usage = json.load(file)
+            for day, metric, amount in history_to_rows(usage['usage_history']):
+                yield user_file.stem, usage.get('user_name'), day, metric, amount
+
+    def compact(self, day_cutoff: str, month_cutoff: str, loaded: set[str]):
+        # the next write of a loaded tracker replaces its whole file, so only the files of the other users are compacted
+        for user_file in pathlib.Path(self.logs_dir).glob('*.json'):
+            if user_file.stem in loaded:
+                continue
+            with open(user_file, "r") as file:
+                usage = json.load(file)
+            if compact_history(usage['usage_history'], day_cutoff, month_cutoff):
+                write_atomic(user_file, json.dumps(usage))
+
+
+class SQLiteUsageStorage(UsageStorage):
+    """
+    Stores the usage of all users in an embedded SQLite database in WAL mode.
+    Every request is kept as an event until it is older than the day cutoff of the compaction,
+    along with per-day aggregates per user and metric which the usage history is loaded from.
+    A batch of snapshots is written in a single transaction.
+    The connection is shared by the event loop and the background threads, so all access to it is serialized
+    by a lock, and transactions never interleave.
+    """
+
+    def __init__(self, path: str):
+        """
+        Opens (and creates if needed) the SQLite database.
+        :param path: Path to the database file
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS usage_users ('
+                'user_id TEXT PRIMARY KEY, user_name TEXT, current_cost TEXT NOT NULL)'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS usage_events ('
+                'id INTEGER PRIMARY KEY, user_id TEXT NOT NULL, time TEXT NOT NULL, metric TEXT NOT NULL, '
+                'amount REAL NOT NULL, cost REAL NOT NULL)'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS usage_days ('
+                'user_id TEXT NOT NULL, day TEXT NOT NULL, metric TEXT NOT NULL, amount REAL NOT NULL, '
+                'PRIMARY KEY (user_id, day, metric))'
+            )
+            self.connection.execute('CREATE INDEX IF NOT EXISTS usage_events_time ON usage_events (time)')
+
+    def load(self, user_id) -> dict | None:
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT user_name, current_cost FROM usage_users WHERE user_id = ?', (str(user_id),)
+            ).fetchone()
+            if row is None:
+                return None
+            rows = self.connection.execute(
+                'SELECT day, metric, amount FROM usage_days WHERE user_id = ? ORDER BY day', (str(user_id),)
+            ).fetchall()
+        return {
+            "user_name": row[0],
+            "current_cost": json.loads(row[1]),
+            "usage_history": rows_to_history(rows)
+        }
+
+    def snapshot(self, tracker: UsageTracker, events: list[tuple]):
+        return str(tracker.user_id), tracker.usage['user_name'], json.dumps(tracker.usage['current_cost']), events
+
+    def write(self, snapshots: list):
+        with self.lock, self.connection:
+            for user_id, user_name, current_cost, events in snapshots:
+                self.write_user(user_id, user_name, current_cost)
+                self.connection.executemany(
+                    'INSERT INTO usage_events (user_id, time, metric, amount, cost) VALUES (?, ?, ?, ?, ?)',
+                    [(user_id, time, metric, amount, cost) for time, metric, amount, cost in events]
+                )
+                self.add_days(user_id, [(time[:10], metric, amount) for time, metric, amount, _ in events])
+
+    def write_user(self, user_id: str, user_name: str, current_cost: str):
+        """
+        Creates or updates the user row. Must be called within a transaction.
+        """
+        self.connection.execute(
+            'INSERT INTO usage_users (user_id, user_name, current_cost) VALUES (?, ?, ?) '
+            'ON CONFLICT (user_id) DO UPDATE SET user_name = COALESCE(excluded.user_name, usage_users.user_name), '
+            'current_cost = excluded.current_cost',
+            (user_id, user_name, current_cost)
+        )
+
+    def add_days(self, user_id: str, rows):
+        """
+        Adds (day, metric, amount) rows to the per-day aggregates. Must be called within a transaction.
+        """
+        self.connection.executemany(
+            'INSERT INTO usage_days (user_id, day, metric, amount) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (user_id, day, metric) DO UPDATE SET amount = amount + excluded.amount',
+            [(user_id, day, metric, amount) for day, metric, amount in rows]
+        )
+
+    def iter_rows(self):
+        # read through a separate read-only connection, which sees a consistent snapshot of the database in WAL mode
+        # while the rows are streamed, without holding the lock of the shared connection
+        connection = sqlite3.connect(pathlib.Path(self.path).absolute().as_uri() + '?mode=ro', uri=True)
+        try:
+            cursor = connection.execute(
+                'SELECT usage_days.user_id, user_name, day, metric, amount FROM usage_days '
+                'LEFT JOIN usage_users ON usage_users.user_id = usage_days.user_id'
+            )
+            while rows := cursor.fetchmany(1000):
+                yield from rows
+        finally:
+            connection.close()
+
+    def compact(self, day_cutoff: str, month_cutoff: str, loaded: set[str]):
+        # writes only add to the per-day totals, so the usage of loaded users is compacted as well
+        with self.lock, self.connection:
+            for length, key_length, cutoff in ((10, 7, day_cutoff), (7, 4, month_cutoff)):
+                self.connection.execute(
+                    'INSERT INTO usage_days (user_id, day, metric, amount) '
+                    'SELECT user_id, substr(day, 1, ?), metric, SUM(amount) FROM usage_days '
+                    'WHERE length(day) = ? AND day < ? GROUP BY user_id, substr(day, 1, ?), metric '
+                    'ON CONFLICT (user_id, day, metric) DO UPDATE SET amount = amount + excluded.amount',
+                    (key_length, length, cutoff, key_length)
+                )
+                self.connection.execute(
+                    'DELETE FROM usage_days WHERE length(day) = ? AND day < ?', (length, cutoff)
+                )
+            # the usage of older events is kept in the rolled up totals
+            self.connection.execute('DELETE FROM usage_events WHERE time < ?', (day_cutoff,))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def create_usage_storage(config: dict) -> UsageStorage:
+    """
+    Creates the usage storage engine selected in the configuration.
+    :param config: A dictionary containing the bot configuration
+    :return: The usage storage engine
+    """
+    storage = config.get('usage_storage', 'json')
+    if storage == 'sqlite':
+        return SQLiteUsageStorage(config['usage_db_path'])
+    if storage != 'json':
+        raise ValueError(f'Unknown usage storage: {storage}')
+    return JSONUsageStorage()
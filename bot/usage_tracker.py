@@ -1,7 +1,17 @@
-import os.path
-import pathlib
-import json
-from datetime import date
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections import OrderedDict
+from abc import ABC, abstractmethod
+from datetime import date, datetime
+
+from usage_analytics import UsageIndex
+from usage_storage import UsageStorage, JSONUsageStorage, IMAGE_SIZES, history_to_rows, compaction_cutoffs, \
+    compact_history
+
+
+GUESTS_NAME = 'all guest users in group chats'
 
 
 def year_month(date_str):
@@ -9,11 +19,112 @@ def year_month(date_str):
     return str(date_str)[:7]
 
 
-class UsageTracker:
+class PeriodCounter:
+    """
+    Running totals of a usage metric for the current day, the current month and all time.
+    """
+
+    def __init__(self, today):
+        self.day = today
+        self.day_amount = 0
+        self.month = year_month(today)
+        self.month_amount = 0
+        self.all_time_amount = 0
+
+    def load(self, today, day, amount):
+        """
+        Adds an amount of the usage history, of any day.
+        """
+        self.all_time_amount += amount
+        if day == today:
+            self.day_amount += amount
+        if year_month(day) == year_month(today):
+            self.month_amount += amount
+
+    def add(self, today, amount):
+        """
+        Adds an amount used today, starting new day and month totals when the day or month changed.
+        """
+        if today != self.day:
+            self.day, self.day_amount = today, 0
+        if year_month(today) != self.month:
+            self.month, self.month_amount = year_month(today), 0
+        self.day_amount += amount
+        self.month_amount += amount
+        self.all_time_amount += amount
+
+    def get(self, today):
+        """
+        Get the amounts used today and this month.
+        """
+        usage_day = self.day_amount if today == self.day else 0
+        usage_month = self.month_amount if year_month(today) == self.month else 0
+        return usage_day, usage_month
+
+
+class UsageRecorder(ABC):
+    """
+    Computes the cost of the usage of a request and records it.
+    """
+
+    @abstractmethod
+    def record(self, metric, amount, cost):
+        """
+        Records the usage of a request.
+        :param metric: the metric, e.g. 'chat_tokens', 'number_images:256x256' or 'tts_characters:tts-1'
+        :param amount: the used amount of the metric
+        :param cost: the cost of the request
+        """
+        pass
+
+    def add_chat_tokens(self, tokens, tokens_price=0.002):
+        """Adds used tokens from a request to a users usage history and updates current cost
+        :param tokens: total tokens used in last request
+        :param tokens_price: price per 1000 tokens, defaults to 0.002
+        """
+        token_cost = round(float(tokens) * tokens_price / 1000, 6)
+        self.record("chat_tokens", tokens, token_cost)
+
+    def add_image_request(self, image_size, image_prices="0.016,0.018,0.02"):
+        """Add image request to users usage history and update current costs.
+
+        :param image_size: requested image size
+        :param image_prices: prices for images of sizes ["256x256", "512x512", "1024x1024"],
+                             defaults to [0.016, 0.018, 0.02]
+        """
+        image_cost = image_prices[IMAGE_SIZES.index(image_size)]
+        self.record(f"number_images:{image_size}", 1, image_cost)
+
+    def add_vision_tokens(self, tokens, vision_token_price=0.01):
+        """
+         Adds requested vision tokens to a users usage history and updates current cost.
+        :param tokens: total tokens used in last request
+        :param vision_token_price: price per 1K tokens transcription, defaults to 0.01
+        """
+        token_price = round(tokens * vision_token_price / 1000, 2)
+        self.record("vision_tokens", tokens, token_price)
+
+    def add_tts_request(self, text_length, tts_model, tts_prices):
+        tts_models = ['tts-1', 'tts-1-hd']
+        price = tts_prices[tts_models.index(tts_model)]
+        tts_price = round(text_length * price / 1000, 2)
+        self.record(f"tts_characters:{tts_model}", text_length, tts_price)
+
+    def add_transcription_seconds(self, seconds, minute_price=0.006):
+        """Adds requested transcription seconds to a users usage history and updates current cost.
+        :param seconds: total seconds used in last request
+        :param minute_price: price per minute transcription, defaults to 0.006
+        """
+        transcription_price = round(seconds * minute_price / 60, 2)
+        self.record("transcription_seconds", seconds, transcription_price)
+
+
+class UsageTracker(UsageRecorder):
     """
     UsageTracker class
     Enables tracking of daily/monthly usage per user.
-    User files are stored as JSON in /usage_logs directory.
+    By default, user files are stored as JSON in /usage_logs directory (see usage_storage.py for other engines).
+    Changes are not written immediately, but written in batches by the `UsageRegistry`.
     JSON example:
     {
         "user_name": "@user_name",
@@ -40,29 +151,30 @@ class UsageTracker:
     }
     """
 
-    def __init__(self, user_id, user_name, logs_dir="usage_logs"):
+    def __init__(self, user_id, user_name, logs_dir="usage_logs", storage: UsageStorage | None = None):
         """
         Initializes UsageTracker for a user with current date.
-        Loads usage data from usage log file.
+        Loads usage data from the storage engine.
         :param user_id: Telegram ID of the user
         :param user_name: Telegram user name
         :param logs_dir: path to directory of usage logs, defaults to "usage_logs"
+        :param storage: storage engine to load the usage from, defaults to JSON files in logs_dir
         """
         self.user_id = user_id
-        self.logs_dir = logs_dir
-        # path to usage file of given user
-        self.user_file = f"{logs_dir}/{user_id}.json"
-
-        if os.path.isfile(self.user_file):
-            with open(self.user_file, "r") as file:
-                self.usage = json.load(file)
+        # whether the usage has changed since it was last written to the storage
+        self.dirty = False
+        # number of batches with changes of this tracker that are being written to the storage
+        self.writing = 0
+        # usage events recorded since the usage was last written, as (time, metric, amount, cost) tuples
+        self.events = []
+
+        self.usage = (storage or JSONUsageStorage(logs_dir)).load(user_id)
+        if self.usage is not None:
             if 'vision_tokens' not in self.usage['usage_history']:
                 self.usage['usage_history']['vision_tokens'] = {}
             if 'tts_characters' not in self.usage['usage_history']:
                 self.usage['usage_history']['tts_characters'] = {}
         else:
-            # ensure directory exists
-            pathlib.Path(logs_dir).mkdir(exist_ok=True)
             # create new dictionary for this user
             self.usage = {
                 "user_name": user_name,
@@ -70,206 +182,116 @@ class UsageTracker:
                 "usage_history": {"chat_tokens": {}, "transcription_seconds": {}, "number_images": {}, "tts_characters": {}, "vision_tokens":{}}
             }
 
-    # token usage functions:
+        # running totals per metric, so the current usage is known without scanning the usage history
+        today = str(date.today())
+        self.counters = {}
+        for day, metric, amount in history_to_rows(self.usage["usage_history"]):
+            self.__get_counter(metric).load(today, day, amount)
 
-    def add_chat_tokens(self, tokens, tokens_price=0.002):
-        """Adds used tokens from a request to a users usage history and updates current cost
-        :param tokens: total tokens used in last request
-        :param tokens_price: price per 1000 tokens, defaults to 0.002
+    def __add_event(self, metric, amount, cost):
         """
-        today = date.today()
-        token_cost = round(float(tokens) * tokens_price / 1000, 6)
-        self.add_current_costs(token_cost)
+        Records a usage event and marks the usage to be written to the storage.
+        """
+        self.events.append((datetime.now().isoformat(timespec='seconds'), metric, amount, cost))
+        self.dirty = True
+
+    def record(self, metric, amount, cost):
+        """
+        Records the usage of a request for today: updates the usage history, the current costs,
+        the period counters and the events to be written to the storage.
+        :param metric: the metric, e.g. 'chat_tokens', 'number_images:256x256' or 'tts_characters:tts-1'
+        :param amount: the used amount of the metric
+        :param cost: the cost of the request
+        """
+        today = str(date.today())
+        self.add_current_costs(cost)
 
         # update usage_history
-        if str(today) in self.usage["usage_history"]["chat_tokens"]:
-            # add token usage to existing date
-            self.usage["usage_history"]["chat_tokens"][str(today)] += tokens
+        history = self.usage["usage_history"]
+        name, _, variant = metric.partition(':')
+        if name == "number_images":
+            if today not in history["number_images"]:
+                # create new entry for current date
+                history["number_images"][today] = [0, 0, 0]
+            history["number_images"][today][IMAGE_SIZES.index(variant)] += amount
         else:
-            # create new entry for current date
-            self.usage["usage_history"]["chat_tokens"][str(today)] = tokens
+            days = history["tts_characters"].setdefault(variant, {}) if name == "tts_characters" else history[name]
+            # add usage to existing date or create new entry for current date
+            days[today] = days.get(today, 0) + amount
 
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.__get_counter(metric).add(today, amount)
+        self.__add_event(metric, amount, cost)
 
-    def get_current_token_usage(self):
-        """Get token amounts used for today and this month
+    def __get_counter(self, metric):
+        """
+        Get the period counter of a metric, creating it if needed.
+        """
+        if metric not in self.counters:
+            self.counters[metric] = PeriodCounter(str(date.today()))
+        return self.counters[metric]
 
-        :return: total number of tokens used per day and per month
+    def __get_period_usage(self, *metrics):
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["chat_tokens"]:
-            usage_day = self.usage["usage_history"]["chat_tokens"][str(today)]
-        else:
-            usage_day = 0
-        month = str(today)[:7]  # year-month as string
-        usage_month = 0
-        for today, tokens in self.usage["usage_history"]["chat_tokens"].items():
-            if today.startswith(month):
-                usage_month += tokens
+        Get the summed usage of the given metrics for today and this month.
+        """
+        today = str(date.today())
+        usage_day, usage_month = 0, 0
+        for metric in metrics:
+            if metric in self.counters:
+                day, month = self.counters[metric].get(today)
+                usage_day += day
+                usage_month += month
         return usage_day, usage_month
 
-    # image usage functions:
+    def compact(self, day_cutoff, month_cutoff):
+        """
+        Rolls the daily usage history before the day cutoff into monthly totals,
+        and the monthly totals before the month cutoff into yearly totals.
+        Totals are kept exact, so the costs and monthly figures don't change.
+        :param day_cutoff: days before this date are rolled into months
+        :param month_cutoff: months before this month are rolled into years
+        """
+        if compact_history(self.usage["usage_history"], day_cutoff, month_cutoff):
+            self.dirty = True
 
-    def add_image_request(self, image_size, image_prices="0.016,0.018,0.02"):
-        """Add image request to users usage history and update current costs.
+    # token usage functions:
 
-        :param image_size: requested image size
-        :param image_prices: prices for images of sizes ["256x256", "512x512", "1024x1024"],
-                             defaults to [0.016, 0.018, 0.02]
-        """
-        sizes = ["256x256", "512x512", "1024x1024"]
-        requested_size = sizes.index(image_size)
-        image_cost = image_prices[requested_size]
-        today = date.today()
-        self.add_current_costs(image_cost)
+    def get_current_token_usage(self):
+        """Get token amounts used for today and this month
 
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["number_images"]:
-            # add token usage to existing date
-            self.usage["usage_history"]["number_images"][str(today)][requested_size] += 1
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["number_images"][str(today)] = [0, 0, 0]
-            self.usage["usage_history"]["number_images"][str(today)][requested_size] += 1
+        :return: total number of tokens used per day and per month
+        """
+        return self.__get_period_usage("chat_tokens")
 
-        # write updated image number to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+    # image usage functions:
 
     def get_current_image_count(self):
         """Get number of images requested for today and this month.
 
         :return: total number of images requested per day and per month
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["number_images"]:
-            usage_day = sum(self.usage["usage_history"]["number_images"][str(today)])
-        else:
-            usage_day = 0
-        month = str(today)[:7]  # year-month as string
-        usage_month = 0
-        for today, images in self.usage["usage_history"]["number_images"].items():
-            if today.startswith(month):
-                usage_month += sum(images)
-        return usage_day, usage_month
-
+        return self.__get_period_usage(*[f"number_images:{size}" for size in IMAGE_SIZES])
 
     # vision usage functions
-    def add_vision_tokens(self, tokens, vision_token_price=0.01):
-        """
-         Adds requested vision tokens to a users usage history and updates current cost.
-        :param tokens: total tokens used in last request
-        :param vision_token_price: price per 1K tokens transcription, defaults to 0.01
-        """
-        today = date.today()
-        token_price = round(tokens * vision_token_price / 1000, 2)
-        self.add_current_costs(token_price)
-
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["vision_tokens"]:
-            # add requested seconds to existing date
-            self.usage["usage_history"]["vision_tokens"][str(today)] += tokens
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["vision_tokens"][str(today)] = tokens
-
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
-
     def get_current_vision_tokens(self):
         """Get vision tokens for today and this month.
 
         :return: total amount of vision tokens per day and per month
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["vision_tokens"]:
-            tokens_day = self.usage["usage_history"]["vision_tokens"][str(today)]
-        else:
-            tokens_day = 0
-        month = str(today)[:7]  # year-month as string
-        tokens_month = 0
-        for today, tokens in self.usage["usage_history"]["vision_tokens"].items():
-            if today.startswith(month):
-                tokens_month += tokens
-        return tokens_day, tokens_month
+        return self.__get_period_usage("vision_tokens")
 
     # tts usage functions:
 
-    def add_tts_request(self, text_length, tts_model, tts_prices):
-        tts_models = ['tts-1', 'tts-1-hd']
-        price = tts_prices[tts_models.index(tts_model)]
-        today = date.today()
-        tts_price = round(text_length * price / 1000, 2)
-        self.add_current_costs(tts_price)
-
-        if 'tts_characters' not in self.usage['usage_history']:
-            self.usage['usage_history']['tts_characters'] = {}
-        
-        if tts_model not in self.usage['usage_history']['tts_characters']:
-            self.usage['usage_history']['tts_characters'][tts_model] = {}
-
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["tts_characters"][tts_model]:
-            # add requested text length to existing date
-            self.usage["usage_history"]["tts_characters"][tts_model][str(today)] += text_length
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["tts_characters"][tts_model][str(today)] = text_length
-
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
-
     def get_current_tts_usage(self):
         """Get length of speech generated for today and this month.
 
         :return: total amount of characters converted to speech per day and per month
         """
-
-        tts_models = ['tts-1', 'tts-1-hd']
-        today = date.today()
-        characters_day = 0
-        for tts_model in tts_models:
-            if tts_model in self.usage["usage_history"]["tts_characters"] and \
-                str(today) in self.usage["usage_history"]["tts_characters"][tts_model]:
-                characters_day += self.usage["usage_history"]["tts_characters"][tts_model][str(today)]
-
-        month = str(today)[:7]  # year-month as string
-        characters_month = 0
-        for tts_model in tts_models:
-            if tts_model in self.usage["usage_history"]["tts_characters"]: 
-                for today, characters in self.usage["usage_history"]["tts_characters"][tts_model].items():
-                    if today.startswith(month):
-                        characters_month += characters
+        characters_day, characters_month = self.__get_period_usage("tts_characters:tts-1", "tts_characters:tts-1-hd")
         return int(characters_day), int(characters_month)
 
-
     # transcription usage functions:
 
-    def add_transcription_seconds(self, seconds, minute_price=0.006):
-        """Adds requested transcription seconds to a users usage history and updates current cost.
-        :param seconds: total seconds used in last request
-        :param minute_price: price per minute transcription, defaults to 0.006
-        """
-        today = date.today()
-        transcription_price = round(seconds * minute_price / 60, 2)
-        self.add_current_costs(transcription_price)
-
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["transcription_seconds"]:
-            # add requested seconds to existing date
-            self.usage["usage_history"]["transcription_seconds"][str(today)] += seconds
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["transcription_seconds"][str(today)] = seconds
-
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
-
     def add_current_costs(self, request_cost):
         """
         Add current cost to all_time, day and month cost and update last_update date.
@@ -278,8 +300,7 @@ class UsageTracker:
         last_update = date.fromisoformat(self.usage["current_cost"]["last_update"])
 
         # add to all_time cost, initialize with calculation of total_cost if key doesn't exist
-        self.usage["current_cost"]["all_time"] = \
-            self.usage["current_cost"].get("all_time", self.initialize_all_time_cost()) + request_cost
+        self.usage["current_cost"]["all_time"] = self.__get_all_time_cost() + request_cost
         # add current cost, update new day
         if today == last_update:
             self.usage["current_cost"]["day"] += request_cost
@@ -297,16 +318,7 @@ class UsageTracker:
 
         :return: total amount of time transcribed per day and per month (4 values)
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["transcription_seconds"]:
-            seconds_day = self.usage["usage_history"]["transcription_seconds"][str(today)]
-        else:
-            seconds_day = 0
-        month = str(today)[:7]  # year-month as string
-        seconds_month = 0
-        for today, seconds in self.usage["usage_history"]["transcription_seconds"].items():
-            if today.startswith(month):
-                seconds_month += seconds
+        seconds_day, seconds_month = self.__get_period_usage("transcription_seconds")
         minutes_day, seconds_day = divmod(seconds_day, 60)
         minutes_month, seconds_month = divmod(seconds_month, 60)
         return int(minutes_day), round(seconds_day, 2), int(minutes_month), round(seconds_month, 2)
@@ -328,9 +340,15 @@ class UsageTracker:
                 cost_month = self.usage["current_cost"]["month"]
             else:
                 cost_month = 0.0
-        # add to all_time cost, initialize with calculation of total_cost if key doesn't exist
-        cost_all_time = self.usage["current_cost"].get("all_time", self.initialize_all_time_cost())
-        return {"cost_today": cost_day, "cost_month": cost_month, "cost_all_time": cost_all_time}
+        return {"cost_today": cost_day, "cost_month": cost_month, "cost_all_time": self.__get_all_time_cost()}
+
+    def __get_all_time_cost(self):
+        """
+        Get the all_time cost, initialized once with the calculation of the total cost if it doesn't exist yet.
+        """
+        if "all_time" not in self.usage["current_cost"]:
+            self.usage["current_cost"]["all_time"] = self.initialize_all_time_cost()
+        return self.usage["current_cost"]["all_time"]
 
     def initialize_all_time_cost(self, tokens_price=0.002, image_prices="0.016,0.018,0.02", minute_price=0.006, vision_token_price=0.01, tts_prices='0.015,0.030'):
         """Get total USD amount of all requests in history
@@ -362,3 +380,268 @@ class UsageTracker:
 
         all_time_cost = token_cost + transcription_cost + image_cost + vision_cost + tts_cost
         return all_time_cost
+
+
+class GuestUsage(UsageRecorder):
+    """
+    Counts the usage of all guest users in group chats in memory.
+    Guest requests only update the pending usage per metric, which is merged
+    into the persisted guests tracker periodically, with one update per metric.
+    """
+
+    def __init__(self):
+        self.pending = {}  # {metric: [amount, cost]}
+        self.cost = 0.0
+
+    def record(self, metric, amount, cost):
+        totals = self.pending.setdefault(metric, [0, 0.0])
+        totals[0] += amount
+        totals[1] += cost
+        self.cost += cost
+
+    def get_pending_cost(self) -> float:
+        """
+        Get the cost of the usage that has not been merged yet.
+        """
+        return self.cost
+
+    def merge(self, tracker: UsageTracker):
+        """
+        Merges the pending usage into the guests tracker and resets it.
+        """
+        pending = self.pending
+        self.pending = {}
+        self.cost = 0.0
+        for metric, (amount, cost) in pending.items():
+            tracker.record(metric, amount, cost)
+
+
+class UsageRegistry:
+    """
+    Keeps the usage trackers of the recently active users and writes their changes to the storage engine in batches.
+    The least recently used trackers are evicted when there are more than `max_trackers`, and loaded again
+    on the next access. Evicted trackers with unwritten changes, or with changes that are being written,
+    are kept until their changes have been written, so they are never loaded again from outdated storage.
+    """
+
+    def __init__(self, storage: UsageStorage, keep_days: int = 0, keep_months: int = 0,
+                 enable_index: bool = False, max_trackers: int = 0):
+        """
+        Initializes the registry.
+        :param storage: The storage engine to load and write the usage of the users
+        :param keep_days: number of days to keep daily usage for before it is compacted, 0 to never compact
+        :param keep_months: number of months to keep monthly usage for before it is compacted
+        :param enable_index: Whether to keep an analytics index of the usage of all users, see `load_index`
+        :param max_trackers: The maximum number of trackers to keep loaded, 0 for no limit
+        """
+        self.storage = storage
+        self.guests = GuestUsage()
+        self.enable_index = enable_index
+        self.index: UsageIndex | None = None
+        # held while a batch is written and indexed, so the index is never loaded in the middle of it
+        self.writing = asyncio.Lock()
+        self.write_task: asyncio.Task | None = None  # the last batch written by `flush`
+        self.keep_days = keep_days
+        self.keep_months = keep_months
+        self.max_trackers = max_trackers
+        self.trackers = OrderedDict()
+        self.evicted = {}  # evicted trackers with changes that are not written yet, or being written
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.compacted = {}  # {user_id: date of the last compaction}
+        self.storage_compacted = None
+
+    def __contains__(self, user_id):
+        return user_id in self.trackers
+
+    def __getitem__(self, user_id):
+        return self.get_tracker(user_id, None)
+
+    def get_tracker(self, user_id, user_name):
+        """
+        Returns the usage tracker of a user, loading it from the storage engine if it is not loaded.
+        :param user_id: Telegram ID of the user
+        :param user_name: Telegram user name, None if it is not known, which keeps the stored name
+        :return: the usage tracker
+        """
+        if user_id in self.trackers:
+            self.hits += 1
+            self.trackers.move_to_end(user_id)
+            tracker = self.trackers[user_id]
+        else:
+            if user_id in self.evicted:
+                self.hits += 1
+                tracker = self.evicted.pop(user_id)
+            else:
+                self.misses += 1
+                tracker = UsageTracker(user_id, user_name, storage=self.storage)
+            self.trackers[user_id] = tracker
+            self.__evict()
+
+        if user_name is not None and tracker.usage['user_name'] is None:
+            # the tracker of a new user was created by an access that didn't know the name
+            tracker.usage['user_name'] = user_name
+            tracker.dirty = True
+        return tracker
+
+    def get_cache_stats(self):
+        """
+        Get the statistics of the tracker cache.
+        :return: dictionary with the number of loaded trackers, hits, misses and evictions
+        """
+        return {"loaded": len(self.trackers), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def __evict(self):
+        """
+        Evicts the least recently used trackers while there are more than `max_trackers`.
+        The guests tracker is never evicted.
+        """
+        while 0 < self.max_trackers < len(self.trackers):
+            user_id, tracker = self.trackers.popitem(last=False)
+            if user_id == 'guests':
+                self.trackers['guests'] = tracker
+                if len(self.trackers) == 1:
+                    break
+                continue
+            self.evictions += 1
+            self.compacted.pop(user_id, None)
+            if tracker.dirty or tracker.writing > 0:
+                self.evicted[user_id] = tracker
+
+    def get_guest_cost(self):
+        """
+        Get the cost of all guest users, including the usage that has not been merged into the guests tracker yet.
+        :return: cost of current day, month and all time, see `UsageTracker.get_current_cost`
+        """
+        cost = self.get_tracker('guests', GUESTS_NAME).get_current_cost()
+        pending_cost = self.guests.get_pending_cost()
+        return {period: amount + pending_cost for period, amount in cost.items()}
+
+    def merge_guests(self):
+        """
+        Merges the pending guest usage into the guests tracker.
+        """
+        if self.guests.pending:
+            self.guests.merge(self.get_tracker('guests', GUESTS_NAME))
+
+    async def flush(self):
+        """
+        Writes the changes of all trackers to the storage engine in a background thread.
+        The snapshots are taken on the event loop, so the written usage is consistent.
+        The write of a batch can't be interrupted: if the flush is cancelled, the batch is still written,
+        and `close` waits for it.
+        """
+        self.merge_guests()
+        batch = self.__take_changes()
+        if len(batch) == 0:
+            return
+        self.write_task = asyncio.create_task(self.__write(batch))
+        await asyncio.shield(self.write_task)
+
+    async def __write(self, batch):
+        """
+        Writes a batch of changes in a background thread and adds it to the analytics index.
+        """
+        try:
+            async with self.writing:
+                try:
+                    await asyncio.to_thread(self.storage.write, [snapshot for _, _, snapshot in batch])
+                except Exception:
+                    self.__restore_changes(batch)
+                    raise
+                self.__index_changes(batch)
+        finally:
+            self.__release_evicted(batch)
+
+    async def load_index(self):
+        """
+        Builds the analytics index from the whole stored usage in a background thread,
+        and keeps it up to date with the written usage from then on. Writes wait until the index is built,
+        so every written batch is counted exactly once. The index is None until it is built.
+        """
+        if not self.enable_index:
+            return
+        async with self.writing:
+            index = UsageIndex()
+            await asyncio.to_thread(index.load, self.storage)
+            self.index = index
+        logging.info(f'Loaded usage index with {index.size} rows')
+
+    async def compact(self):
+        """
+        Compacts the usage history of every loaded tracker once a day, and the storage engine once a day
+        in a background thread, see `UsageTracker.compact`.
+        """
+        if self.keep_days == 0:
+            return
+        today = date.today()
+        day_cutoff, month_cutoff = compaction_cutoffs(today, self.keep_days, self.keep_months)
+        for user_id, tracker in self.trackers.items():
+            if self.compacted.get(user_id) != today:
+                tracker.compact(day_cutoff, month_cutoff)
+                self.compacted[user_id] = today
+        if self.storage_compacted != today:
+            self.storage_compacted = today
+            # no batch is written meanwhile, so the compaction never overwrites a newer write
+            async with self.writing:
+                loaded = {str(user_id) for user_id in [*self.trackers, *self.evicted]}
+                await asyncio.to_thread(self.storage.compact, day_cutoff, month_cutoff, loaded)
+
+    async def close(self):
+        """
+        Waits for the batch being written, if any, then writes all pending changes and closes the storage engine.
+        """
+        if self.write_task is not None:
+            # a failed batch is marked as changed again, and written below
+            await asyncio.gather(self.write_task, return_exceptions=True)
+        self.merge_guests()
+        batch = self.__take_changes()
+        if len(batch) > 0:
+            self.storage.write([snapshot for _, _, snapshot in batch])
+            self.__index_changes(batch)
+            self.__release_evicted(batch)
+        self.storage.close()
+
+    def __take_changes(self):
+        """
+        Takes a snapshot of every changed tracker and marks it as being written, see `__release_evicted`.
+        :return: list of (tracker, events, snapshot) tuples
+        """
+        batch = []
+        for tracker in [*self.trackers.values(), *self.evicted.values()]:
+            if tracker.dirty:
+                events = tracker.events
+                tracker.events = []
+                tracker.dirty = False
+                tracker.writing += 1
+                batch.append((tracker, events, self.storage.snapshot(tracker, events)))
+        return batch
+
+    def __restore_changes(self, batch):
+        """
+        Marks the trackers of a batch that could not be written to be written again.
+        """
+        for tracker, events, _ in batch:
+            tracker.events = events + tracker.events
+            tracker.dirty = True
+
+    def __release_evicted(self, batch):
+        """
+        Marks the trackers of a batch as no longer being written,
+        and drops the evicted ones that have no other changes to write.
+        """
+        for tracker, _, _ in batch:
+            tracker.writing -= 1
+            if self.evicted.get(tracker.user_id) is tracker and not tracker.dirty and tracker.writing == 0:
+                del self.evicted[tracker.user_id]
+
+    def __index_changes(self, batch):
+        """
+        Adds the written usage events of a batch to the analytics index.
+        """
+        if self.index is None:
+            return
+        for tracker, events, _ in batch:
+            self.index.add(tracker.user_id, tracker.usage['user_name'],
+                           [(time[:10], metric, amount) for time, metric, amount, _ in events])
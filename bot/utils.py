@@ -1,7 +1,6 @@
 from __future__ import annotations
 
 import asyncio
-import itertools
 import json
 import logging
 import os
@@ -11,7 +10,8 @@ import telegram
 from telegram import Message, MessageEntity, Update, ChatMember, constants
 from telegram.ext import CallbackContext, ContextTypes
 
-from usage_tracker import UsageTracker
+from access_policy import get_access_policy
+from membership_cache import MembershipCache
 
 
 def message_text(message: Message) -> str:
@@ -78,6 +78,21 @@ def is_group_chat(update: Update) -> bool:
     ]
 
 
+def is_addressed_to_bot(config, update: Update, bot_id: int) -> bool:
+    """
+    Checks if a group chat text message is addressed to the bot: it starts with the trigger keyword,
+    is a /chat command or replies to a message of the bot. Only needs the message itself, so it is cheap
+    enough to run before checking if the user is allowed.
+    """
+    trigger_keyword = config['group_trigger_keyword'].lower()
+    if message_text(update.message).lower().startswith(trigger_keyword) or \
+            update.message.text.lower().startswith('/chat'):
+        return True
+    reply_to_message = update.message.reply_to_message
+    return reply_to_message is not None and reply_to_message.from_user is not None and \
+        reply_to_message.from_user.id == bot_id
+
+
 def split_into_chunks(text: str, chunk_size: int = 4096) -> list[str]:
     """
     Splits a string into chunks of a given size.
@@ -100,6 +115,9 @@ async def wrap_with_indicator(update: Update, context: CallbackContext, coroutin
             await asyncio.wait_for(asyncio.shield(task), 4.5)
         except asyncio.TimeoutError:
             pass
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
 
 
 async def edit_message_with_retry(context: ContextTypes.DEFAULT_TYPE, chat_id: int | None,
@@ -148,30 +166,29 @@ async def error_handler(_: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logging.error(f'Exception while handling an update: {context.error}')
 
 
-async def is_allowed(config, update: Update, context: CallbackContext, is_inline=False) -> bool:
+async def is_allowed(config, update: Update, context: CallbackContext, is_inline=False,
+                     membership: MembershipCache | None = None) -> bool:
     """
     Checks if the user is allowed to use the bot.
+    Guests may use the bot in group chats with at least one allowed user or admin,
+    which is looked up in the membership cache if given.
     """
-    if config['allowed_user_ids'] == '*':
+    policy = get_access_policy(config)
+    if policy.allow_all:
         return True
 
     user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
-    if is_admin(config, user_id):
-        return True
-    name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    allowed_user_ids = config['allowed_user_ids'].split(',')
     # Check if user is allowed
-    if str(user_id) in allowed_user_ids:
+    if policy.check(user_id).allowed:
         return True
+    name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
     # Check if it's a group a chat with at least one authorized member
     if not is_inline and is_group_chat(update):
-        admin_user_ids = config['admin_user_ids'].split(',')
-        for user in itertools.chain(allowed_user_ids, admin_user_ids):
-            if not user.strip():
-                continue
-            if await is_user_in_group(update, context, user):
-                logging.info(f'{user} is a member. Allowing group chat message...')
-                return True
+        membership = membership or MembershipCache(ttl=0)
+        user = await membership.any_member(update, context, policy.member_user_ids, is_user_in_group)
+        if user is not None:
+            logging.info(f'{user} is a member. Allowing group chat message...')
+            return True
         logging.info(f'Group chat messages from user {name} '
                      f'(id: {user_id}) are not allowed')
     return False
@@ -182,18 +199,21 @@ def is_admin(config, user_id: int, log_no_admin=False) -> bool:
     Checks if the user is the admin of the bot.
     The first user in the user list is the admin.
     """
-    if config['admin_user_ids'] == '-':
+    policy = get_access_policy(config)
+    if not policy.admin_user_ids:
         if log_no_admin:
             logging.info('No admin user defined.')
         return False
 
-    admin_user_ids = config['admin_user_ids'].split(',')
-
     # Check if user is in the admin user list
-    if str(user_id) in admin_user_ids:
-        return True
+    return policy.check(user_id).admin
 
-    return False
+
+def is_guest(config, user_id) -> bool:
+    """
+    Checks if the usage of the user counts towards the guest budget.
+    """
+    return get_access_policy(config).check(user_id).guest
 
 
 def get_user_budget(config, user_id) -> float | None:
@@ -203,34 +223,14 @@ def get_user_budget(config, user_id) -> float | None:
     :param user_id: User id
     :return: The user's budget as a float, or None if the user is not found in the allowed user list
     """
-
-    # no budget restrictions for admins and '*'-budget lists
-    if is_admin(config, user_id) or config['user_budgets'] == '*':
-        return float('inf')
-
-    user_budgets = config['user_budgets'].split(',')
-    if config['allowed_user_ids'] == '*':
-        # same budget for all users, use value in first position of budget list
-        if len(user_budgets) > 1:
-            logging.warning('multiple values for budgets set with unrestricted user list '
-                            'only the first value is used as budget for everyone.')
-        return float(user_budgets[0])
-
-    allowed_user_ids = config['allowed_user_ids'].split(',')
-    if str(user_id) in allowed_user_ids:
-        user_index = allowed_user_ids.index(str(user_id))
-        if len(user_budgets) <= user_index:
-            logging.warning(f'No budget set for user id: {user_id}. Budget list shorter than user list.')
-            return 0.0
-        return float(user_budgets[user_index])
-    return None
+    return get_access_policy(config).check(user_id).budget
 
 
 def get_remaining_budget(config, usage, update: Update, is_inline=False) -> float:
     """
     Calculate the remaining budget for a user based on their current usage.
     :param config: The bot configuration object
-    :param usage: The usage tracker object
+    :param usage: The usage registry
     :param update: Telegram update object
     :param is_inline: Boolean flag for inline queries
     :return: The remaining budget for the user as a float
@@ -244,8 +244,7 @@ def get_remaining_budget(config, usage, update: Update, is_inline=False) -> floa
 
     user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
     name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    if user_id not in usage:
-        usage[user_id] = UsageTracker(user_id, name)
+    usage.get_tracker(user_id, name)
 
     # Get budget for users
     user_budget = get_user_budget(config, user_id)
@@ -255,9 +254,7 @@ def get_remaining_budget(config, usage, update: Update, is_inline=False) -> floa
         return user_budget - cost
 
     # Get budget for guests
-    if 'guests' not in usage:
-        usage['guests'] = UsageTracker('guests', 'all guest users in group chats')
-    cost = usage['guests'].get_current_cost()[budget_cost_map[budget_period]]
+    cost = usage.get_guest_cost()[budget_cost_map[budget_period]]
     return config['guest_budget'] - cost
 
 
@@ -266,15 +263,14 @@ def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
     Checks if the user reached their usage limit.
     Initializes UsageTracker for user and guest when needed.
     :param config: The bot configuration object
-    :param usage: The usage tracker object
+    :param usage: The usage registry
     :param update: Telegram update object
     :param is_inline: Boolean flag for inline queries
     :return: Boolean indicating if the user has a positive budget
     """
     user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
     name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    if user_id not in usage:
-        usage[user_id] = UsageTracker(user_id, name)
+    usage.get_tracker(user_id, name)
     remaining_budget = get_remaining_budget(config, usage, update, is_inline=is_inline)
     return remaining_budget > 0
 
@@ -282,7 +278,7 @@ def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
 def add_chat_request_to_usage_tracker(usage, config, user_id, used_tokens):
     """
     Add chat request to usage tracker
-    :param usage: The usage tracker object
+    :param usage: The usage registry
     :param config: The bot configuration object
     :param user_id: The user id
     :param used_tokens: The number of tokens used
@@ -294,9 +290,8 @@ def add_chat_request_to_usage_tracker(usage, config, user_id, used_tokens):
         # add chat request to users usage tracker
         usage[user_id].add_chat_tokens(used_tokens, config['token_price'])
         # add guest chat request to guest usage tracker
-        allowed_user_ids = config['allowed_user_ids'].split(',')
-        if str(user_id) not in allowed_user_ids and 'guests' in usage:
-            usage["guests"].add_chat_tokens(used_tokens, config['token_price'])
+        if is_guest(config, user_id) and 'guests' in usage:
+            usage.guests.add_chat_tokens(used_tokens, config['token_price'])
     except Exception as e:
         logging.warning(f'Failed to add tokens to usage_logs: {str(e)}')
         pass
@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from chat_queue import ChatQueue, ChatQueueFull
+
+
+def test_requests_of_a_chat_run_in_order_and_other_chats_in_parallel():
+    async def run():
+        queue = ChatQueue()
+        order = []
+
+        async def request(chat_id, name, delay):
+            await queue.acquire(chat_id)
+            try:
+                order.append(f'{name} start')
+                await asyncio.sleep(delay)
+                order.append(f'{name} end')
+            finally:
+                queue.release(chat_id)
+
+        await asyncio.gather(request(1, 'a', 0.05), request(1, 'b', 0), request(2, 'c', 0))
+        return order
+
+    order = asyncio.run(run())
+    assert order.index('a end') < order.index('b start')
+    assert order.index('c end') < order.index('a end')
+
+
+def test_acquire_raises_once_the_chat_queue_is_full():
+    async def run():
+        queue = ChatQueue(max_depth=2)
+        await queue.acquire(1)
+        waiting = asyncio.create_task(queue.acquire(1))
+        await asyncio.sleep(0)
+        with pytest.raises(ChatQueueFull):
+            await queue.acquire(1)
+        await queue.acquire(2)
+
+        queue.release(1)
+        await waiting
+        queue.release(1)
+        queue.release(2)
+        assert queue.depths == {} and queue.locks == {}
+
+    asyncio.run(run())
+
+
+def test_cancel_only_cancels_the_running_request_of_the_user():
+    async def run():
+        queue = ChatQueue()
+        started = asyncio.Event()
+
+        async def request():
+            await queue.acquire(1, user_id=10)
+            try:
+                started.set()
+                await asyncio.sleep(10)
+            finally:
+                queue.release(1)
+
+        task = asyncio.create_task(request())
+        await started.wait()
+        assert not queue.cancel(1, user_id=20)
+        assert not queue.cancel(2)
+        assert queue.cancel(1, user_id=10)
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert 1 not in queue.running and queue.depths == {}
+
+    asyncio.run(run())
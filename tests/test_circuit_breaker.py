@@ -0,0 +1,48 @@
+import circuit_breaker
+from circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_breaker_opens_after_consecutive_failures_and_closes_after_a_trial(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(circuit_breaker.time, 'monotonic', clock)
+    breaker = CircuitBreaker(threshold=2, cooldown=30)
+
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.get_retry_after() == 30
+
+    clock.now += 30
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.rejected == 2
+
+
+def test_failed_trial_opens_the_breaker_again(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(circuit_breaker.time, 'monotonic', clock)
+    breaker = CircuitBreaker(threshold=1, cooldown=30)
+    breaker.record_failure()
+
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+
+    clock.now += 30
+    assert breaker.allow()
+    breaker.abandon()
+    assert breaker.allow()
@@ -0,0 +1,71 @@
+from conversation_backend import SQLiteConversationBackend
+from conversation_store import ConversationStore
+
+
+def fill(store, chat_id, count):
+    store.reset(chat_id)
+    store.append(chat_id, {'role': 'system', 'content': 'prompt'}, 5)
+    for index in range(count):
+        store.append(chat_id, {'role': 'user', 'content': f'message {index}'}, 3)
+
+
+def test_truncate_keeps_the_system_prompt(tmp_path):
+    backend = SQLiteConversationBackend(str(tmp_path / 'conversations.db'))
+    store = ConversationStore(backend=backend)
+    fill(store, 1, 5)
+
+    store.truncate(1, 3)
+
+    contents = ['prompt', 'message 3', 'message 4']
+    assert [message['content'] for message in store[1].messages] == contents
+    assert store[1].total_tokens == 11
+    assert [message['content'] for message in backend.load(1).messages] == contents
+
+
+def test_truncate_to_one_message_keeps_only_the_system_prompt(tmp_path):
+    backend = SQLiteConversationBackend(str(tmp_path / 'conversations.db'))
+    store = ConversationStore(backend=backend)
+    fill(store, 1, 2)
+
+    store.truncate(1, 1)
+
+    assert [message['content'] for message in store[1].messages] == ['prompt']
+    assert [message['content'] for message in backend.load(1).messages] == ['prompt']
+
+
+def test_least_recently_used_conversations_are_evicted_and_loaded_again(tmp_path):
+    backend = SQLiteConversationBackend(str(tmp_path / 'conversations.db'))
+    store = ConversationStore(max_conversations=2, backend=backend)
+    fill(store, 1, 1)
+    fill(store, 2, 1)
+    store.get(1)
+    fill(store, 3, 1)
+
+    assert 2 not in store and 1 in store and 3 in store
+    assert [message['content'] for message in store.get(2).messages] == ['prompt', 'message 0']
+    assert len(store) == 2
+
+
+def test_conversations_are_evicted_over_the_memory_limit():
+    store = ConversationStore(max_memory_mb=100 / (1024 * 1024))
+    fill(store, 1, 5)
+    fill(store, 2, 5)
+
+    assert 1 not in store and 2 in store
+    assert store.size == store[2].size
+
+
+def test_replace_swaps_the_messages_and_the_summary(tmp_path):
+    backend = SQLiteConversationBackend(str(tmp_path / 'conversations.db'))
+    store = ConversationStore(backend=backend)
+    fill(store, 1, 4)
+    conversation = store[1]
+
+    store.replace(1, conversation.messages[:1] + conversation.messages[4:], conversation.tokens[:1] +
+                  conversation.tokens[4:], summary='earlier messages', summary_tokens=4)
+
+    assert [message['content'] for message in store[1].messages] == ['prompt', 'message 3']
+    assert store[1].total_tokens == 8
+    loaded = backend.load(1)
+    assert [message['content'] for message in loaded.messages] == ['prompt', 'message 3']
+    assert (loaded.summary, loaded.summary_tokens) == ('earlier messages', 4)
@@ -0,0 +1,62 @@
+import asyncio
+
+from plugin_cache import PluginResultCache, cache_key
+
+
+def test_cache_key_normalizes_the_arguments():
+    assert cache_key('f', {'b': ' x ', 'a': 1}) == cache_key('f', {'a': 1, 'b': 'x'})
+
+
+def test_concurrent_calls_with_the_same_key_share_one_call():
+    async def run():
+        cache = PluginResultCache()
+        calls = 0
+
+        async def call():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return {'result': calls}
+
+        results = await asyncio.gather(*[cache.get_or_call('key', 60, call, lambda _: True) for _ in range(5)])
+        assert results == [{'result': 1}] * 5
+        assert await cache.get_or_call('key', 60, call, lambda _: True) == {'result': 1}
+        assert calls == 1
+        assert cache.get_stats()['coalesced'] == 4 and cache.get_stats()['hits'] == 1
+
+    asyncio.run(run())
+
+
+def test_results_that_are_not_cacheable_are_called_again():
+    async def run():
+        cache = PluginResultCache()
+        calls = 0
+
+        async def call():
+            nonlocal calls
+            calls += 1
+            return {'error': 'timeout'}
+
+        await cache.get_or_call('key', 60, call, lambda result: 'error' not in result)
+        await cache.get_or_call('key', 60, call, lambda result: 'error' not in result)
+        assert calls == 2
+
+    asyncio.run(run())
+
+
+def test_a_cancelled_caller_does_not_cancel_the_call_of_the_others():
+    async def run():
+        cache = PluginResultCache()
+
+        async def call():
+            await asyncio.sleep(0.02)
+            return 'done'
+
+        first = asyncio.create_task(cache.get_or_call('key', 60, call, lambda _: True))
+        second = asyncio.create_task(cache.get_or_call('key', 60, call, lambda _: True))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == 'done'
+        assert first.cancelled()
+
+    asyncio.run(run())
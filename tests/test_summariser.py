@@ -0,0 +1,97 @@
+import asyncio
+from types import SimpleNamespace
+
+from summariser import Summariser
+
+
+class CharacterEncoding:
+    """
+    Counts one token per character, so the tests don't need to download an encoding.
+    """
+
+    def encode(self, text: str) -> list[str]:
+        return list(text)
+
+    def decode(self, tokens: list[str]) -> str:
+        return ''.join(tokens)
+
+
+def test_build_input_names_the_results_of_a_tool_round():
+    summariser = Summariser(client=None, model='gpt-4o', encoding=CharacterEncoding())
+    messages = [
+        {'role': 'user', 'content': 'Weather in Paris and the price of bitcoin?'},
+        {'role': 'assistant', 'content': None, 'tool_calls': [
+            {'id': 'call_1', 'type': 'function',
+             'function': {'name': 'get_current_weather', 'arguments': '{"location": "Paris"}'}},
+            {'id': 'call_2', 'type': 'function',
+             'function': {'name': 'get_crypto_rate', 'arguments': '{"asset": "BTC"}'}},
+        ]},
+        {'role': 'tool', 'tool_call_id': 'call_1', 'content': '{"temperature": 18}'},
+        {'role': 'tool', 'tool_call_id': 'call_2', 'content': '{"rate": 60000}'},
+    ]
+
+    rendered, count = summariser.build_input(messages, 1000)
+    assert count == 4
+    assert rendered.splitlines() == [
+        'User: Weather in Paris and the price of bitcoin?',
+        'Assistant called get_current_weather({"location": "Paris"}), get_crypto_rate({"asset": "BTC"})',
+        'Result of get_current_weather: {"temperature": 18}',
+        'Result of get_crypto_rate: {"rate": 60000}',
+    ]
+
+
+def test_build_input_keeps_the_oldest_messages_that_fit():
+    summariser = Summariser(client=None, model='gpt-4o', encoding=CharacterEncoding())
+    messages = [{'role': 'user', 'content': 'a' * 10},
+                {'role': 'assistant', 'content': 'b' * 10},
+                {'role': 'user', 'content': 'c' * 10}]
+
+    rendered, count = summariser.build_input(messages, 40)
+
+    assert count == 2
+    assert rendered == f"User: {'a' * 10}\nAssistant: {'b' * 10}"
+
+
+def test_build_input_shortens_an_oldest_message_over_budget():
+    summariser = Summariser(client=None, model='gpt-4o', encoding=CharacterEncoding())
+    messages = [{'role': 'user', 'content': 'a' * 100}, {'role': 'user', 'content': 'b'}]
+
+    rendered, count = summariser.build_input(messages, 20)
+
+    assert count == 1
+    assert rendered == f"User: {'a' * 14}…"
+
+
+def test_build_input_never_splits_a_tool_round():
+    summariser = Summariser(client=None, model='gpt-4o', encoding=CharacterEncoding())
+    messages = [
+        {'role': 'assistant', 'content': None, 'tool_calls': [
+            {'id': 'call_1', 'type': 'function', 'function': {'name': 'f', 'arguments': '{}'}},
+            {'id': 'call_2', 'type': 'function', 'function': {'name': 'g', 'arguments': '{}'}},
+        ]},
+        {'role': 'tool', 'tool_call_id': 'call_1', 'content': 'x' * 50},
+        {'role': 'tool', 'tool_call_id': 'call_2', 'content': 'y' * 50},
+        {'role': 'user', 'content': 'thanks'},
+    ]
+
+    _, count = summariser.build_input(messages, 40)
+
+    assert count == 3
+
+
+def test_summarise_reports_the_number_of_folded_messages():
+    class Completions:
+        async def create(self, **kwargs):
+            self.content = kwargs['messages'][1]['content']
+            message = SimpleNamespace(content='new summary')
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    completions = Completions()
+    client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    summariser = Summariser(client=client, model='gpt-4o', encoding=CharacterEncoding(), max_input_tokens=60)
+    messages = [{'role': 'user', 'content': 'a' * 10}, {'role': 'user', 'content': 'b' * 10}]
+
+    summary, count = asyncio.run(summariser.summarise('old summary', messages))
+
+    assert (summary, count) == ('new summary', 2)
+    assert completions.content.endswith(f"New messages:\nUser: {'a' * 10}\nUser: {'b' * 10}")
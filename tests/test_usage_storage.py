@@ -0,0 +1,65 @@
+import json
+from datetime import date
+
+from usage_storage import JSONUsageStorage, SQLiteUsageStorage, compaction_cutoffs, rollup_key
+
+
+def test_compaction_cutoffs_never_roll_up_the_current_month_or_year():
+    assert compaction_cutoffs(date(2024, 3, 15), 90, 24) == ('2023-12-16', '2022-03')
+    assert compaction_cutoffs(date(2024, 3, 15), 5, 1) == ('2024-03', '2024')
+
+
+def test_rollup_key_rolls_days_into_months_and_months_into_years():
+    assert rollup_key('2024-01-05', '2024-02-01', '2023-06') == '2024-01'
+    assert rollup_key('2024-02-05', '2024-02-01', '2023-06') is None
+    assert rollup_key('2022-01-05', '2024-02-01', '2023-06') == '2022'
+    assert rollup_key('2023-01', '2024-02-01', '2023-06') == '2023'
+    assert rollup_key('2023-07', '2024-02-01', '2023-06') is None
+    assert rollup_key('2022', '2024-02-01', '2023-06') is None
+
+
+def write_usage(logs_dir, user_id, usage_history):
+    usage = {'user_name': f'@user{user_id}', 'current_cost': {}, 'usage_history': usage_history}
+    (logs_dir / f'{user_id}.json').write_text(json.dumps(usage))
+
+
+def test_json_compaction_skips_loaded_users(tmp_path):
+    history = {'chat_tokens': {'2023-01-01': 10, '2023-01-02': 5, '2024-03-01': 1},
+               'number_images': {'2023-01-01': [1, 0, 0], '2023-01-03': [0, 2, 1]},
+               'tts_characters': {'tts-1': {'2023-01-01': 7}}}
+    write_usage(tmp_path, 1, history)
+    write_usage(tmp_path, 2, history)
+
+    JSONUsageStorage(str(tmp_path)).compact('2024-01-01', '2022-01', loaded={'2'})
+
+    compacted = json.loads((tmp_path / '1.json').read_text())['usage_history']
+    assert compacted == {'chat_tokens': {'2023-01': 15, '2024-03-01': 1},
+                         'number_images': {'2023-01': [1, 2, 1]},
+                         'tts_characters': {'tts-1': {'2023-01': 7}}}
+    assert json.loads((tmp_path / '2.json').read_text())['usage_history'] == history
+
+
+def test_sqlite_compaction_prunes_old_events(tmp_path):
+    storage = SQLiteUsageStorage(str(tmp_path / 'usage.db'))
+    events = [('2023-01-01T10:00:00', 'chat_tokens', 10, 0.1), ('2024-03-01T10:00:00', 'chat_tokens', 5, 0.05)]
+    storage.write([('1', '@alice', '{}', events)])
+
+    storage.compact('2024-01-01', '2022-01', loaded=set())
+
+    assert storage.connection.execute('SELECT time FROM usage_events').fetchall() == [('2024-03-01T10:00:00',)]
+    assert sorted(storage.iter_rows()) == [('1', '@alice', '2023-01', 'chat_tokens', 10),
+                                           ('1', '@alice', '2024-03-01', 'chat_tokens', 5)]
+    storage.close()
+
+
+def test_sqlite_rows_are_streamed_while_writes_continue(tmp_path):
+    storage = SQLiteUsageStorage(str(tmp_path / 'usage.db'))
+    storage.write([(str(user_id), None, '{}', [('2024-03-01T10:00:00', 'chat_tokens', 1, 0.0)])
+                   for user_id in range(2500)])
+
+    rows = storage.iter_rows()
+    first = next(rows)
+    storage.write([('new', None, '{}', [('2024-03-01T10:00:00', 'chat_tokens', 1, 0.0)])])
+
+    assert len([first, *rows]) == 2500
+    storage.close()
@@ -0,0 +1,75 @@
+import asyncio
+import threading
+
+from usage_storage import JSONUsageStorage
+from usage_tracker import UsageRegistry
+
+
+class BlockingStorage(JSONUsageStorage):
+    """
+    Stores usage as JSON files, but each write waits until it is released, and can be made to fail.
+    """
+
+    def __init__(self, logs_dir):
+        super().__init__(logs_dir)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.fail = False
+
+    def write(self, snapshots):
+        self.started.set()
+        self.release.wait(5)
+        if self.fail:
+            raise OSError('disk full')
+        super().write(snapshots)
+
+
+async def start_flush(registry, storage):
+    flush = asyncio.create_task(registry.flush())
+    while not storage.started.is_set():
+        await asyncio.sleep(0.01)
+    return flush
+
+
+def test_tracker_evicted_during_a_flush_is_not_reloaded(tmp_path):
+    async def run():
+        storage = BlockingStorage(str(tmp_path))
+        registry = UsageRegistry(storage, max_trackers=1)
+        tracker = registry.get_tracker(1, '@alice')
+        tracker.add_chat_tokens(100)
+        flush = await start_flush(registry, storage)
+
+        registry.get_tracker(2, '@bob')
+        assert 1 not in registry
+        assert registry.get_tracker(1, '@alice') is tracker
+
+        storage.release.set()
+        await flush
+        assert registry.get_tracker(1, '@alice').get_current_token_usage() == (100, 100)
+
+    asyncio.run(run())
+
+
+def test_failed_batch_of_an_evicted_tracker_is_written_again(tmp_path):
+    async def run():
+        storage = BlockingStorage(str(tmp_path))
+        registry = UsageRegistry(storage, max_trackers=1)
+        registry.get_tracker(1, '@alice').add_chat_tokens(100)
+        flush = await start_flush(registry, storage)
+
+        registry.get_tracker(2, '@bob')
+        storage.fail = True
+        storage.release.set()
+        try:
+            await flush
+        except OSError:
+            pass
+        assert 1 in registry.evicted
+
+        storage.fail = False
+        await registry.flush()
+        assert 1 not in registry.evicted
+        reloaded = UsageRegistry(JSONUsageStorage(str(tmp_path))).get_tracker(1, '@alice')
+        assert reloaded.get_current_token_usage() == (100, 100)
+
+    asyncio.run(run())